@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+from rate_limiter import RateLimiter
+
+# self-hosted servers are throttled by the concurrency caps of their endpoints, quotas are only applied if configured
+UNLIMITED = 1e12
+DEFAULT_CONCURRENCY = 16
+
+# one OpenAI compatible server (e.g. vLLM or llama.cpp server), its clients keep their connections alive between requests
+# (httpx and openai are imported with the first client, reading the config does not need them)
+class Endpoint:
+    def __init__(self, name, base_url, api_key_env=None, max_concurrency=DEFAULT_CONCURRENCY, timeout=600):
+        self.name = name
+        self.base_url = base_url
+        # local servers usually accept any key, but the OpenAI client requires one
+        self.api_key = os.environ.get(api_key_env, "") if api_key_env else "EMPTY"
+        self.max_concurrency = int(max_concurrency)
+        self.timeout = float(timeout)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.client = None
+        self.async_client = None
+        self.loop = None
+
+    def limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency, keepalive_expiry=60)
+
+    def get_client(self):
+        if self.client is None:
+            import httpx
+            from openai import OpenAI
+            http_client = httpx.Client(limits=self.limits(), timeout=self.timeout)
+            self.client = OpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0, http_client=http_client)
+        return self.client
+
+    # the connections of an async client belong to the event loop which opened them, so every loop gets its own pool
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.loop is not loop:
+            import httpx
+            from openai import AsyncOpenAI
+            http_client = httpx.AsyncClient(limits=self.limits(), timeout=self.timeout)
+            self.async_client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0, http_client=http_client)
+            self.loop = loop
+        return self.async_client
+
+    def load(self):
+        return self.in_flight / self.max_concurrency
+
+    def stats(self):
+        return {"base_url": self.base_url, "max_concurrency": self.max_concurrency, "requests": self.requests, "failures": self.failures, "in_flight": self.in_flight}
+
+# a model tag of the registry, which is served by one or more endpoints under the served model name
+class Route:
+    def __init__(self, registry, model, served_model, endpoints, supports_n=True, rpm=None, tpm=None):
+        self.registry = registry
+        self.model = model
+        self.served_model = served_model
+        self.endpoints = endpoints
+        self.supports_n = supports_n
+        self.rate_limiter = RateLimiter(float(rpm) if rpm else UNLIMITED, float(tpm) if tpm else UNLIMITED)
+
+    # the request parameters use the model tag of the experiments, the servers expect their own model name
+    def request(self, params):
+        return {**params, "model": self.served_model}
+
+    def slot(self):
+        return self.registry.slot(self.endpoints)
+
+    def async_slot(self):
+        return self.registry.async_slot(self.endpoints)
+
+# endpoints and model routes of a config file, the endpoints (and their caps) are shared by all models they serve
+class BackendRegistry:
+    def __init__(self, config):
+        self.endpoints = {}
+        for name, endpoint in config.get("endpoints", {}).items():
+            self.endpoints[name] = Endpoint(name, endpoint["base_url"], endpoint.get("api_key_env"), endpoint.get("max_concurrency", DEFAULT_CONCURRENCY), endpoint.get("timeout", 600))
+
+        self.routes = {}
+        for model, route in config.get("models", {}).items():
+            missing = [name for name in route["endpoints"] if name not in self.endpoints]
+            if missing or not route["endpoints"]:
+                raise Exception("Model {} of the backend config has no or unknown endpoints: {}".format(model, ", ".join(missing)))
+            endpoints = [self.endpoints[name] for name in route["endpoints"]]
+            self.routes[model] = Route(self, model, route.get("served_model", model), endpoints, route.get("supports_n", True), route.get("rpm"), route.get("tpm"))
+
+        self.condition = threading.Condition()
+        self.waiters = []
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    # least loaded endpoint with a free slot, ties go to the endpoint with fewer requests so far
+    def select(self, endpoints):
+        available = [endpoint for endpoint in endpoints if endpoint.in_flight < endpoint.max_concurrency]
+        if not available:
+            return None
+        endpoint = min(available, key=lambda endpoint: (endpoint.load(), endpoint.requests))
+        endpoint.in_flight += 1
+        endpoint.requests += 1
+        return endpoint
+
+    # a released slot wakes up all waiting requests, which select an endpoint again
+    def release(self, endpoint, failed=False):
+        with self.condition:
+            endpoint.in_flight -= 1
+            if failed:
+                endpoint.failures += 1
+            waiters, self.waiters = self.waiters, []
+            self.condition.notify_all()
+
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(wake, waiter)
+            except RuntimeError:
+                # the loop of the waiter is already closed
+                continue
+
+    @contextmanager
+    def slot(self, endpoints):
+        with self.condition:
+            endpoint = self.select(endpoints)
+            while endpoint is None:
+                self.condition.wait()
+                endpoint = self.select(endpoints)
+
+        failed = False
+        try:
+            yield endpoint
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.release(endpoint, failed)
+
+    @asynccontextmanager
+    async def async_slot(self, endpoints):
+        while True:
+            with self.condition:
+                endpoint = self.select(endpoints)
+                if endpoint is None:
+                    loop = asyncio.get_running_loop()
+                    waiter = loop.create_future()
+                    self.waiters.append((loop, waiter))
+            if endpoint is not None:
+                break
+            await waiter
+
+        failed = False
+        try:
+            yield endpoint
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.release(endpoint, failed)
+
+    def stats(self):
+        with self.condition:
+            return {name: endpoint.stats() for name, endpoint in self.endpoints.items()}
+
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+registries = {}
+registries_lock = threading.Lock()
+
+# registry of the config file, which is shared by all clients of the process so that the caps and connection pools are global
+def get_registry(path=None):
+    path = path or os.environ.get("BACKENDS_CONFIG")
+    if not path:
+        return None
+    with registries_lock:
+        if path not in registries:
+            registries[path] = BackendRegistry.from_file(path)
+        return registries[path]
+
+def get_route(model, path=None):
+    registry = get_registry(path)
+    if registry is None:
+        return None
+    return registry.routes.get(model)
@@ -0,0 +1,157 @@
+import codecs
+import csv
+import json
+import os
+
+# split a stream of byte chunks into lines, the incremental decoder handles multi-byte UTF-8 characters across chunks
+def iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+# stream the lines of a batch output, either from a local JSONL file or from an OpenAI file id
+def open_batch_output(source, client=None):
+    if os.path.exists(source):
+        with open(source, "rb") as f:
+            yield from iter_lines(iter(lambda: f.read(1 << 16), b""))
+    else:
+        with client.files.with_streaming_response.content(source) as response:
+            yield from iter_lines(response.iter_bytes())
+
+# return the custom id, the answers and the response body of a batch output line, or the error if the request failed
+def parse_batch_line(line):
+    item = json.loads(line)
+    custom_id = item.get("custom_id")
+
+    if item.get("error"):
+        return custom_id, None, json.dumps(item["error"]), None
+
+    response = item.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code", 200) != 200:
+        return custom_id, None, "status code {}".format(response.get("status_code")), body
+
+    choices = body.get("choices") or []
+    if not choices or choices[0].get("message") is None:
+        return custom_id, None, "no choices", body
+
+    choices = sorted(choices, key=lambda choice: choice.get("index", 0))
+    return custom_id, [choice["message"]["content"] for choice in choices], None, body
+
+# the size and modification time of the result file when the index was last updated
+STATE_PREFIX = "#state "
+
+# index of the custom ids which are already saved in a result file, it is stored next to the file
+class IdIndex:
+    def __init__(self, filepath, row_id):
+        self.filepath = filepath
+        self.path = filepath + ".ids"
+        self.ids = set()
+
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith(STATE_PREFIX):
+                        state = line[len(STATE_PREFIX):]
+                    elif line:
+                        self.ids.add(line)
+
+        # the index is rebuilt if it is missing or the result file was changed without it (e.g. by a compaction or by hand)
+        if state != self.file_state():
+            self.ids = set()
+            if os.path.exists(filepath):
+                with open(filepath, newline="", encoding="utf-8") as f:
+                    ids = set(row_id(row) for row in csv.DictReader(f))
+                self.add(ids, "w")
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __contains__(self, custom_id):
+        return custom_id in self.ids
+
+    def file_state(self):
+        if not os.path.exists(self.filepath):
+            return None
+        stat = os.stat(self.filepath)
+        return "{} {}".format(stat.st_size, stat.st_mtime_ns)
+
+    # add the ids of rows which were just written to the result file
+    def add(self, ids, mode="a"):
+        with open(self.path, mode, encoding="utf-8") as f:
+            for custom_id in ids:
+                f.write(custom_id + "\n")
+            f.write(STATE_PREFIX + self.file_state() + "\n")
+        self.ids.update(ids)
+
+def append_csv(filepath, rows):
+    exists = os.path.exists(filepath)
+    fieldnames = list(rows[0].keys())
+    if exists:
+        with open(filepath, newline="", encoding="utf-8") as f:
+            fieldnames = next(csv.reader(f))
+
+    with open(filepath, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore", lineterminator="\n")
+        if not exists:
+            writer.writeheader()
+        writer.writerows(rows)
+
+# append the rows of a batch output in chunks to the result file, custom ids which are already saved are skipped
+# the usage and finish reasons of every request are recorded if a Telemetry is given
+def ingest_batch(lines, create_rows, filepath, row_id, chunk_size=1000, write_rows=append_csv, telemetry=None):
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    index = IdIndex(filepath, row_id)
+    chunk, chunk_ids = [], set()
+    stats = {"rows": 0, "duplicates": 0, "errors": 0}
+    errors_path = filepath + ".errors.jsonl"
+
+    def flush():
+        if chunk:
+            write_rows(filepath, chunk)
+            index.add(chunk_ids)
+            stats["rows"] += len(chunk)
+            chunk.clear()
+            chunk_ids.clear()
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        custom_id, answers, error, body = parse_batch_line(line)
+        if telemetry is not None:
+            telemetry.record_response(body, error)
+        if error:
+            stats["errors"] += 1
+            with open(errors_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"custom_id": custom_id, "error": error}) + "\n")
+            continue
+
+        for row in create_rows(custom_id, answers):
+            if row_id(row) in index or row_id(row) in chunk_ids:
+                stats["duplicates"] += 1
+                continue
+            chunk.append(row)
+            chunk_ids.add(row_id(row))
+
+        if len(chunk) >= chunk_size:
+            flush()
+
+    flush()
+    print("Ingested {rows} rows ({duplicates} duplicates, {errors} errors) into".format(**stats), filepath)
+    if stats["errors"]:
+        print("Failed requests are listed in", errors_path)
+
+    return stats
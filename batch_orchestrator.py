@@ -0,0 +1,165 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_ingestion import open_batch_output
+from rate_limiter import is_retryable, get_retry_after, backoff_delay
+
+# limits of a single OpenAI batch, the byte limit leaves some margin to the 200 MB input file limit
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+FINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+# split the batch calls into shards which stay below the request and byte limits of a batch
+def shard_records(records, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    shards = []
+    shard, shard_bytes = [], 0
+    for record in records:
+        line = json.dumps(record) + "\n"
+        size = len(line.encode("utf-8"))
+        if shard and (len(shard) >= max_requests or shard_bytes + size > max_bytes):
+            shards.append(shard)
+            shard, shard_bytes = [], 0
+        shard.append(line)
+        shard_bytes += size
+    if shard:
+        shards.append(shard)
+
+    return shards
+
+def write_shards(filename, shards):
+    if len(shards) == 1:
+        filenames = [filename]
+    else:
+        stem = filename[:-len(".jsonl")] if filename.endswith(".jsonl") else filename
+        filenames = ["{}_shard{}.jsonl".format(stem, idx) for idx in range(len(shards))]
+
+    for shard_file, lines in zip(filenames, shards):
+        with open(shard_file, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    return filenames
+
+# local record of all submitted batches, so that their results can be ingested automatically
+class BatchManifest:
+    def __init__(self, path="./batches/manifest.json"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            self.save()
+
+    def update(self, entry, **values):
+        with self.lock:
+            entry.update(values)
+            self.save()
+
+    # batches which are running or whose output was not ingested yet, expired and cancelled batches have partial outputs
+    def pending(self, kinds=None):
+        return [entry for entry in self.entries if not entry.get("ingested") and (kinds is None or entry["kind"] in kinds)]
+
+def submit_shard(client, shard_file, description, completion_window="24h"):
+    with open(shard_file, "rb") as f:
+        batch_input = client.files.create(file=f, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window=completion_window,
+        metadata={
+            "description": description
+        }
+    )
+
+    return batch
+
+# shard, upload and create the batches concurrently and record them in the manifest
+def submit_batch(client, filename, records, description, kind, manifest, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES, workers=4, **info):
+    shards = shard_records(records, int(max_requests), int(max_bytes))
+    filenames = write_shards(filename, shards)
+
+    def submit(shard_file):
+        batch = submit_shard(client, shard_file, description)
+        entry = {
+            "batch_id": batch.id,
+            "input_file": shard_file,
+            "description": description,
+            "kind": kind,
+            "status": batch.status,
+            "submitted": time.time(),
+            "ingested": False,
+            **info
+        }
+        manifest.add(entry)
+        print("Submitted batch", batch.id, "for", shard_file)
+        return entry
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(submit, filenames))
+
+# retrieve the status of a batch, throttled requests and connection errors are retried as the API calls
+def retrieve_batch(client, batch_id, max_retries=6):
+    for attempt in range(max_retries + 1):
+        try:
+            return client.batches.retrieve(batch_id)
+        except Exception as exception:
+            if not is_retryable(exception) or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, get_retry_after(exception))
+            print("Retrying the status of batch {} in {:.1f}s ({})".format(batch_id, delay, type(exception).__name__))
+            time.sleep(delay)
+
+# poll the pending batches with an exponential backoff and ingest finished outputs with ingest(entry, lines)
+def wait_for_batches(client, manifest, ingest, kinds=None, interval=30, max_interval=600, timeout=None):
+    start = time.time()
+    delay = interval
+
+    while manifest.pending(kinds):
+        changed = False
+        for entry in manifest.pending(kinds):
+            batch = retrieve_batch(client, entry["batch_id"])
+            if batch.status != entry["status"]:
+                manifest.update(entry, status=batch.status)
+                changed = True
+                print("Batch", entry["batch_id"], batch.status)
+
+            if batch.status in FINAL_STATUSES:
+                # expired and cancelled batches keep the outputs of the requests which were completed before
+                if batch.status != "completed" and getattr(batch, "request_counts", None) is not None:
+                    print("Batch {} {} with {} of {} completed requests, the other requests have to be submitted again".format(entry["batch_id"], batch.status, batch.request_counts.completed, batch.request_counts.total))
+                if batch.output_file_id:
+                    ingest(entry, open_batch_output(batch.output_file_id, client))
+                if batch.error_file_id:
+                    manifest.update(entry, error_file_id=batch.error_file_id)
+                manifest.update(entry, ingested=True, output_file_id=batch.output_file_id)
+                changed = True
+
+        if not manifest.pending(kinds):
+            break
+        if timeout is not None and time.time() - start > timeout:
+            print("Stopped polling with {} pending batches".format(len(manifest.pending(kinds))))
+            break
+
+        # poll quickly again after changes, otherwise back off
+        delay = interval if changed else min(max_interval, delay * 2)
+        time.sleep(delay * random.uniform(0.8, 1.2))
+
+    return manifest.pending(kinds)
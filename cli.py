@@ -0,0 +1,56 @@
+import argparse
+import importlib
+import os
+import sys
+
+# subcommands and the packages and modules of the scripts they run, the scripts import their heavy dependencies
+# (pandas, openai, pint, spaCy) in the functions which use them, so that e.g. --help starts immediately
+COMMANDS = {
+    "generate": ("context_question_generation", "generate_context_questions", "Generate the context questions or the context answers"),
+    "run": ("fermi_problem_evaluation", "run_experiments", "Sample the target responses of the experiments"),
+    "ingest": ("fermi_problem_evaluation", "read_batch_results", "Ingest the outputs of the batches of run, or of generate with --context_questions"),
+    "process": ("fermi_problem_evaluation", "process_results", "Extract the numeric answers of all target responses"),
+    "stats": ("fermi_problem_evaluation", "streaming_statistics", "Calculate the group statistics of the evaluation"),
+}
+CONTEXT_INGESTION = ("context_question_generation", "read_batch_context_questions")
+
+parser = argparse.ArgumentParser(
+    prog="fermi",
+    description="Run the steps of the experiments, the arguments after the command are passed to its script (see <command> --help)",
+    epilog="Every command runs in the folder of its script, so relative paths are resolved as in the README",
+)
+subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+for command, (package, module, description) in COMMANDS.items():
+    subparsers.add_parser(command, help="{} ({}.py)".format(description, module), add_help=False)
+
+# package and module of a command, the batches of the context questions are ingested by the script of the generation folder
+def resolve(command, arguments):
+    package, module, _ = COMMANDS[command]
+    if command == "ingest" and "--context_questions" in arguments:
+        package, module = CONTEXT_INGESTION
+        arguments = [argument for argument in arguments if argument != "--context_questions"]
+    return package, module, arguments
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS:
+        # prints the help or the error of unknown commands
+        parser.parse_args(argv[:1])
+        return 2
+
+    package, module, arguments = resolve(argv[0], argv[1:])
+    # the package adds its folder to the path, so that the script is imported under the flat name its neighbours use
+    folder = importlib.import_module(package).FOLDER
+    script = importlib.import_module(module)
+    script.parser.prog = "fermi {}".format(argv[0])
+
+    # the scripts run in the folder of their package, as if they were started from there
+    os.chdir(folder)
+    try:
+        script.main(arguments)
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
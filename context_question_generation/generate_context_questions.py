@@ -4,14 +4,18 @@ import os
 parent_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_folder_path)
 from utils import *
+from batch_orchestrator import BatchManifest, submit_batch
+from batch_ingestion import open_batch_output
+from local_batch import run_local_batch
+from read_batch_context_questions import ingest_questions
+from telemetry import Telemetry
 
-from openai import OpenAI
 from dotenv import load_dotenv
 import argparse
+import asyncio
 import json
 import time
 import pickle
-import pandas as pd
 import csv
 
 parser = argparse.ArgumentParser(prog="Thesisdatasets", description="Run API calls to ChatGPT to generate context questions")
@@ -26,6 +30,18 @@ parser.add_argument("--save", default="generated_context_questions.csv", help="F
 
 parser.add_argument("--as_batch", default=False, action="store_true", help="Instead of using synchronous API calls, create a batch that can be uploaded to the OpenAI API")
 
+parser.add_argument("--manifest", default="./batches/manifest.json", help="Manifest file of the submitted batches, which is used to poll and ingest their results")
+
+parser.add_argument("--max_batch_requests", default=50000, help="Maximum number of requests per batch, larger batches are split into shards")
+
+parser.add_argument("--max_retries", default=6, help="Number of retries for throttled or failed API requests")
+
+parser.add_argument("--backends", default=None, help="Backend config (JSON) which routes models to self-hosted OpenAI compatible endpoints, defaults to the BACKENDS_CONFIG environment variable")
+
+parser.add_argument("--cache", default=None, help="Path of the SQLite cache for completions, which returns stored responses for identical requests")
+
+parser.add_argument("--cache_size", default=1024, help="Maximum size of the completion cache in MB")
+
 parser.add_argument("--turn", default=0, help="Provide turn of conversation to generate context questions")
 
 parser.add_argument(
@@ -41,6 +57,9 @@ def format_batch_id(row, args, target = False):
     return "/".join([str(row["id"]), args.model, args.bias, args.experiment_type])
 
 def get_context_questions(args):
+    # pandas is only imported on use, so that e.g. --help starts immediately
+    import pandas as pd
+
     # Load the data
     folder = "../fermi_problem_evaluation/experiment_data/"
     target_questions = pd.read_csv(folder + "target_questions.csv")
@@ -56,7 +75,7 @@ def get_context_questions(args):
     if len(prompts) > 2 and args.turn == 0:
         args.save = first_turn_file
     elif args.turn == 1:
-        first_turn = pd.read_csv(first_turn_file)
+        first_turn = RowLookup(pd.read_csv(first_turn_file), ["target_id", "source", "experiment_type"], "first turn response in " + first_turn_file)
 
     if len(prompts) == 0:
         raise Exception("Prompt variant does not exist!")
@@ -75,6 +94,15 @@ def get_context_questions(args):
     else:
         exp_types = [args.experiment_type]
 
+    # every API call is recorded in the metrics log
+    if not args.as_batch:
+        client.telemetry = Telemetry(
+            "./results/metrics/{}context_questions.jsonl".format("DEBUG" if args.debug else ""),
+            {"model": args.model, "context_bias": args.bias, "target_prompt": "context_question"},
+            len(target_questions) * len(exp_types),
+            max_tokens=SAMPLING_PARAMS["max_tokens"]
+        )
+
     # Generate the context questions
     for idx, row in target_questions.iterrows():
         for exp_type in exp_types:
@@ -84,8 +112,7 @@ def get_context_questions(args):
             messages = None
             args.experiment_type = exp_type
             if args.turn == 1:
-                context_condition = (first_turn["target_id"] == row["id"]) & (first_turn["source"] == args.model.split("/")[-1]) & (first_turn["experiment_type"] == args.experiment_type)
-                context_info = first_turn[context_condition].iloc[0]["response"]
+                context_info = first_turn[(row["id"], args.model.split("/")[-1], args.experiment_type)]["response"]
                 first_turn_prompt = prompts.iloc[0].str.replace("[experiment_type]", exp_type)
                 messages = client.construct_prompt(row["question"], first_turn_prompt)
                 messages = client.expand_history(messages, context_info)
@@ -111,6 +138,13 @@ def get_context_questions(args):
 
                 gen_questions.append(new_row)
 
+    if client.cache:
+        print("Completion cache", client.cache.stats())
+
+    if client.telemetry:
+        client.telemetry.report()
+        client.telemetry.close()
+
     # Append new context questions to the existing data
     context_questions = pd.concat([context_questions, pd.DataFrame(gen_questions)], ignore_index=True)
 
@@ -125,25 +159,28 @@ def get_context_questions(args):
     if args.as_batch:
         batch_folder = "./batches/{}/".format(args.model)
         os.makedirs(batch_folder, exist_ok=True)
-        filename = batch_folder + "{}_{}_{}_{}_batch.jsonl".format(args.model, args.bias, args.experiment_type if len(batch_calls) == 50 else "all", args.turn)
-        with open(filename, "w+") as f:
-            for item in batch_calls:
-                f.write(json.dumps(item) + "\n")
-
-        if not args.debug:
-            batch_input = client.files.create(
-                file=open(filename, "rb"),
-                purpose="batch"
-            )
-
-            batch_id = batch_input.id
-            client.batches.create(
-                input_file_id=batch_id,
-                endpoint="/v1/chat/completions",
-                completion_window="24h",
-                metadata={
-                "description": " ".join([args.model, "bias:", args.bias, "experiment_type:", args.experiment_type])
-                }
+        filename = batch_folder + "{}_{}_{}_{}_batch.jsonl".format(args.model.split("/")[-1], args.bias, args.experiment_type if len(batch_calls) == 50 else "all", args.turn)
+        save_file = args.save if args.save.startswith("./") else "./results/" + args.save
+        if args.debug or not client.has_batch_api:
+            with open(filename, "w+") as f:
+                for item in batch_calls:
+                    f.write(json.dumps(item) + "\n")
+
+        if not args.debug and not client.has_batch_api:
+            # the batch file is run locally with the same client and ingested like an OpenAI batch output
+            output_file, stats = asyncio.run(run_local_batch(filename, clients={args.model: client}))
+            ingest_questions(open_batch_output(output_file), save_file)
+        elif not args.debug:
+            # the batch calls are split into shards within the batch limits and recorded in the manifest for ingestion
+            submit_batch(
+                client.client,
+                filename,
+                batch_calls,
+                " ".join([args.model, "bias:", args.bias, "experiment_type:", args.experiment_type]),
+                "context_questions",
+                BatchManifest(args.manifest),
+                max_requests=args.max_batch_requests,
+                save_file=save_file
             )
 
     # Save the generated context questions
@@ -151,8 +188,11 @@ def get_context_questions(args):
         context_questions.to_csv("../fermi_problem_evaluation/experiment_data/{}{}".format(debug_str, filename), index=False)
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    args = parser.parse_args(argv)
     print("START")
-    args = parser.parse_args()
     args.turn = int(args.turn)
-    get_context_questions(args)
\ No newline at end of file
+    get_context_questions(args)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,8 +1,4 @@
-from openai import OpenAI
 from dotenv import load_dotenv
-import json
-
-import pandas as pd
 
 import sys
 import os
@@ -12,15 +8,24 @@ import argparse
 parent_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_folder_path)
 from utils import *
+from batch_ingestion import open_batch_output, ingest_batch
+from batch_orchestrator import BatchManifest, wait_for_batches
+from telemetry import Telemetry
 
 parser = argparse.ArgumentParser(prog="ReadBatch", description="Retrieve Results from batch calls")
 parser.add_argument("--batch_file", help="Filename of the OpenAI batch to load the results from")
+parser.add_argument("--output_file", default=None, help="Local JSONL file with the batch output, which is read instead of the OpenAI file")
 parser.add_argument("--save_file", help="Filename where the data should be saved")
+parser.add_argument("--chunk_size", default=1000, help="Number of rows which are appended to the result file at once")
+parser.add_argument("--poll", default=False, action="store_true", help="Wait for all pending context question batches of the manifest and ingest them as soon as they are completed")
+parser.add_argument("--manifest", default="./batches/manifest.json", help="Manifest file of the submitted batches")
+parser.add_argument("--interval", default=30, help="Initial polling interval in seconds, which increases while no batch changes")
+parser.add_argument("--timeout", default=None, help="Stop polling after the given number of seconds")
 
 def create_row(id, answer):
     data = id.split("/")
     new_row = {
-        "target_id": data[0],
+        "target_id": int(data[0]),
         "source": data[1],
         "bias": data[2],
         "experiment_type": data[3],
@@ -29,36 +34,38 @@ def create_row(id, answer):
     
     return new_row
 
-if __name__ == "__main__":
-    client = OpenAI()
-
-    args = parser.parse_args()
-
-    bin = client.files.content(args.batch_file)
-    results_str = bin.content.decode("ascii")
-
-    lines = results_str.strip().splitlines()
-    
-    results = [json.loads(el) for el in lines]
-
-    new_data = []
-
-    for item in results:
-        answer = item["response"]["body"]["choices"][0]["message"]["content"]
-        id = item["custom_id"]
-
-        new_data.append(create_row(id, answer))
-
-    result_folder = "./results/"
-    os.makedirs(result_folder, exist_ok=True)
-
-    filepath = result_folder + args.file + ".csv"
-    if os.path.exists(filepath):
-        existing_data = pd.read_csv(filepath)
-        new_data = pd.concat([existing_data, pd.DataFrame(new_data)], ignore_index=True)
+# the custom id of a saved row, equivalent to format_batch_id of generate_context_questions.py
+def row_id(row):
+    return "/".join(str(row[column]) for column in ["target_id", "source", "bias", "experiment_type"])
+
+def ingest_questions(lines, filepath, chunk_size=1000):
+    create_rows = lambda id, answers: [create_row(id, answers[0])]
+    telemetry = Telemetry("./results/metrics/batch_ingestion.jsonl", {"target_prompt": "context_question"}, interval=60, max_tokens=SAMPLING_PARAMS["max_tokens"])
+    stats = ingest_batch(lines, create_rows, filepath, row_id, int(chunk_size), telemetry=telemetry)
+    telemetry.report()
+    telemetry.close()
+
+    return stats
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    from openai import OpenAI
+
+    if args.poll:
+        load_dotenv()
+        client = OpenAI()
+        manifest = BatchManifest(args.manifest)
+        ingest = lambda entry, lines: ingest_questions(lines, entry["save_file"], args.chunk_size)
+        wait_for_batches(client, manifest, ingest, ["context_questions"], float(args.interval), timeout=float(args.timeout) if args.timeout else None)
     else:
-        new_data = pd.DataFrame(new_data)
+        if args.output_file:
+            lines = open_batch_output(args.output_file)
+        else:
+            load_dotenv()
+            client = OpenAI()
+            lines = open_batch_output(args.batch_file, client)
 
-    new_data.to_csv(filepath, index=False)
+        ingest_questions(lines, "./results/" + args.save_file + ".csv", args.chunk_size)
 
-    
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the modules of the folder import each other and the shared modules of the repository root by their flat names,
+# as when their scripts are started from the folder, so both folders are added to the path once the package is imported
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+for folder in [FOLDER, os.path.dirname(FOLDER)]:
+    if folder not in sys.path:
+        sys.path.append(folder)
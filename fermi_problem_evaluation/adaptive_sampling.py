@@ -0,0 +1,91 @@
+import csv
+import math
+import os
+from statistics import NormalDist
+
+DECISION_COLUMNS = ["target_id", "model", "context", "context_prompt", "context_bias", "target_prompt", "experiment_type", "samples", "max_samples", "stopped", "mode_oom", "mode_count", "valid_answers", "lower_bound"]
+
+# lower bound of the Wilson score interval of a share
+def wilson_lower_bound(successes, total, confidence):
+    if total == 0:
+        return 0.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    share = successes / total
+    center = share + z ** 2 / (2 * total)
+    margin = z * math.sqrt(share * (1 - share) / total + z ** 2 / (4 * total ** 2))
+    return (center - margin) / (1 + z ** 2 / total)
+
+# the responses of a condition are parsed as they arrive, sampling stops once the most frequent order of magnitude
+# holds the required share of all samples with the given confidence (responses without a valid answer count against it)
+class OomStopper:
+    def __init__(self, target_unit, target_units, min_samples=3, max_samples=10, share=0.5, confidence=0.95):
+        self.target_unit = target_unit
+        self.target_units = target_units
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.share = share
+        self.confidence = confidence
+        self.samples = 0
+        self.valid_answers = 0
+        self.oom_counts = {}
+
+    def add(self, response):
+        # the answer extraction (pandas, pint and spaCy) is only imported once answers are sampled
+        from answer_extraction import extract_answer
+        number, oom, comment = extract_answer(response, self.target_unit, self.target_units)
+        self.samples += 1
+        # the same answers as in filter_answers of result_statistics.py are valid
+        if oom is not None and (comment is None or comment == "unit_converted"):
+            self.valid_answers += 1
+            self.oom_counts[oom] = self.oom_counts.get(oom, 0) + 1
+
+    def mode(self):
+        if not self.oom_counts:
+            return None, 0
+        return max(self.oom_counts.items(), key=lambda item: item[1])
+
+    def lower_bound(self):
+        return wilson_lower_bound(self.mode()[1], self.samples, self.confidence)
+
+    def should_stop(self):
+        return self.samples >= self.min_samples and self.lower_bound() >= self.share
+
+    def decision(self):
+        mode_oom, mode_count = self.mode()
+        return {
+            "samples": self.samples,
+            "max_samples": self.max_samples,
+            "stopped": self.samples < self.max_samples,
+            "mode_oom": mode_oom,
+            "mode_count": mode_count,
+            "valid_answers": self.valid_answers,
+            "lower_bound": round(self.lower_bound(), 4),
+        }
+
+def new_stopper(args, unit_table, target_id):
+    target_unit, target_units = unit_table[target_id]
+    return OomStopper(target_unit, target_units, int(args.min_samples), int(args.samples), float(args.stop_share), float(args.stop_confidence))
+
+# stop decisions of all conditions, so that the analysis can account for the reduced number of samples
+class StopLog:
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        if os.path.exists(path):
+            with open(path, newline="", encoding="utf-8") as f:
+                self.keys = set(self.key(row) for row in csv.DictReader(f))
+
+    def key(self, row):
+        return tuple(str(row[column]) for column in DECISION_COLUMNS[:7])
+
+    def record(self, row):
+        if self.key(row) in self.keys:
+            return
+        exists = os.path.exists(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=DECISION_COLUMNS, extrasaction="ignore", lineterminator="\n")
+            if not exists:
+                writer.writeheader()
+            writer.writerow(row)
+        self.keys.add(self.key(row))
@@ -0,0 +1,173 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser(prog="AnalysisCube", description="Convert the group statistics into a dense array for the evaluation tables")
+parser.add_argument("--stats", default="saved_states/results_oom_df.pkl", help="Group statistics of compute_statistics (order of magnitude or number)")
+parser.add_argument("--save", default="saved_states/oom_cube", help="Path of the cube without extension (<path>.npy and <path>.json)")
+parser.add_argument("--contexts", nargs="+", default=None, help="Context sources to include, required if a condition was evaluated with several sources")
+
+CUBE_DIMENSIONS = ["model", "target_prompt", "context_bias", "experiment_type", "target_id"]
+CUBE_STATISTICS = ["min", "max", "mean", "50%", "std", "mode", "mode_count", "unique", "num_valid_answers", "50%_difference"]
+
+# classes of a question for a bias, comparing the decrease and the increase experiment
+EXPECTED = 1
+NEUTRAL = 0
+REVERSED = -1
+INVALID = -2
+
+# group statistics as a dense float array (model, target_prompt, context_bias, experiment_type, target_id, statistic),
+# missing groups are NaN and the labels of every dimension are kept in order of appearance
+class AnalysisCube:
+    def __init__(self, values, labels, statistics=CUBE_STATISTICS):
+        self.values = values
+        self.labels = labels
+        self.statistics = list(statistics)
+        self.positions = {dimension: {label: idx for idx, label in enumerate(labels[dimension])} for dimension in CUBE_DIMENSIONS}
+
+    @classmethod
+    def from_frame(cls, stats, contexts=None, statistics=CUBE_STATISTICS):
+        if contexts is not None:
+            stats = stats[stats["context"].isin(contexts)]
+        if stats.duplicated(CUBE_DIMENSIONS).any():
+            raise Exception("The statistics contain several context sources ({}) for a condition, select them with contexts".format(", ".join(map(str, stats["context"].unique()))))
+
+        codes, labels = [], {}
+        for dimension in CUBE_DIMENSIONS:
+            dimension_codes, uniques = pd.factorize(stats[dimension], sort=False)
+            codes.append(dimension_codes)
+            labels[dimension] = uniques.tolist()
+
+        values = np.full([len(labels[dimension]) for dimension in CUBE_DIMENSIONS] + [len(statistics)], np.nan)
+        values[tuple(codes)] = stats[list(statistics)].to_numpy(dtype=float)
+
+        return cls(values, labels, statistics)
+
+    # the array is saved as .npy, so that it can be opened as a memory map
+    def save(self, path):
+        np.save(path + ".npy", self.values)
+        with open(path + ".json", "w") as f:
+            json.dump({"labels": {dimension: [to_json(label) for label in self.labels[dimension]] for dimension in CUBE_DIMENSIONS}, "statistics": self.statistics}, f, indent=4)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        return cls(np.load(path + ".npy", mmap_mode=mmap_mode), meta["labels"], meta["statistics"])
+
+    def index(self, dimension, label):
+        if label not in self.positions[dimension]:
+            raise Exception("No {} {} in the analysis cube".format(dimension, label))
+        return self.positions[dimension][label]
+
+    # values of a statistic, dimensions given as labels are removed from the result
+    def stat(self, statistic, **selection):
+        key = [slice(None)] * len(CUBE_DIMENSIONS) + [self.statistics.index(statistic)]
+        for dimension, label in selection.items():
+            key[CUBE_DIMENSIONS.index(dimension)] = self.index(dimension, label)
+        return self.values[tuple(key)]
+
+    # reference answers aligned with the target_id axis
+    def target_answers(self, target_questions):
+        answers = target_questions.drop_duplicates("id").set_index("id")["answer"]
+        return answers.reindex(self.labels["target_id"]).to_numpy(dtype=float)
+
+    # 2d array of the cube as a table, e.g. target prompts by models
+    def table(self, values, index, columns):
+        return pd.DataFrame(values, index=pd.Index(self.labels[index], name=index), columns=pd.Index(self.labels[columns], name=columns))
+
+def to_json(label):
+    return label.item() if isinstance(label, np.generic) else label
+
+# mean without NaN values, empty groups are NaN (without the warning of np.nanmean)
+def nanmean(values, axis):
+    valid = ~np.isnan(values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(valid, values, 0).sum(axis=axis) / valid.sum(axis=axis)
+
+# accuracy as defined in the reference paper by Kalyan et al., for arrays of targets and answers (missing answers stay NaN)
+def acc_score(target, answer):
+    target, answer = np.asarray(target, dtype=float), np.asarray(answer, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance = np.abs(np.log10(target / answer))
+        score = np.where(distance > 3, 0.0, 1 - distance / 3)
+    return np.where(answer == 0, 0.0, score)
+
+# accuracy of every group, shape (model, target_prompt, context_bias, experiment_type, target_id)
+def accuracy(cube, target_questions, metric="50%"):
+    return acc_score(cube.target_answers(target_questions), cube.stat(metric))
+
+# mean accuracy of a bias by target prompt and model, as in the accuracy table of the evaluation notebook
+def accuracy_table(cube, target_questions, metric="50%", bias="none"):
+    scores = accuracy(cube, target_questions, metric)[:, :, cube.index("context_bias", bias)]
+    means = nanmean(scores, axis=(2, 3))
+    return cube.table(np.round(means, 3).T, "target_prompt", "model")
+
+# mean of a statistic of a bias over all questions and experiment types by target prompt and model (infinite values are ignored)
+def mean_table(cube, statistic, bias):
+    values = cube.stat(statistic, context_bias=bias)
+    means = nanmean(np.where(np.isinf(values), np.nan, values), axis=(2, 3))
+    return cube.table(means.T, "target_prompt", "model")
+
+# share of the groups of a bias whose statistic deviates from the baseline by more than the threshold
+def deviation_table(cube, bias, statistic="50%_difference", threshold=0.5):
+    values = cube.stat(statistic, context_bias=bias)
+    valid = ~np.isnan(values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        changed = (np.abs(values) > threshold) & valid
+        shares = changed.sum(axis=(2, 3)) / valid.sum(axis=(2, 3))
+    return cube.table(np.round(shares, 2).T, "target_prompt", "model")
+
+# class of every question, shape (model, target_prompt, context_bias, target_id): the decrease and increase experiments
+# are neutral if their statistics differ by at most the threshold, otherwise expected (decrease < increase) or reversed
+def classify(cube, statistic="50%_difference", threshold=0.5):
+    decrease = cube.stat(statistic, experiment_type="decrease")
+    increase = cube.stat(statistic, experiment_type="increase")
+    with np.errstate(invalid="ignore"):
+        classes = np.where(np.abs(decrease - increase) <= threshold, NEUTRAL, np.where(decrease < increase, EXPECTED, REVERSED))
+    return np.where(np.isnan(decrease) | np.isnan(increase), INVALID, classes).astype(np.int8)
+
+# neutral questions whose experiments both stay within the bound of the baseline
+def neutral_baseline(cube, statistic="50%_difference", threshold=0.5, bound=1):
+    decrease = cube.stat(statistic, experiment_type="decrease")
+    increase = cube.stat(statistic, experiment_type="increase")
+    with np.errstate(invalid="ignore"):
+        return (classify(cube, statistic, threshold) == NEUTRAL) & (np.abs(decrease) < bound) & (np.abs(increase) < bound)
+
+# shares of the classes by model, target prompt and bias, as collect_question_classifications of the evaluation notebook
+def classification_shares(cube, statistic="50%_difference", threshold=0.5, exclude=("none", "control")):
+    classes = classify(cube, statistic, threshold)
+    baseline = neutral_baseline(cube, statistic, threshold)
+    counts = {name: (classes == value).sum(axis=-1) for name, value in [("expected", EXPECTED), ("reversed", REVERSED), ("neutral", NEUTRAL)]}
+    total = (classes != INVALID).sum(axis=-1)
+    baseline_count = baseline.sum(axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = {
+            "neutral": counts["neutral"] / total,
+            "neutral_baseline": baseline_count / counts["neutral"],
+            "changed": (counts["expected"] + counts["reversed"]) / total,
+            "expected_share": counts["expected"] / (counts["expected"] + counts["reversed"]),
+        }
+
+    index = pd.MultiIndex.from_product([cube.labels[dimension] for dimension in ["model", "target_prompt", "context_bias"]], names=["model", "target_prompt", "context_bias"])
+    frame = pd.DataFrame({name: values.ravel() for name, values in shares.items()}, index=index).reset_index()
+    frame = frame[(total.ravel() > 0) & ~frame["context_bias"].isin(exclude)]
+    frame.insert(0, "id", frame["model"].astype(str) + "/" + frame["target_prompt"].astype(str))
+
+    return frame.reset_index(drop=True)
+
+# target ids of a class for one model, target prompt and bias
+def question_ids(cube, classes, model, target_prompt, bias, value):
+    mask = classes[cube.index("model", model), cube.index("target_prompt", target_prompt), cube.index("context_bias", bias)] == value
+    return [cube.labels["target_id"][idx] for idx in np.flatnonzero(mask)]
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start = time.time()
+    cube = AnalysisCube.from_frame(pd.read_pickle(args.stats), args.contexts)
+    cube.save(args.save)
+    print("Saved the cube {} with shape {} in {:.2f}s".format(args.save, cube.values.shape, time.time() - start))
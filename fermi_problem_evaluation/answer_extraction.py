@@ -0,0 +1,378 @@
+import math
+from functools import lru_cache
+
+import pandas as pd
+
+ANSWER_TAG = "Answer:"
+
+# multipliers for string numbers
+MULTIPLIERS = {
+    "thousand": 1e3,
+    "million": 1e6,
+    "billion": 1e9,
+    "trillion": 1e12,
+    "quadrillion": 1e15,
+    "sextillion": 1e21,
+    "quintillion": 1e30
+}
+
+# accepted variations of the target unit after manual review
+UNIT_VARIATIONS = {
+    "strokes": ["keystrokes", "keyboard strokes", "computer keyboard strokes"],
+    "trees": ["árvores"],
+    "kg/year": ["кг/год"],
+    "conversations": ["'conversations'"],
+    "mothers": ["[mothers]", "human mothers"],
+    "kg": ["kilograms"],
+    "fermi problems": ["[fermi problems]"],
+    "punctuation marks": ["punctuation.marker"],
+    "tenured professors": ["tenored professors", "tensted professors"],
+    "plastic straws": ["plastic strays", "plastic strails"],
+    "square meters": ["square such meters"],
+}
+
+UNIT_DEFINITIONS = [
+    "ton = 1e3 * kg = tonne",
+    "USD = [currency]",
+    "exabyte = 1e9 * GB = eb",
+    "yottabyte = 1e15 * GB = yb",
+    "zetabyte = 1e12 * GB = zb",
+    "terabyte = 1e3 * GB = tb",
+    "petabyte = 1e6 * GB = pb",
+    "gigabyte = 1 * GB = gb",
+    "megabyte = 1 * MB = mb",
+]
+
+# the heavy dependencies are only loaded once they are needed and then reused
+@lru_cache(maxsize=None)
+def get_unit_registry():
+    from pint import UnitRegistry
+    ureg = UnitRegistry()
+    for definition in UNIT_DEFINITIONS:
+        ureg.define(definition)
+    return ureg
+
+@lru_cache(maxsize=None)
+def get_nlp(model="en_core_web_lg"):
+    import spacy
+    return spacy.load(model)
+
+# memoized registry lookups and conversion factors, the same units are looked up for thousands of answers
+class UnitLookup:
+    def __init__(self, ureg, maxsize=4096):
+        self.ureg = ureg
+        self.exists = lru_cache(maxsize=maxsize)(self.unit_exists)
+        self.contains = lru_cache(maxsize=maxsize)(self.registry_contains)
+        self.factor = lru_cache(maxsize=maxsize)(self.conversion_factor)
+
+    def unit_exists(self, unit_name):
+        try:
+            self.ureg.parse_expression(unit_name)
+            return True
+        except:
+            return False
+
+    # None if the lookup itself fails
+    def registry_contains(self, name):
+        try:
+            return name in self.ureg
+        except:
+            return None
+
+    # None if the units are not convertible, offset units (e.g. temperatures) have no constant factor
+    def conversion_factor(self, unit, target_unit):
+        try:
+            offset = self.ureg.Quantity(0.0, unit).to(target_unit).magnitude
+            factor = self.ureg.Quantity(1.0, unit).to(target_unit).magnitude
+        except Exception:
+            return None
+        return factor if offset == 0 else "offset"
+
+    def convert(self, number, unit, target_unit):
+        factor = self.factor(unit, target_unit)
+        if factor is None:
+            raise ValueError("Unit {} is not convertible to {}".format(unit, target_unit))
+        if factor == "offset":
+            return self.ureg.Quantity(number, unit).to(target_unit).magnitude
+        return number * factor
+
+@lru_cache(maxsize=None)
+def get_unit_lookup():
+    return UnitLookup(get_unit_registry())
+
+def oom_extraction(number):
+    if number and not math.isinf(number):
+        return int("{:.2e}".format(number).split('e')[1])
+    else:
+        return None
+
+# build the target unit and its accepted variations (longest first) once per target question
+def build_unit_table(target_questions):
+    unit_table = {}
+    for _, question in target_questions.iterrows():
+        if question["id"] in unit_table:
+            continue
+        target_unit = question["unit"]
+        target_units = [target_unit] + UNIT_VARIATIONS.get(target_unit, [])
+        target_units.sort(key=lambda s: len(s), reverse=True)
+        unit_table[question["id"]] = (target_unit, target_units)
+
+    return unit_table
+
+# string preprocessing of the answer, returns either the final result or the string and unit flag for token parsing
+def preprocess_answer(answer_string, target_unit, target_units):
+    while "=" in answer_string:
+        answer_string = answer_string[answer_string.rfind("=") + 1:].strip()
+    while "≈" in answer_string:
+        answer_string = answer_string[answer_string.rfind("≈") + 1:].strip()
+
+    if "\n" in answer_string:
+        answer_string = answer_string.split("\n")[-1]
+
+    if "between" in answer_string:
+        return (None, "range", answer_string), answer_string, False
+    if "n/a" in answer_string:
+        return (None, "no_answer", answer_string), answer_string, False
+
+    found_unit = False
+
+    answer_string = answer_string.replace("!", "")
+    answer_string = answer_string.replace("~", "")
+    if answer_string.endswith("."): answer_string = answer_string[:-1]
+
+    # add custom postprocessing for USD
+    if "usd" in target_unit.lower() and any(el for el in ["usd", "$"] if el in answer_string):
+        if "$" in answer_string:
+            answer_string = answer_string.replace("$", "")
+        if "in usd" in answer_string:
+            answer_string = answer_string.partition("in usd")[0]
+        elif "usd" in answer_string:
+            answer_string = answer_string.rpartition("usd")
+
+            if sum(c.isdigit() for c in answer_string[0]) >= sum(c.isdigit() for c in answer_string[2]):
+                answer_string = answer_string[0]
+            else:
+                answer_string = answer_string[2]
+
+        if "/year" in answer_string and "/year" in target_unit:
+            answer_string = answer_string.rpartition("/year")[0]
+
+        found_unit = True
+
+    # check if any of the target units can be found in the answer string
+    for variation in target_units:
+        lowered = variation.lower()
+        if lowered in ["cm", "mb", "gb"] and lowered in answer_string:
+            answer_string = answer_string.rpartition(lowered)[0].strip()
+            found_unit = True
+            break
+        elif " " + lowered in answer_string:
+            answer_string = answer_string.rpartition(" " + lowered)[0].strip()
+            found_unit = True
+            break
+        elif " " + lowered[:-1] in answer_string and variation.endswith("s"):
+            answer_string = answer_string.rpartition(" " + lowered[:-1])[0].strip()
+            found_unit = True
+            break
+        elif "_" + lowered in answer_string:
+            answer_string = answer_string.rpartition("_" + lowered)[0].strip()
+            found_unit = True
+            break
+
+    if found_unit and answer_string.split(" ")[-1] == "in":
+        found_unit = False
+        answer_string = answer_string.replace("in", "").strip()
+
+    if answer_string.endswith("]"):
+        answer_string = answer_string[:-1]
+
+    # detect ranges
+    if all([substr in answer_string for substr in ["from", "to"]]) and any([substr in answer_string for substr in ["range", "anywhere"]]):
+        return (None, "range", answer_string), answer_string, found_unit
+
+    return None, answer_string, found_unit
+
+def is_number_token(token):
+    return (token.pos_ in ["NUM", "SYM"] or (any(c.isdigit() for c in token.text) and sum(1 for c in token.text if c.isalpha()) < 2) or token.text in MULTIPLIERS) and token.text != "one"
+
+def keep_number_token(token):
+    return token.pos_ != "X" or "e" in token.text or sum(1 for c in token.text if c.isdigit()) > 1
+
+# parse the number and unit from the spaCy tokens of the preprocessed answer
+def parse_tokens(doc, answer_string, found_unit, target_unit, units):
+    number = 1
+    unit = []
+    number_list = []
+
+    # if the unit was found, parse the answer in reverse order
+    if found_unit:
+        for token in reversed(doc):
+            if is_number_token(token):
+                if keep_number_token(token): number_list.append(token.text)
+            else:
+                if token.text in ["-", "to"]:
+                    if "add up to" not in answer_string:
+                        return None, "range", answer_string
+                elif token.text == "of":
+                    if "%" in answer_string:
+                        return None, "percentage", answer_string
+                    return None, "no_concrete_answer", answer_string
+                elif token.text not in ["x", "×"]:
+                    break
+
+        number_list.reverse()
+    elif len(doc) == 1:
+        try:
+            answer_number = answer_string.replace(",", "")
+            answer_number = float(answer_number)
+            return answer_number, None, answer_string
+        except:
+            number_list.append(answer_string)
+    # otherwise, parse unit in normal order
+    else:
+        for token in doc:
+            if is_number_token(token):
+                if keep_number_token(token): number_list.append(token.text)
+            else:
+                if number_list != []:
+                    if units.exists(token.text):
+                        unit.append(token.text)
+                    elif token.text not in ["x", "×"] and token.pos_ != "PUNCT":
+                        if token.text in ["or", "during", "approximately", "in"]: break
+                        unit.append(token.text)
+                    if token.pos_ in ["NOUN", "PROPN"]: break
+
+    read_number = False
+
+    # check if any number could be extracted
+    if number_list == []:
+        return None, "no_answer", answer_string
+    elif any(el for el in ["-", "to"] if el in unit) or any(el for el in ["-", "to"] if el in number_list):
+        return None, "range", answer_string
+    # if there are extracted numbers, postprocess them and calculate the final number
+    else:
+        number_list = " ".join(number_list).replace(" ^ ", "^")
+        number_list = number_list.strip().split(" ")
+
+        math_chars = ["x", "×", "*"]
+
+        for char in math_chars:
+            if char in number_list:
+                number_list.remove(char)
+            if len(number_list) == 1 and char in number_list[0]:
+                number_list = number_list[0].split(char)
+
+        for number_str in number_list:
+            try:
+                number_str = number_str.replace(",", "")
+
+                number_str = number_str.replace("10<sup>", "1e")
+                if "</sup>" in number_str: number_str = number_str.replace("</sup>", "")
+                if "~" in number_str: number_str = number_str.replace("~", "")
+                number_str = number_str.replace("10^", "1e")
+                number_str = number_str.replace("e^", "e")
+
+                number *= float(number_str)
+                read_number = True
+            except Exception:
+                # for non-interpretable scientific notation, such as "200 million e^6 people"
+                if number_str in MULTIPLIERS:
+                    number *= MULTIPLIERS[number_str]
+                    read_number = True
+                    break
+                else:
+                    contained = units.contains(number_str)
+                    if contained is None:
+                        return None, "no_concrete_numbers", answer_string
+                    elif contained:
+                        unit.append(number_str)
+                    else:
+                        return None, "no_concrete_answer", answer_string
+
+    if not read_number:
+        return number, "no_concrete_answer", answer_string
+
+    if unit != [] and not found_unit:
+        unit = " ".join(unit)
+        for period in ["year", "day"]:
+            if period in answer_string and period in target_unit:
+                target_unit = target_unit.partition("/" + period)[0].strip()
+        if "metric ton" in unit:
+            unit = unit.partition("metric")[-1]
+        if "%" in unit:
+            return None, "percentage", answer_string
+        try:
+            return units.convert(number, unit, target_unit), "unit_converted", answer_string
+        except Exception:
+            return number, "unit_not_convertible", answer_string
+
+    return number, None, answer_string
+
+# extract the answers of all responses of one target question, every distinct answer string is only parsed once
+# (spaCy and pint are only loaded if an answer string needs parsing, by default their cached instances are used)
+def extract_target_answers(answer_strings, target_unit, target_units, nlp=None, units=None, batch_size=256):
+    results = {}
+    pending = {}
+
+    for answer_string in set(answer_strings):
+        result, processed, found_unit = preprocess_answer(answer_string, target_unit, target_units)
+        if result is not None:
+            results[answer_string] = result
+        else:
+            pending.setdefault((processed, found_unit), []).append(answer_string)
+
+    texts = list(dict.fromkeys(processed for processed, _ in pending))
+    if not texts:
+        return results
+    nlp = nlp if nlp is not None else get_nlp()
+    units = units if units is not None else get_unit_lookup()
+    docs = dict(zip(texts, nlp.pipe(texts, batch_size=batch_size)))
+
+    for (processed, found_unit), originals in pending.items():
+        result = parse_tokens(docs[processed], processed, found_unit, target_unit, units)
+        for answer_string in originals:
+            results[answer_string] = result
+
+    return results
+
+# extraction of a single response (e.g. while sampling), returns number, order_of_magnitude and comment
+def extract_answer(response, target_unit, target_units, nlp=None, units=None):
+    response = str(response)
+    if ANSWER_TAG not in response:
+        return None, None, "no_answer"
+
+    answer_string = response.split(ANSWER_TAG)[-1].strip().lower()
+    number, comment, _ = extract_target_answers([answer_string], target_unit, target_units, nlp, units)[answer_string]
+
+    return number, oom_extraction(number), comment
+
+def results_to_frame(results, index):
+    return pd.DataFrame({
+        "number": [number for number, _, _ in results],
+        "order_of_magnitude": [oom_extraction(number) for number, _, _ in results],
+        "comment": [comment for _, comment, _ in results],
+        "answer_part": [answer_part for _, _, answer_part in results],
+    }, index=index)
+
+# vectorized replacement for the row-wise extract_number of the evaluation notebook, returns number,
+# order_of_magnitude, comment and answer_part aligned with the index of target_data
+def extract_answers(target_data, target_questions, responses=None, nlp=None, ureg=None, unit_table=None):
+    units = UnitLookup(ureg) if ureg is not None else None
+    unit_table = unit_table if unit_table is not None else build_unit_table(target_questions)
+    responses = responses if responses is not None else target_data["response"]
+
+    responses = responses.astype(str)
+    has_answer = responses.str.contains(ANSWER_TAG, regex=False)
+    answer_strings = responses.str.split(ANSWER_TAG).str[-1].str.strip().str.lower()
+
+    results = {}
+    answered = target_data.loc[has_answer, "target_id"]
+    for target_id, group in answered.groupby(answered):
+        target_unit, target_units = unit_table[target_id]
+        group_strings = answer_strings.loc[group.index]
+        target_results = extract_target_answers(group_strings, target_unit, target_units, nlp, units)
+        results.update(zip(group.index, (target_results[el] for el in group_strings)))
+
+    # responses without the answer tag are not parsed
+    no_answer = (None, "no_answer", None)
+    return results_to_frame([results.get(idx, no_answer) for idx in responses.index], responses.index)
@@ -0,0 +1,435 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # the peak memory is not measured on platforms without getrusage (Windows)
+    resource = None
+
+parser = argparse.ArgumentParser(prog="Benchmark", description="Time the evaluation, ingestion and request construction on synthetic result corpora and compare the timings with a baseline")
+parser.add_argument("--scales", nargs="+", default=["1", "10", "100"], help="Sizes of the synthetic corpora as multiples of the responses in ./results/")
+parser.add_argument("--cases", nargs="+", default=["pipeline", "ingestion", "requests"], help="Benchmarks to run: pipeline (load, extract, aggregate, accuracy), ingestion (batch output files) and requests (batch files of run_api_requests)")
+parser.add_argument("--repeats", default=3, help="Runs of every benchmark, each in a new process, the fastest run is reported")
+parser.add_argument("--data", default="./benchmark_data/", help="Folder of the generated corpora, which are reused by later runs with the same parameters")
+parser.add_argument("--base_responses", default=None, help="Number of responses of the 1x corpus, defaults to the number of responses in ./results/")
+parser.add_argument("--seed", default=0, help="Seed of the synthetic corpora")
+parser.add_argument("--save", default="./benchmarks/latest.json", help="JSON file to save the results, which can be used as a baseline")
+parser.add_argument("--compare", default=None, help="Baseline JSON file, the results are compared with it and slowdowns are flagged (exit code 1)")
+parser.add_argument("--current", default=None, help="Saved results which are compared with the baseline instead of running the benchmarks")
+parser.add_argument("--threshold", default=0.2, help="Relative slowdown (and memory increase) which is flagged in the comparison")
+parser.add_argument("--min_seconds", default=0.05, help="Slowdowns of less than this number of seconds are not flagged, as they are mostly noise")
+
+DEFAULT_BASE_RESPONSES = 56000
+# version of the corpus format, corpora of other versions are generated again
+CORPUS_VERSION = 1
+MIN_MEMORY_MB = 20
+
+MODELS = ["gpt-3.5-turbo", "gpt-4-turbo", "gpt-4o", "Llama-3-70b-chat-hf"]
+TARGET_PROMPTS = ["onlyanswer", "reasoning"]
+# the ingestion and request benchmarks use the conditions of one model and target prompt, as a single sweep of run_experiments.py
+SWEEP_MODEL = "gpt-3.5-turbo"
+SWEEP_TARGET_PROMPT = "onlyanswer"
+
+# answer formats of the synthetic responses and their shares, incl. the cases which the extraction handles separately
+ANSWER_FORMATS = {
+    "comma": 0.35,
+    "plain": 0.15,
+    "words": 0.2,
+    "scientific": 0.04,
+    "power": 0.03,
+    "converted": 0.1,
+    "range": 0.03,
+    "approximate": 0.05,
+    "no_answer_tag": 0.05,
+}
+NUMBER_WORDS = [("trillion", 1e12), ("billion", 1e9), ("million", 1e6), ("thousand", 1e3)]
+# other units of the target units, which pint converts back (factor from the target unit)
+CONVERSIONS = {
+    "kg": [("pounds", 2.20462), ("tons", 1e-3)],
+    "kg/year": [("pounds/year", 2.20462), ("tons/year", 1e-3)],
+    "liters": [("gallons", 0.264172), ("milliliters", 1e3)],
+    "hours": [("minutes", 60), ("days", 1 / 24)],
+    "days": [("hours", 24), ("weeks", 1 / 7)],
+    "GB": [("TB", 1e-3), ("MB", 1e3)],
+    "cm": [("meters", 1e-2), ("inches", 0.393701)],
+}
+REASONING = [
+    "Reasoning:\n1. Start from the total population that is relevant for the question.\n2. Estimate the share of this population which is affected.\n3. Multiply the share with the average quantity per person.\n\n",
+    "Reasoning:\n1. The global population is approximately 8 billion people.\n2. Assume that the quantity scales with the population and take an average rate per person.\n3. Round the result to an order of magnitude estimate.\n\n",
+    "Reasoning: The estimate combines the number of relevant units with a typical value per unit and a rough correction for the time period.\n\n",
+]
+# shifts of the orders of magnitude of the answers by experiment type, as the biased contexts move the answers
+EXPERIMENT_SHIFTS = {"neutral": 0.0, "decrease": -0.3, "increase": 0.3}
+
+def round_significant(value, digits):
+    if value == 0:
+        return 0.0
+    return round(value, digits - 1 - int(math.floor(math.log10(abs(value)))))
+
+def format_number(value):
+    return "{:,.0f}".format(value) if value >= 10 else "{:g}".format(value)
+
+def format_answer(value, unit, answer_format, rng):
+    if answer_format == "words" and value >= 1e3:
+        word, multiplier = next((word, multiplier) for word, multiplier in NUMBER_WORDS if value >= multiplier)
+        return "{:g} {} {}".format(round_significant(value / multiplier, 3), word, unit)
+    if answer_format == "scientific":
+        return "{:.2e} {}".format(value, unit) if rng.random() < 0.5 else "{:.1f} x 10^{} {}".format(value / 10 ** math.floor(math.log10(value)), int(math.floor(math.log10(value))), unit)
+    if answer_format == "power":
+        return "10^{} {}".format(int(round(math.log10(value))), unit)
+    if answer_format == "converted" and unit in CONVERSIONS:
+        other_unit, factor = CONVERSIONS[unit][rng.integers(len(CONVERSIONS[unit]))]
+        return "{} {}".format(format_number(round_significant(value * factor, 2)), other_unit)
+    if answer_format == "converted" and "usd" in unit.lower():
+        return "${}".format(format_number(value))
+    if answer_format == "range":
+        return "between {} and {} {}".format(format_number(round_significant(value / 2, 1)), format_number(round_significant(value * 2, 1)), unit)
+    if answer_format == "approximate":
+        return "approximately {} {}.".format(format_number(value), unit)
+    if answer_format == "plain":
+        return "{:.0f} {}".format(value, unit) if value >= 10 else "{:g} {}".format(value, unit)
+    return "{} {}".format(format_number(value), unit)
+
+# synthetic responses of one condition, the answers of a condition scatter around its own estimate in orders of magnitude
+# and are mostly round numbers, so that the samples repeat answers as the models do
+def synthetic_responses(question, target_prompt, experiment_type, samples, rng):
+    estimate = np.log10(question["answer"]) + EXPERIMENT_SHIFTS[experiment_type] + rng.normal(0, 0.5)
+    magnitudes = estimate + rng.normal(0, 0.25, samples)
+    digits = rng.choice([1, 2, 3], size=samples, p=[0.5, 0.35, 0.15])
+    formats = rng.choice(list(ANSWER_FORMATS), size=samples, p=list(ANSWER_FORMATS.values()))
+    prefixes = rng.choice(REASONING, size=samples) if target_prompt == "reasoning" else [""] * samples
+
+    responses = []
+    for magnitude, digit, answer_format, prefix in zip(magnitudes, digits, formats, prefixes):
+        value = round_significant(10 ** magnitude, int(digit))
+        if answer_format == "no_answer_tag":
+            responses.append(prefix + "I would estimate about {} {}.".format(format_number(value), question["unit"]))
+        else:
+            responses.append(prefix + "Answer: " + format_answer(value, question["unit"], answer_format, rng))
+    return responses
+
+# context sources, biases and experiment types of the experiments, the single turn baseline has no context
+def conditions(context_questions):
+    grid = [("single_turn", "none", ["neutral"])]
+    for (source, bias), types in context_questions.groupby(["source", "bias"], sort=False)["experiment_type"]:
+        grid.append((source, bias, list(types.unique())))
+    return sorted(grid, key=lambda condition: condition[1])
+
+# file of the target responses of a condition, as written by read_batch_results.py
+def result_file(context, bias):
+    return "{}_target_responses.csv".format(bias if context != "single_turn" else "neutral")
+
+def batch_id(target_id, sample, context, bias, target_prompt, experiment_type):
+    return "/".join([str(target_id), str(sample), context, "simple", bias, target_prompt, experiment_type])
+
+# output line of the OpenAI batch API for one response
+def batch_line(custom_id, model, response, idx):
+    completion_tokens = len(response) // 4
+    body = {
+        "id": "chatcmpl-{}".format(idx),
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": response}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 60, "completion_tokens": completion_tokens, "total_tokens": 60 + completion_tokens},
+    }
+    return json.dumps({"id": "batch_req_{}".format(idx), "custom_id": custom_id, "response": {"status_code": 200, "request_id": str(idx), "body": body}, "error": None})
+
+def count_responses(folder):
+    from process_results import list_result_files
+    return sum(len(pd.read_csv(path, usecols=["target_id"])) for path in list_result_files(folder))
+
+# result files, context answers and batch outputs of a corpus with the structure of ./results/ (every model, target prompt and condition)
+def generate_corpus(folder, responses, seed, experiment_data="./experiment_data/"):
+    target_questions = pd.read_csv(os.path.join(experiment_data, "target_questions.csv")).drop_duplicates("id")
+    context_questions = pd.read_csv(os.path.join(experiment_data, "generated_context_questions.csv"))
+    grid = conditions(context_questions)
+    groups = len(MODELS) * len(TARGET_PROMPTS) * len(target_questions) * sum(len(types) for context, bias, types in grid)
+    samples = max(1, int(round(responses / groups)))
+
+    shutil.rmtree(folder, ignore_errors=True)
+    shutil.copytree(experiment_data, os.path.join(folder, "experiment_data"))
+    rng = np.random.default_rng(seed)
+    batches, total, distinct = [], 0, set()
+
+    for model in MODELS:
+        # context answers of all context questions, which run_api_requests prepends to the target questions
+        context_answers = context_questions.rename(columns={"source": "context", "bias": "context_bias"}).assign(sample=0, model=model, context_prompt="simple", response="Answer: 42")
+        os.makedirs(os.path.join(folder, "results", model), exist_ok=True)
+        context_answers[["target_id", "sample", "model", "context", "context_prompt", "context_bias", "experiment_type", "response"]].to_csv(os.path.join(folder, "results", model, "simple_responses.csv"), index=False)
+
+        for target_prompt in TARGET_PROMPTS:
+            os.makedirs(os.path.join(folder, "results", model, target_prompt), exist_ok=True)
+            for context, bias, types in grid:
+                rows = []
+                for _, question in target_questions.iterrows():
+                    for experiment_type in types:
+                        for sample, response in enumerate(synthetic_responses(question, target_prompt, experiment_type, samples, rng)):
+                            rows.append((question["id"], sample, model, context, "simple", bias, target_prompt, experiment_type, response))
+                frame = pd.DataFrame(rows, columns=["target_id", "sample", "model", "context", "context_prompt", "context_bias", "target_prompt", "experiment_type", "response"])
+                frame.to_csv(os.path.join(folder, "results", model, target_prompt, result_file(context, bias)), index=False)
+                total += len(frame)
+                distinct.update(frame["response"].str.split("Answer:").str[-1].unique())
+
+                if model == SWEEP_MODEL and target_prompt == SWEEP_TARGET_PROMPT:
+                    batches.append(write_batch_output(folder, frame, context, bias, types))
+
+    corpus = {"version": CORPUS_VERSION, "requested": responses, "responses": total, "samples": samples, "seed": seed, "distinct_answers": len(distinct), "batches": batches}
+    with open(os.path.join(folder, "corpus.json"), "w") as f:
+        json.dump(corpus, f, indent=4)
+    return corpus
+
+def write_batch_output(folder, frame, context, bias, types):
+    path = os.path.join("batches", "{}_{}_{}_output.jsonl".format(SWEEP_TARGET_PROMPT, bias, context))
+    os.makedirs(os.path.join(folder, "batches"), exist_ok=True)
+    with open(os.path.join(folder, path), "w", encoding="utf-8") as f:
+        for idx, row in enumerate(frame.itertuples(index=False)):
+            custom_id = batch_id(row.target_id, row.sample, context, bias, row.target_prompt, row.experiment_type)
+            f.write(batch_line(custom_id, SWEEP_MODEL, row.response, idx) + "\n")
+    description = "/".join([SWEEP_MODEL, SWEEP_TARGET_PROMPT, bias if context != "single_turn" else "neutral", context])
+    return {"file": path, "description": description, "context": context, "bias": bias, "experiment_types": types, "lines": len(frame)}
+
+# corpus of a scale, generated again if it is missing or was generated with other parameters
+def ensure_corpus(data, scale, base_responses, seed):
+    folder = os.path.abspath(os.path.join(data, "{}x".format(scale)))
+    responses = int(base_responses * scale)
+    path = os.path.join(folder, "corpus.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            corpus = json.load(f)
+        if corpus.get("version") == CORPUS_VERSION and corpus["seed"] == seed and corpus["requested"] == responses:
+            return folder, corpus
+
+    start = time.time()
+    corpus = generate_corpus(folder, responses, seed)
+    print("Generated the {}x corpus with {} responses in {:.1f}s".format(scale, corpus["responses"], time.time() - start))
+    return folder, corpus
+
+# peak resident memory of the process in MB, on Linux the high-water mark of /proc is used, as ru_maxrss
+# also covers the memory of the parent process before a new process was started
+def peak_memory():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+# duration and peak memory of the stages of a benchmark, the rows of a stage can be set in the yielded dict
+class Stages:
+    def __init__(self):
+        self.results = {}
+
+    @contextmanager
+    def measure(self, name):
+        result = {"rows": None}
+        memory = peak_memory()
+        start = time.perf_counter()
+        yield result
+        result["seconds"] = time.perf_counter() - start
+        result["peak_mb"] = peak_memory()
+        result["peak_increase_mb"] = result["peak_mb"] - memory if memory is not None else None
+        self.results[name] = result
+
+# load -> extract -> aggregate -> accuracy, as in the evaluation notebook
+def pipeline_benchmark(stages, corpus):
+    with stages.measure("import"):
+        from process_results import read_result_csvs
+        from answer_extraction import extract_answers, build_unit_table, get_nlp, get_unit_lookup
+        from result_statistics import filter_answers, compute_statistics
+        from analysis_cube import AnalysisCube, accuracy_table
+
+    with stages.measure("models"):
+        get_nlp()
+        get_unit_lookup()
+
+    with stages.measure("load") as stage:
+        target_questions = pd.read_csv("./experiment_data/target_questions.csv")
+        target_data = read_result_csvs("./results/")
+        stage["rows"] = len(target_data)
+
+    with stages.measure("extract") as stage:
+        answers = extract_answers(target_data, target_questions, unit_table=build_unit_table(target_questions))
+        answer_df = pd.concat([target_data.drop(columns=["response"]), answers[["number", "order_of_magnitude", "comment"]]], axis=1)
+        stage["rows"] = len(answer_df)
+
+    with stages.measure("aggregate") as stage:
+        oom_df, num_df = compute_statistics(filter_answers(answer_df))
+        stage["rows"] = len(num_df)
+
+    with stages.measure("accuracy") as stage:
+        cube = AnalysisCube.from_frame(num_df)
+        accuracy_table(cube, target_questions, "50%", "none")
+        stage["rows"] = int(np.isfinite(cube.stat("50%")).sum())
+
+# batch outputs of one sweep ingested into empty result files
+def ingestion_benchmark(stages, corpus):
+    with stages.measure("import"):
+        # read_batch_results.py adds the parent folder with batch_ingestion.py to the path
+        from read_batch_results import ingest_results, open_batch_output
+
+    shutil.rmtree("./ingestion/", ignore_errors=True)
+    os.makedirs("./ingestion/")
+    os.chdir("./ingestion/")
+    with stages.measure("ingest") as stage:
+        stage["rows"] = sum(ingest_results(open_batch_output(os.path.join("..", batch["file"])), batch["description"])["rows"] for batch in corpus["batches"])
+    os.chdir("..")
+    shutil.rmtree("./ingestion/", ignore_errors=True)
+
+# batch files of all conditions of one sweep, the requests are built by run_api_requests without sending them (--debug)
+def requests_benchmark(stages, corpus):
+    with stages.measure("import"):
+        import run_experiments
+
+    shutil.rmtree("./batches/{}/".format(SWEEP_MODEL), ignore_errors=True)
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    with stages.measure("construct") as stage:
+        for batch in corpus["batches"]:
+            arguments = ["--model", SWEEP_MODEL, "--target_prompt", SWEEP_TARGET_PROMPT, "--samples", str(corpus["samples"]), "--as_batch", "--debug"]
+            if batch["context"] != "single_turn":
+                arguments += ["--context", batch["context"], "--bias", batch["bias"]]
+            if len(batch["experiment_types"]) == 1:
+                arguments += ["--experiment_type", batch["experiment_types"][0]]
+            run_experiments.run_api_requests(run_experiments.parser.parse_args(arguments))
+
+    batch_folder = "./batches/{}/".format(SWEEP_MODEL)
+    stage["rows"] = 0
+    for file in os.listdir(batch_folder):
+        with open(os.path.join(batch_folder, file), encoding="utf-8") as f:
+            stage["rows"] += sum(1 for line in f)
+    shutil.rmtree(batch_folder, ignore_errors=True)
+
+BENCHMARKS = {"pipeline": pipeline_benchmark, "ingestion": ingestion_benchmark, "requests": requests_benchmark}
+
+# a single run of a benchmark in the folder of the corpus, the output of the scripts is discarded
+def run_benchmark(case, folder, corpus):
+    os.chdir(folder)
+    stages = Stages()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        BENCHMARKS[case](stages, corpus)
+    rows = max((result["rows"] or 0) for result in stages.results.values()) or None
+    stages.results["total"] = {"rows": rows, "seconds": time.perf_counter() - start, "peak_mb": peak_memory(), "peak_increase_mb": None}
+    return stages.results
+
+# every run starts in a new process, so that the imports, model loading and peak memory are measured from scratch
+def isolated_run(case, folder, corpus):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, case, folder, corpus).result()
+
+# fastest of the repeated runs of every stage, the memory is the highest peak
+def summarize(runs):
+    summary = {}
+    for stage in runs[0]:
+        results = [run[stage] for run in runs]
+        seconds = min(result["seconds"] for result in results)
+        peaks = [result["peak_mb"] for result in results if result["peak_mb"] is not None]
+        increases = [result["peak_increase_mb"] for result in results if result["peak_increase_mb"] is not None]
+        summary[stage] = {
+            "seconds": round(seconds, 4),
+            "runs": [round(result["seconds"], 4) for result in results],
+            "rows": results[0]["rows"],
+            "rows_per_s": round(results[0]["rows"] / seconds, 1) if results[0]["rows"] and seconds > 0 else None,
+            "peak_mb": round(max(peaks), 1) if peaks else None,
+            "peak_increase_mb": round(max(increases), 1) if increases else None,
+        }
+    return summary
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(), "numpy": np.__version__, "pandas": pd.__version__}
+
+def run_benchmarks(scales, cases, repeats, data, base_responses, seed):
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(), "base_responses": base_responses, "seed": seed, "repeats": repeats, "corpora": {}, "measurements": {}}
+    for scale in scales:
+        label = "{}x".format(scale)
+        folder, corpus = ensure_corpus(data, scale, base_responses, seed)
+        report["corpora"][label] = {key: corpus[key] for key in ["responses", "samples", "distinct_answers"]}
+
+        for case in cases:
+            summary = summarize([isolated_run(case, folder, corpus) for _ in range(repeats)])
+            for stage, result in summary.items():
+                report["measurements"]["{}/{}/{}".format(label, case, stage)] = result
+                throughput = ", {} rows/s".format(result["rows_per_s"]) if result["rows_per_s"] else ""
+                print("{}/{}/{}: {:.3f}s{}, peak {} MB".format(label, case, stage, result["seconds"], throughput, result["peak_mb"]))
+
+    return report
+
+# measurements which are slower (or use more memory) than the baseline by more than the threshold
+def compare(current, baseline, threshold=0.2, min_seconds=0.05):
+    rows = []
+    for key, result in current["measurements"].items():
+        if key not in baseline["measurements"]:
+            continue
+        base = baseline["measurements"][key]
+        change = result["seconds"] / base["seconds"] - 1 if base["seconds"] > 0 else math.inf
+        slower = change > threshold and result["seconds"] - base["seconds"] > min_seconds
+        memory = None
+        if result.get("peak_mb") is not None and base.get("peak_mb"):
+            memory = result["peak_mb"] / base["peak_mb"] - 1
+        more_memory = memory is not None and memory > threshold and result["peak_mb"] - base["peak_mb"] > MIN_MEMORY_MB
+        rows.append({
+            "measurement": key,
+            "baseline_s": base["seconds"],
+            "current_s": result["seconds"],
+            "time_change": round(change, 3),
+            "memory_change": round(memory, 3) if memory is not None else None,
+            "flag": ", ".join(flag for flag, flagged in [("SLOWER", slower), ("MEMORY", more_memory)] if flagged),
+        })
+
+    return pd.DataFrame(rows, columns=["measurement", "baseline_s", "current_s", "time_change", "memory_change", "flag"])
+
+# differences of the corpora and the environment make the measurements incomparable, they are reported with the comparison
+def comparison_warnings(current, baseline):
+    warnings = []
+    for label, corpus in current["corpora"].items():
+        if label in baseline["corpora"] and baseline["corpora"][label]["responses"] != corpus["responses"]:
+            warnings.append("The {} corpora differ ({} and {} responses)".format(label, baseline["corpora"][label]["responses"], corpus["responses"]))
+    for key in ["python", "cpu_count", "processor"]:
+        if current["environment"].get(key) != baseline["environment"].get(key):
+            warnings.append("The {} differs ({} and {})".format(key, baseline["environment"].get(key), current["environment"].get(key)))
+    return warnings
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.current:
+        with open(args.current) as f:
+            report = json.load(f)
+    else:
+        base_responses = int(args.base_responses) if args.base_responses else (count_responses("./results/") if os.path.exists("./results/") else DEFAULT_BASE_RESPONSES)
+        report = run_benchmarks([float(scale) if "." in scale else int(scale) for scale in args.scales], args.cases, int(args.repeats), args.data, base_responses, int(args.seed))
+        if args.save:
+            if os.path.dirname(args.save):
+                os.makedirs(os.path.dirname(args.save), exist_ok=True)
+            with open(args.save, "w") as f:
+                json.dump(report, f, indent=4)
+            print("Saved the results to", args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        comparison = compare(report, baseline, float(args.threshold), float(args.min_seconds))
+        for warning in comparison_warnings(report, baseline):
+            print("Warning:", warning)
+        print(comparison.to_string(index=False))
+
+        flagged = comparison[comparison["flag"] != ""]
+        if not flagged.empty:
+            print("{} of {} measurements are slower or use more memory than the baseline".format(len(flagged), len(comparison)))
+            sys.exit(1)
+        print("No slowdowns against the baseline")
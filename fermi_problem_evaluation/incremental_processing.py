@@ -0,0 +1,148 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from answer_extraction import extract_answers
+from process_results import list_result_files, load_target_questions
+from result_statistics import GROUP_COLUMNS, FAMILY_COLUMNS, filter_answers, compute_statistics
+
+parser = argparse.ArgumentParser(prog="IncrementalProcessing", description="Update the processed answers and statistics for new or changed result files")
+parser.add_argument("--results", default="./results/", help="Folder with the target response files")
+parser.add_argument("--target_questions", default="./experiment_data/target_questions.csv", help="File with the target questions")
+parser.add_argument("--states", default="./saved_states/", help="Folder of the saved states")
+parser.add_argument("--full", default=False, action="store_true", help="Ignore the saved states and rebuild everything")
+
+ANSWER_COLUMNS = ["number", "order_of_magnitude", "comment"]
+
+def content_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+# size and modification time are checked first, the content hash is only calculated if they differ
+def fingerprint(path, previous=None):
+    stat = os.stat(path)
+    if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": content_hash(path)}
+
+def cache_path(states_folder, path):
+    name = os.path.relpath(path).replace(os.sep, "__")
+    return os.path.join(states_folder, "processed", name + ".pkl")
+
+def group_keys(frame):
+    return set(frame[GROUP_COLUMNS].itertuples(index=False, name=None))
+
+# extract the answers of a result file, rows which were already processed are taken from the previous state
+def process_file(path, previous, target_questions, unit_table):
+    target_data = pd.read_csv(path)
+    target_data["row_hash"] = pd.util.hash_pandas_object(target_data, index=False).values
+
+    if previous is None:
+        new_rows = pd.Series(True, index=target_data.index)
+        changed = group_keys(target_data)
+    else:
+        new_rows = ~target_data["row_hash"].isin(previous["row_hash"])
+        removed_rows = previous[~previous["row_hash"].isin(target_data["row_hash"])]
+        changed = group_keys(target_data[new_rows]) | group_keys(removed_rows)
+
+    answers = pd.DataFrame(index=target_data.index, columns=ANSWER_COLUMNS, dtype=object)
+    if new_rows.any():
+        answers.loc[new_rows, ANSWER_COLUMNS] = extract_answers(target_data[new_rows], target_questions, unit_table=unit_table)[ANSWER_COLUMNS]
+    if previous is not None and (~new_rows).any():
+        reused = previous.drop_duplicates("row_hash").set_index("row_hash")[ANSWER_COLUMNS]
+        answers.loc[~new_rows, ANSWER_COLUMNS] = reused.loc[target_data.loc[~new_rows, "row_hash"]].values
+
+    processed = pd.concat([target_data.drop(columns=["response"]), answers.infer_objects()], axis=1)
+    print("Processed {} new rows of {}".format(int(new_rows.sum()), path))
+
+    return processed, changed
+
+def update_processed_answers(results_folder, target_questions_path, states_folder, full=False):
+    manifest_path = os.path.join(states_folder, "fingerprints.json")
+    manifest = {}
+    if os.path.exists(manifest_path) and not full:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    target_questions, unit_table = load_target_questions(target_questions_path)
+    files = list_result_files(results_folder)
+    changed_groups = set()
+    frames = []
+    new_manifest = {}
+
+    for path in files:
+        previous_print = manifest.get(path)
+        current_print = fingerprint(path, previous_print)
+        new_manifest[path] = current_print
+        state_file = cache_path(states_folder, path)
+
+        if previous_print and previous_print["sha256"] == current_print["sha256"] and os.path.exists(state_file):
+            frames.append(pd.read_pickle(state_file))
+            continue
+
+        previous = pd.read_pickle(state_file) if previous_print and os.path.exists(state_file) else None
+        processed, changed = process_file(path, previous, target_questions, unit_table)
+        changed_groups |= changed
+
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        processed.to_pickle(state_file)
+        frames.append(processed)
+
+    # results of deleted files change their groups as well
+    for path in set(manifest) - set(new_manifest):
+        state_file = cache_path(states_folder, path)
+        if os.path.exists(state_file):
+            changed_groups |= group_keys(pd.read_pickle(state_file))
+            os.remove(state_file)
+
+    with open(manifest_path, "w") as f:
+        json.dump(new_manifest, f, indent=4)
+
+    answer_df = pd.concat(frames, ignore_index=True).drop(columns=["row_hash"]) if frames else pd.DataFrame()
+
+    return answer_df, changed_groups
+
+# recalculate the statistics of the families (question, model, target prompt) with changed groups, as their baseline may have changed
+def update_statistics(answer_df, changed_groups, states_folder, full=False):
+    oom_path = os.path.join(states_folder, "results_oom_df.pkl")
+    num_path = os.path.join(states_folder, "results_num_df.pkl")
+    filtered_answers = filter_answers(answer_df)
+
+    if full or not (os.path.exists(oom_path) and os.path.exists(num_path)):
+        return compute_statistics(filtered_answers)
+
+    families = {(key[0], key[1], key[4]) for key in changed_groups}
+    oom_df = pd.read_pickle(oom_path)
+    num_df = pd.read_pickle(num_path)
+    if not families:
+        return oom_df, num_df
+
+    new_oom, new_num = compute_statistics(filtered_answers, families)
+    keep_oom = ~pd.MultiIndex.from_frame(oom_df[FAMILY_COLUMNS]).isin(list(families))
+    keep_num = ~pd.MultiIndex.from_frame(num_df[FAMILY_COLUMNS]).isin(list(families))
+    print("Recalculated the statistics of {} groups".format(len(new_oom)))
+
+    oom_df = pd.concat([oom_df[keep_oom], new_oom], ignore_index=True)
+    num_df = pd.concat([num_df[keep_num], new_num], ignore_index=True)
+
+    return oom_df, num_df
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start = time.time()
+
+    answer_df, changed_groups = update_processed_answers(args.results, args.target_questions, args.states, args.full)
+    answer_df.to_pickle(os.path.join(args.states, "processed_answers.pkl"))
+
+    oom_df, num_df = update_statistics(answer_df, changed_groups, args.states, args.full)
+    oom_df.to_pickle(os.path.join(args.states, "results_oom_df.pkl"))
+    num_df.to_pickle(os.path.join(args.states, "results_num_df.pkl"))
+
+    print("Updated {} changed groups in {:.1f}s".format(len(changed_groups), time.time() - start))
@@ -0,0 +1,96 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# pandas and the answer extraction (pint and spaCy) are imported by the functions which use them, so that the CLI starts without them
+
+parser = argparse.ArgumentParser(prog="ProcessResults", description="Extract the numeric answers of all target responses in parallel")
+parser.add_argument("--results", default="./results/", help="Folder with the target response files")
+parser.add_argument("--target_questions", default="./experiment_data/target_questions.csv", help="File with the target questions")
+parser.add_argument("--workers", default=os.cpu_count(), help="Number of worker processes")
+parser.add_argument("--save", default="saved_states/processed_answers.pkl", help="File to save the processed answers")
+
+CATEGORY_COLUMNS = ["model", "context", "context_prompt", "context_bias", "target_prompt", "experiment_type"]
+
+# list the result files in the same order as the evaluation notebook
+def list_result_files(folder):
+    result_files = []
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            if file.endswith("target_responses.csv"):
+                result_files.append(os.path.join(root, file))
+    return result_files
+
+# read the result CSV files in the order of the evaluation notebook and concatenate them once
+def read_result_csvs(folder):
+    import pandas as pd
+
+    frames = [pd.read_csv(path) for path in list_result_files(folder)]
+    if not frames:
+        return pd.DataFrame()
+
+    # categories are only assigned after the concatenation, as frames with different categories fall back to objects
+    results = pd.concat(frames, ignore_index=True)
+    for column in CATEGORY_COLUMNS:
+        if column in results.columns:
+            results[column] = results[column].astype("category")
+
+    return results
+
+@lru_cache(maxsize=None)
+def load_target_questions(path):
+    import pandas as pd
+    from answer_extraction import build_unit_table
+
+    target_questions = pd.read_csv(path)
+    return target_questions, build_unit_table(target_questions)
+
+# every worker loads the unit registry and the spaCy model once and reuses them for all its files
+def init_worker(target_questions_path):
+    from answer_extraction import get_nlp, get_unit_lookup
+
+    get_unit_lookup()
+    get_nlp()
+    load_target_questions(target_questions_path)
+
+def process_file(path, target_questions_path):
+    import pandas as pd
+    from answer_extraction import extract_answers
+
+    target_questions, unit_table = load_target_questions(target_questions_path)
+    target_data = pd.read_csv(path)
+    answers = extract_answers(target_data, target_questions, unit_table=unit_table)
+
+    return pd.concat([target_data, answers], axis=1)
+
+def process_results(files, target_questions_path, workers=None):
+    import pandas as pd
+
+    if not files:
+        return pd.DataFrame()
+
+    # submit the largest files first for a balanced load, but collect the results in the original order
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(target_questions_path,)) as executor:
+        futures = {}
+        for path in sorted(files, key=os.path.getsize, reverse=True):
+            futures[path] = executor.submit(process_file, path, target_questions_path)
+        frames = [futures[path].result() for path in files]
+
+    return pd.concat(frames, ignore_index=True)
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    start = time.time()
+
+    files = list_result_files(args.results)
+    answer_df = process_results(files, args.target_questions, int(args.workers))
+    answer_df = answer_df.drop(columns=["response", "answer_part"])
+
+    os.makedirs(os.path.dirname(args.save), exist_ok=True)
+    answer_df.to_pickle(args.save)
+    print("Processed {} responses from {} files in {:.1f}s".format(len(answer_df), len(files), time.time() - start))
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,33 @@
-from openai import OpenAI
 from dotenv import load_dotenv
-import json
 import argparse
 
-import pandas as pd
-
 import sys
 import os
 
 parent_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_folder_path)
 from utils import *
+from batch_ingestion import open_batch_output, ingest_batch, append_csv
+from batch_orchestrator import BatchManifest, wait_for_batches
+from telemetry import Telemetry
 
 parser = argparse.ArgumentParser(prog="ReadBatch", description="Retrieve Results from batch calls")
 parser.add_argument("--batch_file", help="Filename of the OpenAI batch to load the results from")
-
-def create_row(id, answer):
+parser.add_argument("--output_file", default=None, help="Local JSONL file with the batch output, which is read instead of the OpenAI batch")
+parser.add_argument("--description", default=None, help="Batch description (model/target_prompt/bias/context) of a local output file")
+parser.add_argument("--chunk_size", default=1000, help="Number of rows which are appended to the result file at once")
+parser.add_argument("--poll", default=False, action="store_true", help="Wait for all pending batches of the manifest and ingest them as soon as they are completed")
+parser.add_argument("--manifest", default="./batches/manifest.json", help="Manifest file of the submitted batches")
+parser.add_argument("--interval", default=30, help="Initial polling interval in seconds, which increases while no batch changes")
+parser.add_argument("--timeout", default=None, help="Stop polling after the given number of seconds")
+parser.add_argument("--store", default=None, help="Parquet store (see result_store.py) to which the ingested target responses are also appended")
+
+# the choices of a call with n > 1 are the samples following the sample index of the custom id
+def create_row(id, answer, model, choice=0):
     data = id.split("/")
     new_row = {
-        "target_id": data[0],
-        "sample": data[1],
+        "target_id": int(data[0]),
+        "sample": int(data[1]) + choice,
         "model": model,
         "context": data[2],
         "context_prompt": data[3],
@@ -31,54 +39,92 @@ def create_row(id, answer):
 
     return new_row
 
-if __name__ == "__main__":
-    client = OpenAI()
-    args = parser.parse_args()
+# context answers generated in a batch have the same custom id, but are saved without the target prompt
+def create_context_row(id, answer, model):
+    new_row = create_row(id, answer, model)
+    del new_row["target_prompt"]
+    return new_row
 
-    batch = client.batches.retrieve(args.batch_file)
+def context_row_id(row):
+    return "/".join(str(row[column]) for column in ["target_id", "sample", "context", "context_prompt", "context_bias", "experiment_type"])
 
-    description = batch.metadata["description"]
-    metadata = description.split("/")
+# the custom id of a saved row, equivalent to format_batch_id of run_experiments.py
+def row_id(row):
+    return "/".join(str(row[column]) for column in ["target_id", "sample", "context", "context_prompt", "context_bias", "target_prompt", "experiment_type"])
 
-    print(metadata)
+# the usage and finish reasons of batch requests are appended to the metrics log of the model
+def batch_telemetry(model, labels):
+    return Telemetry("./results/{}/metrics/batch_ingestion.jsonl".format(model), {"model": model, **labels}, interval=60, max_tokens=SAMPLING_PARAMS["max_tokens"])
 
-    #model = "gpt-3.5-turbo"
-    #target_prompt = "assumptions"
-    #bias = "single_turn"
-    model = metadata[0]
-    target_prompt = metadata[1]
-    bias = metadata[2]
+# write_rows of ingest_batch which appends the rows to the result file and the Parquet store,
+# rows which were added to the result file without the store (e.g. by a compaction) are appended to the store first
+def store_writer(store, results_folder="./results/"):
+    # pyarrow is only required with a store
+    import pandas as pd
+    from result_store import append_file_rows, sync_store
 
-    bin = client.files.content(batch.output_file_id)
-    results_str = bin.content.decode("ascii")
+    def write_rows(filepath, rows):
+        sync_store(results_folder, store, [filepath])
+        append_csv(filepath, rows)
+        append_file_rows(results_folder, store, filepath, pd.DataFrame(rows))
 
-    lines = results_str.strip().splitlines()
-    
-    results = [json.loads(el) for el in lines]
+    return write_rows
 
-    new_data = []
+def ingest_results(lines, description, chunk_size=1000, store=None):
+    # model tags of Together models contain a slash themselves
+    metadata = description.split("/")
+    metadata = ["/".join(metadata[:-3])] + metadata[-3:]
+    print(metadata)
 
-    for item in results:
-        answer = item["response"]["body"]["choices"][0]["message"]["content"]
-        id = item["custom_id"]
+    model = metadata[0]
+    target_prompt = metadata[1]
+    bias = metadata[2]
 
-        new_data.append(create_row(id, answer))
-        #print(item["response"]["body"]["choices"][0]["message"]["content"])
+    create_rows = lambda id, answers: [create_row(id, answer, model, choice) for choice, answer in enumerate(answers)]
 
     result_folder = "./results/{}/{}/".format(model, target_prompt)
-    #result_folder = "./results/{}/".format(model)
-    os.makedirs(result_folder, exist_ok=True)
-    file = "{}_target_responses.csv".format(bias) 
-    #file = "simple_responses.csv"
-
-    filepath = result_folder + file
-    if os.path.exists(filepath):
-        existing_data = pd.read_csv(filepath)
-        new_data = pd.concat([existing_data, pd.DataFrame(new_data)], ignore_index=True)
-        new_data.sort_values(["context", "context_bias", "target_id", "experiment_type"], inplace=True)
+    file = "{}_target_responses.csv".format(bias)
+
+    context_bias = bias if metadata[3] != "single_turn" else "none"
+    telemetry = batch_telemetry(model, {"context_bias": context_bias, "target_prompt": target_prompt})
+    write_rows = store_writer(store) if store else append_csv
+    stats = ingest_batch(lines, create_rows, result_folder + file, row_id, int(chunk_size), write_rows, telemetry)
+    telemetry.report()
+    telemetry.close()
+
+    return stats
+
+def ingest_context_results(lines, model, save_file, chunk_size=1000):
+    create_rows = lambda id, answers: [create_context_row(id, answers[0], model)]
+    telemetry = batch_telemetry(model, {"target_prompt": "context"})
+    stats = ingest_batch(lines, create_rows, save_file, context_row_id, int(chunk_size), telemetry=telemetry)
+    telemetry.report()
+    telemetry.close()
+
+    return stats
+
+def ingest_entry(entry, lines, chunk_size=1000, store=None):
+    if entry["kind"] == "context_responses":
+        return ingest_context_results(lines, entry["model"], entry["save_file"], chunk_size)
+    return ingest_results(lines, entry["description"], chunk_size, store)
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    from openai import OpenAI
+
+    if args.poll:
+        load_dotenv()
+        client = OpenAI()
+        manifest = BatchManifest(args.manifest)
+        ingest = lambda entry, lines: ingest_entry(entry, lines, args.chunk_size, args.store)
+        wait_for_batches(client, manifest, ingest, ["target", "context_responses"], float(args.interval), timeout=float(args.timeout) if args.timeout else None)
+    elif args.output_file:
+        ingest_results(open_batch_output(args.output_file), args.description, args.chunk_size, args.store)
     else:
-        new_data = pd.DataFrame(new_data)
+        load_dotenv()
+        client = OpenAI()
+        batch = client.batches.retrieve(args.batch_file)
+        ingest_results(open_batch_output(batch.output_file_id, client), batch.metadata["description"], args.chunk_size, args.store)
 
-    new_data.to_csv(filepath, index=False)
-
-    
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import csv
+import json
+import os
+
+# columns which identify a sample, together with the result file it belongs to (source and bias identify generated context questions)
+KEY_COLUMNS = ["target_id", "sample", "context", "context_prompt", "context_bias", "target_prompt", "experiment_type", "source", "bias"]
+
+parser = argparse.ArgumentParser(prog="CompactResults", description="Compact the journals of experiment runs into the result CSV files")
+parser.add_argument("--model", default=None, help="Only compact the journals of this model (all models if not set)")
+parser.add_argument("--results", default="./results/", help="Folder of the result files")
+
+def row_key(file, row):
+    return (file,) + tuple(str(row.get(column, "")) for column in KEY_COLUMNS)
+
+# order of the synchronous runs (target question, experiment type, sample), concurrent runs complete the samples in any order
+def row_order(row):
+    return (int(row["target_id"]), str(row.get("experiment_type", "")), int(row.get("sample", 0)))
+
+# generated context questions are saved as question instead of response
+def row_response(row):
+    return row["response"] if "response" in row else row["question"]
+
+# numpy scalars from pandas rows are not JSON serializable
+def to_json(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class ResultJournal:
+    def __init__(self, path, results_folder="./results/", resume=False):
+        self.path = path
+        self.results_folder = results_folder
+        self.responses = {}
+        self.loaded_files = set()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if os.path.exists(path):
+            if resume:
+                for record in read_journal(path):
+                    self.responses[row_key(record["file"], record["row"])] = row_response(record["row"])
+                print("Resuming with {} recorded responses".format(len(self.responses)))
+            else:
+                # results of an interrupted run are kept, but not reused
+                print("Compacting the journal of a previous run")
+                compact_journal(path, results_folder)
+
+        self.handle = open(path, "a", encoding="utf-8")
+        # terminate an incomplete last line, so that new records are not appended to it
+        if self.handle.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.handle.write("\n")
+
+    # return the recorded response of a sample or None if it was not recorded yet
+    def recorded(self, file, row):
+        if file not in self.loaded_files:
+            self.load_result_file(file)
+        return self.responses.get(row_key(file, row))
+
+    # samples which are already saved in the result file are not requested again, as compaction would skip their rows
+    def load_result_file(self, file):
+        self.loaded_files.add(file)
+        filepath = os.path.join(self.results_folder, file)
+        if not os.path.exists(filepath):
+            return
+
+        saved = 0
+        with open(filepath, newline="", encoding="utf-8") as f:
+            for existing_row in csv.DictReader(f):
+                self.responses.setdefault(row_key(file, existing_row), row_response(existing_row))
+                saved += 1
+        if saved:
+            print("Skipping the samples of {} rows which are already saved in {}".format(saved, filepath))
+
+    def append(self, file, row):
+        self.handle.write(json.dumps({"file": file, "row": row}, default=to_json, ensure_ascii=False) + "\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.responses[row_key(file, row)] = row_response(row)
+
+    def close(self):
+        self.handle.close()
+
+
+def read_journal(path):
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be incomplete if the run was killed while writing
+                print("Skipping incomplete journal line")
+
+# open a result file for appending and collect the keys of the rows it already contains
+def open_result_file(filepath, file, row):
+    keys = set()
+    if os.path.exists(filepath):
+        with open(filepath, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames
+            for existing_row in reader:
+                keys.add(row_key(file, existing_row))
+        handle = open(filepath, "a", newline="", encoding="utf-8")
+        writer = csv.DictWriter(handle, fieldnames=fieldnames, extrasaction="ignore", lineterminator="\n")
+    else:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        handle = open(filepath, "w", newline="", encoding="utf-8")
+        writer = csv.DictWriter(handle, fieldnames=list(row.keys()), extrasaction="ignore", lineterminator="\n")
+        writer.writeheader()
+
+    return handle, writer, keys
+
+# write the rows of the journal into the result files, rows that are already saved are skipped so that compaction can be repeated
+def compact_journal(path, results_folder="./results/"):
+    result_files = {}
+    new_rows = {}
+    written = 0
+
+    try:
+        for record in read_journal(path):
+            file, row = record["file"], record["row"]
+            if file not in result_files:
+                result_files[file] = open_result_file(os.path.join(results_folder, file), file, row)
+                new_rows[file] = []
+
+            _, _, keys = result_files[file]
+            key = row_key(file, row)
+            if key not in keys:
+                new_rows[file].append(row)
+                keys.add(key)
+
+        # the new rows of a run are appended in a fixed order, independent of the order in which they were completed
+        for file, rows in new_rows.items():
+            _, writer, _ = result_files[file]
+            writer.writerows(sorted(rows, key=row_order))
+            written += len(rows)
+    finally:
+        for handle, _, _ in result_files.values():
+            handle.close()
+
+    os.remove(path)
+    print("Compacted {} rows from {}".format(written, path))
+
+    return written
+
+def compact_all(results_folder, model=None):
+    journal_folder = os.path.join(results_folder, model) if model else results_folder
+    for root, dirs, files in os.walk(journal_folder):
+        if os.path.basename(root) != "journals":
+            continue
+        for file in files:
+            if file.endswith(".jsonl"):
+                compact_journal(os.path.join(root, file), results_folder)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    compact_all(args.results, args.model)
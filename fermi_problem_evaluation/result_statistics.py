@@ -0,0 +1,118 @@
+# numpy and pandas are imported by the aggregations, so that the columns and filters are imported without them (e.g. by the CLI)
+
+GROUP_COLUMNS = ["target_id", "model", "context", "context_bias", "target_prompt", "experiment_type"]
+
+# every group is compared to the single turn baseline of the same question, model and target prompt
+FAMILY_COLUMNS = ["target_id", "model", "target_prompt"]
+
+def baseline_key(target_id, model, target_prompt):
+    return (target_id, model, "single_turn", "none", target_prompt, "neutral")
+
+# remove answers which could not be interpreted (converted answers are kept)
+def filter_answers(answer_df):
+    no_answer = answer_df["comment"].notnull() & (answer_df["comment"] != "unit_converted")
+    return answer_df[~no_answer]
+
+def mode_unique(val_group, description):
+    mode = val_group.mode()[0] if len(val_group.mode()) == 1 else None
+    description["mode"] = mode if mode else description["50%"]
+    description["mode_count"] = val_group.value_counts().loc[mode] if mode else None
+    description["unique"] = val_group.nunique()
+
+    return description
+
+def describe_convert(group, group_key, format, baseline_med = None):
+    group_filtered = group.dropna(subset=[format])
+    oom_data = group_filtered[format]
+    oom_description = oom_data.describe().loc[['min', 'max', 'mean', '50%', 'std']].to_dict()
+    oom_description = mode_unique(oom_data, oom_description)
+
+    for idx, column in enumerate(GROUP_COLUMNS):
+        oom_description[column] = group_key[idx]
+    oom_description["num_valid_answers"] = len(group)
+    oom_description["50%_difference"] = oom_description["50%"] - baseline_med if baseline_med != None else 0
+
+    return oom_description
+
+STAT_COLUMNS = ["min", "max", "mean", "50%", "std"]
+
+# mode and count of every group, groups with several modes (or a mode of 0, as in mode_unique) have no mode
+def aggregate_modes(data, format):
+    counts = data.groupby(GROUP_COLUMNS + [format], observed=True).size().rename("mode_count").reset_index()
+    max_count = counts.groupby(GROUP_COLUMNS, observed=True)["mode_count"].transform("max")
+    top = counts[counts["mode_count"] == max_count]
+    top = top[top.groupby(GROUP_COLUMNS, observed=True)["mode_count"].transform("size") == 1]
+    top = top[top[format] != 0]
+
+    return top.rename(columns={format: "mode"}).set_index(GROUP_COLUMNS)[["mode", "mode_count"]]
+
+# mean and std of every group as computed by describe, i.e. with the (pairwise) numpy sums over the values of a group,
+# the compensated group sums of pandas differ from them in the last digits, so the groups with the same number of values
+# are summed as the rows of one array
+def aggregate_moments(data, grouped, format):
+    import numpy as np
+    import pandas as pd
+
+    values = data[format].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    codes = grouped.ngroup().to_numpy()[valid]
+    values = values[valid][np.argsort(codes, kind="stable")]
+    counts = np.bincount(codes, minlength=grouped.ngroups)
+    starts = np.cumsum(counts) - counts
+
+    mean, std = np.full(grouped.ngroups, np.nan), np.full(grouped.ngroups, np.nan)
+    # extreme answers overflow the squared deviations to inf, as in describe
+    with np.errstate(over="ignore", invalid="ignore"):
+        for count in np.unique(counts[counts > 0]):
+            groups = np.flatnonzero(counts == count)
+            group_values = values[starts[groups, None] + np.arange(count)]
+            mean[groups] = group_values.sum(axis=1) / count
+            if count > 1:
+                std[groups] = np.sqrt(((mean[groups, None] - group_values) ** 2).sum(axis=1) / (count - 1))
+
+    return pd.DataFrame({"mean": mean, "std": std}, index=grouped.size().index)
+
+# statistics of one format for all groups in a single aggregation, equivalent to describe_convert for every group
+def aggregate_format(data, format):
+    # categorical columns (e.g. from the Parquet store) must not add empty groups
+    grouped = data.groupby(GROUP_COLUMNS, observed=True)
+    stats = grouped[format].agg(["min", "max", "median", "nunique"]).astype({"nunique": int})
+    stats = stats.join(aggregate_moments(data, grouped, format))
+    stats = stats.rename(columns={"median": "50%", "nunique": "unique"})
+    stats[STAT_COLUMNS] = stats[STAT_COLUMNS].astype(float)
+    stats["num_valid_answers"] = grouped.size()
+
+    stats = stats.join(aggregate_modes(data, format))
+    stats["mode"] = stats["mode"].astype(float).fillna(stats["50%"])
+
+    appearance = {column: data[column].unique() for column in ["model", "target_id", "target_prompt"]}
+    return finish_statistics(stats.reset_index(), appearance)
+
+# join the baseline differences and sort the groups, appearance holds the model, question and target prompt labels in order of appearance
+def finish_statistics(stats, appearance):
+    import pandas as pd
+
+    # the baseline median is joined to all groups of the same question, model and target prompt
+    is_baseline = (stats["context"] == "single_turn") & (stats["context_bias"] == "none") & (stats["experiment_type"] == "neutral")
+    baseline = stats.loc[is_baseline, FAMILY_COLUMNS + ["50%"]].rename(columns={"50%": "baseline_50%"})
+    stats = stats.merge(baseline, on=FAMILY_COLUMNS, how="left")
+    stats["50%_difference"] = (stats["50%"] - stats["baseline_50%"]).where(~is_baseline.values, 0)
+
+    # same order as the original loop: model, question and target prompt in order of appearance, baseline first
+    for column in ["model", "target_id", "target_prompt"]:
+        stats[column + "_rank"] = pd.Categorical(stats[column], categories=appearance[column]).codes
+    stats["baseline_rank"] = (~is_baseline.values).astype(int)
+    stats = stats.sort_values(["model_rank", "target_id_rank", "target_prompt_rank", "baseline_rank"] + GROUP_COLUMNS, kind="stable")
+
+    columns = STAT_COLUMNS + ["mode", "mode_count", "unique"] + GROUP_COLUMNS + ["num_valid_answers", "50%_difference"]
+    return stats[columns].reset_index(drop=True)
+
+# calculate the statistics of all groups, optionally restricted to the given (target_id, model, target_prompt) families
+def compute_statistics(filtered_answers, families=None):
+    import pandas as pd
+
+    data = filtered_answers
+    if families is not None:
+        data = data[pd.MultiIndex.from_frame(data[FAMILY_COLUMNS]).isin(list(families))]
+
+    return aggregate_format(data, "order_of_magnitude"), aggregate_format(data, "number")
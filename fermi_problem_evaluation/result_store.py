@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from process_results import CATEGORY_COLUMNS
+
+parser = argparse.ArgumentParser(prog="ResultStore", description="Migrate the result CSV files into a partitioned Parquet store")
+parser.add_argument("--results", default="./results/", help="Folder with the target response files")
+parser.add_argument("--store", default="./results_store/", help="Folder of the Parquet store")
+parser.add_argument("--sync", default=False, action="store_true", help="Append the new rows of the result files to an existing store instead of migrating")
+
+PARTITION_COLUMNS = ["model", "target_prompt", "context_bias"]
+
+# partition columns are only stored in the folder names and read back as dictionaries
+SCHEMA = pa.schema([
+    ("target_id", pa.int32()),
+    ("sample", pa.int32()),
+    ("model", pa.string()),
+    ("context", pa.dictionary(pa.int32(), pa.string())),
+    ("context_prompt", pa.dictionary(pa.int32(), pa.string())),
+    ("context_bias", pa.string()),
+    ("target_prompt", pa.string()),
+    ("experiment_type", pa.dictionary(pa.int32(), pa.string())),
+    ("response", pa.string()),
+])
+
+# the size and modification time of the migrated result files, files starting with "_" are not read as part of the dataset
+SOURCES_FILE = "_sources.json"
+
+PARTITIONING = ds.partitioning(pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS]), flavor="hive")
+
+def to_table(frame):
+    frame = frame[SCHEMA.names].copy()
+    frame["response"] = frame["response"].astype(object).where(frame["response"].notna(), None)
+    for column in CATEGORY_COLUMNS:
+        frame[column] = frame[column].astype(str)
+    return pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False)
+
+# append the rows to the store, every call writes new files into the partitions
+def write_results(frame, store):
+    table = to_table(frame)
+    ds.write_dataset(
+        table,
+        store,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template="part-{}-{{i}}.parquet".format(uuid.uuid4().hex),
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+    return table.num_rows
+
+def open_store(store):
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+    return ds.dataset(store, format="parquet", partitioning=partitioning)
+
+# filters map columns to a value or a list of values, filters on partition columns skip the other partitions
+def filter_expression(filters):
+    expression = None
+    for column, values in (filters or {}).items():
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        condition = pc.field(column).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+# load only the required partitions and columns, dictionary columns are loaded as categories
+def load_results(store, columns=None, filters=None):
+    table = open_store(store).to_table(columns=columns, filter=filter_expression(filters))
+    frame = table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+
+    for column in frame.columns:
+        if column in CATEGORY_COLUMNS and not isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype("category")
+
+    return frame
+
+def result_files(results_folder):
+    for root, dirs, files in os.walk(results_folder):
+        for file in files:
+            if file.endswith("target_responses.csv"):
+                yield os.path.join(root, file)
+
+def read_sources(store):
+    path = os.path.join(store, SOURCES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def write_sources(store, sources):
+    os.makedirs(store, exist_ok=True)
+    path = os.path.join(store, SOURCES_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(sources, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def store_sources(store):
+    if not os.path.exists(store):
+        raise Exception("The store {} does not exist, migrate the result files first".format(store))
+    sources = read_sources(store)
+    if sources is None:
+        raise Exception("The store {} has no record of its result files, remove it and migrate again".format(store))
+    return sources
+
+def source_state(filepath, rows):
+    return {"rows": rows, "size": os.path.getsize(filepath), "mtime": os.path.getmtime(filepath)}
+
+def migrate(results_folder, store):
+    if os.path.exists(store) and os.listdir(store):
+        raise Exception("The store {} already exists, remove it before migrating again".format(store))
+
+    rows = 0
+    sources = {}
+    for filepath in result_files(results_folder):
+        frame = pd.read_csv(filepath)
+        rows += write_results(frame, store)
+        sources[os.path.relpath(filepath, results_folder)] = source_state(filepath, len(frame))
+    write_sources(store, sources)
+
+    return rows
+
+# append the rows which were added to the result files since the migration (e.g. by new runs or ingested batches),
+# the result files are only appended to, files which were rewritten or removed require a new migration
+def sync_store(results_folder, store, filepaths=None):
+    sources = store_sources(store)
+
+    if filepaths is None:
+        filepaths = list(result_files(results_folder))
+        removed = set(sources) - set(os.path.relpath(filepath, results_folder) for filepath in filepaths)
+        if removed:
+            raise Exception("The result files {} were removed, remove the store {} and migrate again".format(sorted(removed), store))
+
+    rows = 0
+    for filepath in filepaths:
+        name = os.path.relpath(filepath, results_folder)
+        state = sources.get(name, {"rows": 0, "size": 0, "mtime": None})
+        if not os.path.exists(filepath) or (os.path.getsize(filepath), os.path.getmtime(filepath)) == (state["size"], state["mtime"]):
+            continue
+        if os.path.getsize(filepath) < state["size"]:
+            raise Exception("The result file {} was rewritten, remove the store {} and migrate again".format(filepath, store))
+
+        frame = pd.read_csv(filepath)
+        if len(frame) > state["rows"]:
+            rows += write_results(frame.iloc[state["rows"]:], store)
+        sources[name] = source_state(filepath, len(frame))
+
+    write_sources(store, sources)
+
+    return rows
+
+# append rows which were just appended to a result file to the store, the store has to be in sync with the file before
+def append_file_rows(results_folder, store, filepath, frame):
+    sources = store_sources(store)
+    name = os.path.relpath(filepath, results_folder)
+    rows = sources.get(name, {"rows": 0})["rows"] + write_results(frame, store)
+    sources[name] = source_state(filepath, rows)
+    write_sources(store, sources)
+
+    return rows
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start = time.time()
+    if args.sync:
+        rows = sync_store(args.results, args.store)
+        print("Synchronized {} rows to {} in {:.1f}s".format(rows, args.store, time.time() - start))
+    else:
+        rows = migrate(args.results, args.store)
+        print("Migrated {} rows to {} in {:.1f}s".format(rows, args.store, time.time() - start))
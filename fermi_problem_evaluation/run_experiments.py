@@ -4,16 +4,22 @@ import os
 parent_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_folder_path)
 from utils import *
+from result_journal import ResultJournal, compact_journal
+from batch_orchestrator import BatchManifest, submit_batch
+from batch_ingestion import open_batch_output
+from local_batch import run_local_batch
+from read_batch_results import ingest_entry
+from telemetry import Telemetry
+from adaptive_sampling import StopLog, new_stopper
 
-from openai import OpenAI
 from dotenv import load_dotenv
 import argparse
+import asyncio
+import copy
 import json
 import time
 import pickle
 import os
-import pandas as pd
-import numpy as np
 
 parser = argparse.ArgumentParser(
     prog="ThesisExperiments",
@@ -42,11 +48,39 @@ parser.add_argument("--bias", default="general", help="Select the bias that the
 
 parser.add_argument("--samples", default=10, help="Number of API calls per question")
 
-parser.add_argument("--save_target", default="target_responses.csv", help="Filename to save the target responses (if existing, appends new data)")
+parser.add_argument("--save_target", default="target_responses.csv", help="Filename to save the target responses (if existing, samples which are already saved are skipped and new data is appended)")
 
-parser.add_argument("--save_context", default="responses.csv", help="Filename to save the context responses (if existing, appends new data)")
+parser.add_argument("--save_context", default="responses.csv", help="Filename to save the context responses (if existing, samples which are already saved are skipped and new data is appended)")
 
-parser.add_argument("--as_batch", default=False, action="store_true", help="Instead of using synchronous API calls, create a batch that can be uploaded to the OpenAI API")
+parser.add_argument("--as_batch", default=False, action="store_true", help="Instead of using synchronous API calls, create a batch that can be uploaded to the OpenAI API (for other providers, the batch is run locally)")
+
+parser.add_argument("--manifest", default="./batches/manifest.json", help="Manifest file of the submitted batches, which is used to poll and ingest their results")
+
+parser.add_argument("--max_batch_requests", default=50000, help="Maximum number of requests per batch, larger batches are split into shards")
+
+parser.add_argument("--choices_per_call", default=1, help="Number of samples which are requested in a single API call (or batch request) with the n parameter")
+
+parser.add_argument("--adaptive", default=False, action="store_true", help="Stop sampling a condition once the order of magnitude of its answers is stable, --samples is the maximum number of samples")
+
+parser.add_argument("--min_samples", default=3, help="Minimum number of samples per condition for adaptive sampling")
+
+parser.add_argument("--stop_share", default=0.5, help="Share of samples which the most frequent order of magnitude must hold for adaptive sampling to stop")
+
+parser.add_argument("--stop_confidence", default=0.95, help="Confidence of the lower bound of the share for adaptive sampling")
+
+parser.add_argument("--as_async", default=False, action="store_true", help="Run the synchronous API calls concurrently with an asynchronous client")
+
+parser.add_argument("--concurrency", default=8, help="Maximum number of in-flight API requests for asynchronous calls")
+
+parser.add_argument("--max_retries", default=6, help="Number of retries for throttled or failed API requests")
+
+parser.add_argument("--backends", default=None, help="Backend config (JSON) which routes models to self-hosted OpenAI compatible endpoints, defaults to the BACKENDS_CONFIG environment variable")
+
+parser.add_argument("--cache", default=None, help="Path of the SQLite cache for completions (e.g. ./cache/completions.sqlite), which returns stored responses for identical requests")
+
+parser.add_argument("--cache_size", default=1024, help="Maximum size of the completion cache in MB, least recently used completions are evicted")
+
+parser.add_argument("--resume", default=False, action="store_true", help="Resume an interrupted run from its journal and skip all samples that were already recorded")
 
 parser.add_argument("--context_unavailable", default=False, action="store_true", help="If context is available, it is loaded from the file instead of being generated again")
 
@@ -58,6 +92,8 @@ parser.add_argument(
     help="Toggle if experiments should be run with mock LLM responses",
 )
 
+parser.add_argument("--debug_latency", default=0, help="Simulated latency in seconds of the mock LLM responses")
+
 def format_response(row, idx, args, content, target = False):
     new_row = {
         "target_id": row["id"],
@@ -76,12 +112,84 @@ def format_response(row, idx, args, content, target = False):
 def format_batch_id(row, idx, args, target = False):
     return "/".join([str(row["id"]), str(idx), args.context if args.context else "single_turn", args.context_prompt, args.bias if args.context else "none", args.target_prompt, args.experiment_type if args.context else "neutral"])
 
+# sample indices which are requested together, a call with n choices returns the samples in this order
+def sample_chunks(args):
+    samples = list(range(int(args.samples)))
+    size = max(1, int(args.choices_per_call))
+    return [samples[start:start + size] for start in range(0, len(samples), size)]
+
+# responses of all samples of a chunk, samples which are not recorded in the journal yet are requested
+def sample_chunk(client, args, row, messages, samples, journal, target_file):
+    responses = [journal.recorded(target_file, format_response(row, sample, args, None, True)) for sample in samples]
+    missing = [sample for sample, response in zip(samples, responses) if response is None]
+    if missing:
+        new_responses = dict(zip(missing, client.sample_responses(messages, missing)))
+        for sample in missing:
+            journal.append(target_file, format_response(row, sample, args, new_responses[sample], True))
+        responses = [new_responses.get(sample, response) for sample, response in zip(samples, responses)]
+
+    return responses
+
+async def async_sample_chunk(client, args, row, messages, samples, journal, target_file, semaphore):
+    responses = [journal.recorded(target_file, format_response(row, sample, args, None, True)) for sample in samples]
+    missing = [sample for sample, response in zip(samples, responses) if response is None]
+    if missing:
+        new_responses = dict(zip(missing, await client.async_sample_responses(messages, missing, semaphore)))
+        for sample in missing:
+            journal.append(target_file, format_response(row, sample, args, new_responses[sample], True))
+        responses = [new_responses.get(sample, response) for sample, response in zip(samples, responses)]
+
+    return responses
+
+def stop_decision(row, args, stopper):
+    decision = format_response(row, 0, args, None, True)
+    del decision["sample"], decision["response"]
+    return {**decision, **stopper.decision()}
+
+async def sample_condition(client, args, row, messages, target_prompt, journal, files, semaphore, stop_log=None, unit_table=None):
+    target_file, context_file = files
+
+    # generate the context answer first, as the target question depends on it
+    if args.context and args.context_unavailable:
+        response = journal.recorded(context_file, format_response(row, 0, args, None))
+        if response is None:
+            async with semaphore:
+                completion = await client.async_api_call(messages)
+            response = client.get_completion_message(completion)
+            journal.append(context_file, format_response(row, 0, args, response))
+        messages = client.expand_history(messages, response)
+
+    messages = client.construct_prompt(row["question"], target_prompt, messages)
+
+    if stop_log is None:
+        await asyncio.gather(*[async_sample_chunk(client, args, row, messages, samples, journal, target_file, semaphore) for samples in sample_chunks(args)])
+        return
+
+    # adaptive sampling requests the chunks of a condition one after another until the answers are stable
+    stopper = new_stopper(args, unit_table, row["id"])
+    for samples in sample_chunks(args):
+        if stopper.should_stop():
+            break
+        for response in await async_sample_chunk(client, args, row, messages, samples, journal, target_file, semaphore):
+            stopper.add(response)
+    stop_log.record(stop_decision(row, args, stopper))
+
+async def run_async_requests(client, conditions, journal, files, concurrency, stop_log=None, unit_table=None):
+    # the semaphore bounds the number of in-flight requests across all conditions
+    semaphore = asyncio.Semaphore(concurrency)
+    await asyncio.gather(*[sample_condition(client, *condition, journal, files, semaphore, stop_log, unit_table) for condition in conditions])
+
 def run_api_requests(args):
+    # pandas and the answer extraction are only imported on use, so that e.g. --help starts immediately
+    import pandas as pd
+    import numpy as np
+    from answer_extraction import build_unit_table
+
     folder = "./experiment_data/"
     target_questions = pd.read_csv(folder + "target_questions.csv")
     prompts = pd.read_csv(folder + "prompts.csv")
     prompts = prompts.replace(np.nan, None)
-    context_questions = pd.read_csv(folder + "generated_context_questions.csv")
+    context_questions = RowLookup(pd.read_csv(folder + "generated_context_questions.csv"), ["target_id", "source", "bias", "experiment_type"], "context question")
 
     original_target_prompt = prompts[(prompts["turn"] == "target") & (prompts["prompt"] == args.target_prompt)].iloc[0]
     context_prompt = prompts[(prompts["turn"] == "context") & (prompts["prompt"] == args.context_prompt)].iloc[0]
@@ -90,15 +198,31 @@ def run_api_requests(args):
 
     client, args = APIClient(args).return_client_args()
 
-    context_responses = []
-    target_responses = []
+    if args.debug:
+        debug_str = "DEBUG"
+    else:
+        debug_str = ""
+
+    # every completed sample is appended to the journal and compacted into the result files at the end
+    if not args.as_batch:
+        files = (
+            "{}/{}/{}{}_{}".format(args.model, args.target_prompt, debug_str, args.bias, args.save_target),
+            "{}/{}{}_{}".format(args.model, debug_str, args.context_prompt, args.save_context)
+        )
+        journal_name = "{}{}_{}_{}_{}_{}.jsonl".format(debug_str, args.target_prompt, args.context_prompt, args.bias, args.context if args.context else "single_turn", args.experiment_type if args.experiment_type else "all")
+        journal_path = "./results/{}/journals/{}".format(args.model, journal_name)
+        journal = ResultJournal(journal_path, "./results/", args.resume)
+        target_file, context_file = files
 
     if args.as_batch:
         batch_calls = []
 
+    # conditions which are sampled concurrently after the loop
+    conditions = []
+
     if not args.context_unavailable and args.context:
         filepath = "./results/{}/{}_{}".format(args.model, args.context_prompt, args.save_context)
-        context_answers = pd.read_csv(filepath)
+        context_answers = RowLookup(pd.read_csv(filepath), ["target_id", "context_bias", "context", "context_prompt", "experiment_type"], "context answer in " + filepath)
 
     exp_types = []
     if not args.experiment_type and args.context:
@@ -110,6 +234,22 @@ def run_api_requests(args):
     else:
         exp_types = [args.experiment_type]
 
+    # every API call is recorded in the metrics log, the expected number of calls is used for the ETA
+    if not args.as_batch:
+        calls = len(target_questions) * len(exp_types) * (len(sample_chunks(args)) + (1 if args.context and args.context_unavailable else 0))
+        client.telemetry = Telemetry(
+            "./results/{}/metrics/{}".format(args.model, journal_name),
+            {"model": args.model, "context_bias": args.bias if args.context else "none", "target_prompt": args.target_prompt},
+            calls,
+            max_tokens=SAMPLING_PARAMS["max_tokens"]
+        )
+
+    # the stop decisions of adaptive sampling are saved next to the target responses
+    stop_log, unit_table = None, None
+    if args.adaptive and not args.as_batch:
+        stop_log = StopLog("./results/{}/{}/{}{}_stop_decisions.csv".format(args.model, args.target_prompt, debug_str, args.bias))
+        unit_table = build_unit_table(target_questions)
+
     for idx, row in target_questions.iterrows():
         for exp_type in exp_types:
             print("Sampling question", row["id"], exp_type)
@@ -118,9 +258,7 @@ def run_api_requests(args):
             messages = None
 
             if args.context:
-                context_condition = (context_questions["target_id"] == row["id"]) & (context_questions["source"] == args.context) & (context_questions["bias"] == args.bias) & (context_questions["experiment_type"] == args.experiment_type)
-                test = (context_questions["target_id"] == row["id"]) & (context_questions["source"] == args.context) & (context_questions["bias"] == args.bias) & (context_questions["experiment_type"] == args.experiment_type)
-                context_question = context_questions[context_condition].iloc[0]
+                context_question = context_questions[(row["id"], args.context, args.bias, args.experiment_type)]
                 messages = client.construct_prompt(context_question["question"], context_prompt)
                 if args.context_unavailable:
                     if args.as_batch:
@@ -128,35 +266,55 @@ def run_api_requests(args):
                         call = batch_call(args.model, messages, id)
                         batch_calls.append(call)
                         continue
-                    else:
-                        completion = client.api_call(messages)
-                        messages = client.expand_history(messages, client.get_completion_message(completion))
-                        new_row = format_response(row, 0, args, client.get_completion_message(completion))
-                        context_responses.append(new_row)
+                    # with asynchronous calls, the context answer is requested together with the target samples
+                    elif not args.as_async:
+                        response = journal.recorded(context_file, format_response(row, 0, args, None))
+                        if response is None:
+                            completion = client.api_call(messages)
+                            response = client.get_completion_message(completion)
+                            journal.append(context_file, format_response(row, 0, args, response))
+                        messages = client.expand_history(messages, response)
                 else:
-                    search = (context_answers["target_id"] == row["id"]) & (context_answers["context_bias"] == args.bias) & (context_answers["context"] == args.context) & (context_answers["context_prompt"] == args.context_prompt) & (context_answers["experiment_type"] == args.experiment_type)
-                    completion = context_answers[search].iloc[0]["response"]
+                    completion = context_answers[(row["id"], args.bias, args.context, args.context_prompt, args.experiment_type)]["response"]
                     messages = client.expand_history(messages, completion)
 
             target_prompt = original_target_prompt.str.replace("[unit]", row["unit"])
+
+            if args.as_async and not args.as_batch:
+                conditions.append((copy.copy(args), row, messages, target_prompt))
+                continue
+
             messages = client.construct_prompt(row["question"], target_prompt, messages)
 
             if args.as_batch:
-                for sample in range(int(args.samples)):
+                for samples in sample_chunks(args):
                     #print(sample)
-                    id = format_batch_id(row, sample, args, True)
-                    call = batch_call(args.model, messages, id)
+                    id = format_batch_id(row, samples[0], args, True)
+                    call = batch_call(args.model, messages, id, len(samples))
                     batch_calls.append(call)
             else:
-                for sample in range(int(args.samples)):
-                    print(sample)    
-                    completion = client.api_call(messages)
+                stopper = new_stopper(args, unit_table, row["id"]) if args.adaptive else None
+                for samples in sample_chunks(args):
+                    if stopper is not None and stopper.should_stop():
+                        break
+
+                    responses = sample_chunk(client, args, row, messages, samples, journal, target_file)
 
-                    if args.debug and sample == 3:
+                    if args.debug and 3 in samples:
                         print(messages)
-                    
-                    new_row = format_response(row, sample, args, client.get_completion_message(completion), True)
-                    target_responses.append(new_row)
+
+                    if stopper is not None:
+                        for response in responses:
+                            stopper.add(response)
+
+                if stopper is not None:
+                    stop_log.record(stop_decision(row, args, stopper))
+
+    if conditions:
+        asyncio.run(run_async_requests(client, conditions, journal, files, int(args.concurrency), stop_log, unit_table))
+
+    if client.cache:
+        print("Completion cache", client.cache.stats())
 
     if args.as_batch:
         batch_folder = "./batches/{}/".format(args.model)
@@ -166,52 +324,46 @@ def run_api_requests(args):
             filename = batch_folder + "{}_{}_context_gen_{}_batch.jsonl".format(args.bias, args.context, args.experiment_type)
         else:
             filename = batch_folder + "{}_{}_{}_context_{}_batch.jsonl".format(args.target_prompt, args.bias, args.context if args.context else "single_turn", args.experiment_type if args.context else "neutral")
-        with open(filename, "w+") as f:
-            for item in batch_calls:
-                f.write(json.dumps(item) + "\n")
-
-        if not args.debug:
-            batch_input = client.client.files.create(
-                file=open(filename, "rb"),
-                purpose="batch"
-            )
-
-            batch_id = batch_input.id
-            client.client.batches.create(
-                input_file_id=batch_id,
-                endpoint="/v1/chat/completions",
-                completion_window="24h",
-                metadata={
-                "description": "/".join([args.model, args.target_prompt, args.bias if args.context else "neutral", args.context if args.context else "single_turn"])
-                }
+        description = "/".join([args.model, args.target_prompt, args.bias if args.context else "neutral", args.context if args.context else "single_turn"])
+        if args.context_unavailable:
+            info = {"kind": "context_responses", "model": args.model, "save_file": "./results/{}/{}_{}".format(args.model, args.context_prompt, args.save_context)}
+        else:
+            info = {"kind": "target"}
+
+        if args.debug or not client.has_batch_api:
+            with open(filename, "w+") as f:
+                for item in batch_calls:
+                    f.write(json.dumps(item) + "\n")
+
+        if not args.debug and not client.has_batch_api:
+            # the batch file is run locally with the same client and ingested like an OpenAI batch output
+            output_file, stats = asyncio.run(run_local_batch(filename, concurrency=args.concurrency, clients={args.model: client}))
+            ingest_entry({"description": description, **info}, open_batch_output(output_file))
+        elif not args.debug:
+            # the batch calls are split into shards within the batch limits and recorded in the manifest for ingestion
+            manifest = BatchManifest(args.manifest)
+            submit_batch(
+                client.client,
+                filename,
+                batch_calls,
+                description,
+                manifest=manifest,
+                max_requests=args.max_batch_requests,
+                **info
             )
 
-    if args.debug:
-        debug_str = "DEBUG"
-    else:
-        debug_str = ""
+    if not args.as_batch:
+        journal.close()
+        compact_journal(journal_path, "./results/")
 
-    files = [args.target_prompt + "/" + debug_str + args.bias + "_" + args.save_target, debug_str + "{}_{}".format(args.context_prompt, args.save_context)]
-    collected_data = [target_responses, context_responses]
-
-    result_folder = "./results/{}/".format(args.model)
-    os.makedirs(result_folder, exist_ok=True)
-    os.makedirs(result_folder + args.target_prompt, exist_ok=True)
-
-    for idx, file in enumerate(files):
-        new_data = collected_data[idx]
-        if new_data != []:
-            filepath = result_folder + file
-            if os.path.exists(filepath):
-                existing_data = pd.read_csv(filepath)
-                new_data = pd.concat([existing_data, pd.DataFrame(new_data)], ignore_index=True)
-                new_data.sort_values(["target_id", "context", "experiment_type"], inplace=True)
-            else:
-                new_data = pd.DataFrame(new_data)
+        client.telemetry.progress(force=True)
+        client.telemetry.report()
+        client.telemetry.close()
 
-            new_data.to_csv(filepath, index=False)
+def main(argv=None):
+    args = parser.parse_args(argv)
+    print("START")
+    run_api_requests(args)
 
 if __name__ == "__main__":
-    print("START")
-    args = parser.parse_args()
-    run_api_requests(args)
\ No newline at end of file
+    main()
\ No newline at end of file
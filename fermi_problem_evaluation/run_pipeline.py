@@ -0,0 +1,279 @@
+import sys
+import os
+
+parent_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_folder_path)
+from utils import *
+from result_journal import ResultJournal, compact_journal
+from run_experiments import format_response, sample_chunks
+from telemetry import Telemetry
+
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import copy
+import time
+
+parser = argparse.ArgumentParser(
+    prog="ThesisPipeline",
+    description="Generate context questions, context answers and target samples as a streaming pipeline per question",
+)
+
+parser.add_argument("--model", default="gpt-3.5-turbo", help="Model tag which answers the context and target questions")
+
+parser.add_argument("--context_model", default="gpt-4-turbo", help="Model tag which generates the context questions, its name is the source of the context questions")
+
+parser.add_argument("--bias", default="general", help="Context bias of the generated context questions")
+
+parser.add_argument("--context_prompt", default="simple", help="Select the prompt style for the context question")
+
+parser.add_argument("--target_prompt", default="onlyanswer", help="Select the prompt style for the target question")
+
+parser.add_argument("--experiment_type", default=None, help="Experiment type (increase or decrease), None runs both")
+
+parser.add_argument("--samples", default=10, help="Number of target samples per question")
+
+parser.add_argument("--choices_per_call", default=1, help="Number of samples which are requested in a single API call with the n parameter")
+
+parser.add_argument("--save_target", default="target_responses.csv", help="Filename to save the target responses (if existing, samples which are already saved are skipped and new data is appended)")
+
+parser.add_argument("--save_context", default="responses.csv", help="Filename to save the context responses (if existing, samples which are already saved are skipped and new data is appended)")
+
+parser.add_argument("--question_concurrency", default=4, help="Maximum number of in-flight requests for context questions (first and second turn)")
+
+parser.add_argument("--answer_concurrency", default=8, help="Maximum number of in-flight requests for context answers")
+
+parser.add_argument("--target_concurrency", default=16, help="Maximum number of in-flight requests for target samples")
+
+parser.add_argument("--queue_size", default=8, help="Maximum number of questions waiting between two stages")
+
+parser.add_argument("--max_retries", default=6, help="Number of retries for throttled or failed API requests")
+
+parser.add_argument("--backends", default=None, help="Backend config (JSON) which routes models to self-hosted OpenAI compatible endpoints, defaults to the BACKENDS_CONFIG environment variable")
+
+parser.add_argument("--cache", default=None, help="Path of the SQLite cache for completions")
+
+parser.add_argument("--cache_size", default=1024, help="Maximum size of the completion cache in MB")
+
+parser.add_argument("--resume", default=False, action="store_true", help="Resume an interrupted pipeline from its journal")
+
+parser.add_argument("--debug", default=False, action="store_true", help="Toggle if the pipeline should be run with mock LLM responses")
+
+parser.add_argument("--debug_latency", default=0, help="Simulated latency in seconds of the mock LLM responses")
+
+# one stage of the pipeline, its workers limit the number of questions which are processed at once
+class Stage:
+    def __init__(self, name, process, concurrency):
+        self.name = name
+        self.process = process
+        self.concurrency = concurrency
+
+# every question passes the stages in order, bounded queues between the stages apply backpressure
+async def run_stages(items, stages, queue_size):
+    queues = [asyncio.Queue(maxsize=queue_size) for stage in stages]
+    failures = []
+
+    async def worker(idx):
+        stage = stages[idx]
+        while True:
+            item = await queues[idx].get()
+            try:
+                item = await stage.process(item)
+                if idx + 1 < len(stages):
+                    await queues[idx + 1].put(item)
+            except Exception as exception:
+                print("Stage {} failed for question {} ({}): {}".format(stage.name, item["row"]["id"], item["args"].experiment_type, exception))
+                failures.append((stage.name, item, exception))
+            finally:
+                queues[idx].task_done()
+
+    workers = [asyncio.create_task(worker(idx)) for idx, stage in enumerate(stages) for _ in range(int(stage.concurrency))]
+    for item in items:
+        await queues[0].put(item)
+    # a stage is finished once the previous stages are finished and its queue is empty
+    for queue in queues:
+        await queue.join()
+
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    return failures
+
+class ContextPipeline:
+    def __init__(self, args):
+        # pandas is only imported on use, so that e.g. --help starts immediately
+        import pandas as pd
+        import numpy as np
+
+        folder = "./experiment_data/"
+        load_dotenv()
+        question_args = copy.copy(args)
+        question_args.model = args.context_model
+        self.question_client = APIClient(question_args)
+        # the client prefixes the model tag of Together models, the result files use the prefixed tag as in run_experiments.py
+        self.client, args = APIClient(args).return_client_args()
+        self.args = args
+        self.debug_str = "DEBUG" if args.debug else ""
+        self.source = args.context_model.split("/")[-1]
+
+        self.target_questions = pd.read_csv(folder + "target_questions.csv")
+        prompts = pd.read_csv(folder + "prompts.csv").replace(np.nan, None)
+        self.target_prompt = prompts[(prompts["turn"] == "target") & (prompts["prompt"] == args.target_prompt)].iloc[0]
+        self.context_prompt = prompts[(prompts["turn"] == "context") & (prompts["prompt"] == args.context_prompt)].iloc[0]
+
+        question_prompts = pd.read_csv("../context_question_generation/context_questions_prompts.csv")
+        self.question_prompts = question_prompts[question_prompts["bias"] == args.bias].sort_values("turn")
+        if len(self.question_prompts) == 0:
+            raise Exception("Prompt variant does not exist!")
+
+        # the files of the journal are relative to the results folder
+        self.files = {
+            "first_turn": "{}/{}{}_first_turn.csv".format(self.source, self.debug_str, args.bias),
+            "question": "../experiment_data/{}generated_context_questions.csv".format(self.debug_str),
+            "answer": "{}/{}{}_{}".format(args.model, self.debug_str, args.context_prompt, args.save_context),
+            "target": "{}/{}/{}{}_{}".format(args.model, args.target_prompt, self.debug_str, args.bias, args.save_target),
+        }
+
+        # existing context questions and answers are reused, only missing ones are generated (debug runs only reuse their DEBUG files)
+        questions = self.read_results(self.files["question"], ["target_id", "source", "bias", "experiment_type", "question"])
+        self.context_questions = RowLookup(questions, ["target_id", "source", "bias", "experiment_type"], "context question")
+        answers = self.read_results(self.files["answer"], ["target_id", "context_bias", "context", "context_prompt", "experiment_type", "response"])
+        self.context_answers = RowLookup(answers, ["target_id", "context_bias", "context", "context_prompt", "experiment_type"], "context answer in ./results/" + self.files["answer"])
+
+        journal_name = "{}pipeline_{}_{}_{}_{}_{}.jsonl".format(self.debug_str, args.target_prompt, args.context_prompt, args.bias, self.source, args.experiment_type if args.experiment_type else "all")
+        self.journal_path = "./results/{}/journals/{}".format(args.model, journal_name)
+        self.journal = ResultJournal(self.journal_path, "./results/", args.resume)
+
+        # the experiment types of the context questions are the same as for run_experiments.py
+        self.exp_types = [args.experiment_type] if args.experiment_type else ["decrease", "increase"]
+        conditions = len(self.target_questions) * len(self.exp_types)
+        metrics_folder = "./results/{}/metrics/".format(args.model)
+        self.question_client.telemetry = Telemetry(metrics_folder + journal_name.replace("pipeline_", "pipeline_questions_"), {"model": args.context_model, "context_bias": args.bias, "target_prompt": "context_question"}, interval=30, max_tokens=SAMPLING_PARAMS["max_tokens"])
+        self.client.telemetry = Telemetry(metrics_folder + journal_name, {"model": args.model, "context_bias": args.bias, "target_prompt": args.target_prompt}, conditions * (len(sample_chunks(args)) + 1), max_tokens=SAMPLING_PARAMS["max_tokens"])
+
+    def read_results(self, file, columns):
+        import pandas as pd
+
+        path = "./results/" + file
+        return pd.read_csv(path) if os.path.exists(path) else pd.DataFrame(columns=columns)
+
+    # the arguments of a condition, as used by format_response of run_experiments.py
+    def condition(self, row, exp_type):
+        args = copy.copy(self.args)
+        args.context = self.source
+        args.experiment_type = exp_type
+        return {"row": row, "args": args, "question": None, "first_turn": None, "answer": None}
+
+    def question_row(self, item, text, column="question"):
+        return {"target_id": item["row"]["id"], "source": self.source, "bias": self.args.bias, "experiment_type": item["args"].experiment_type, column: text}
+
+    def existing_question(self, item):
+        key = (item["row"]["id"], self.source, self.args.bias, item["args"].experiment_type)
+        if key in self.context_questions:
+            return self.context_questions[key]["question"]
+        return self.journal.recorded(self.files["question"], self.question_row(item, None))
+
+    def question_prompt(self, turn, exp_type):
+        return self.question_prompts.iloc[turn].str.replace("[experiment_type]", exp_type)
+
+    # the first turn of two turn biases (e.g. availability), which is followed up by the question turn
+    async def first_turn(self, item):
+        item["question"] = self.existing_question(item)
+        if item["question"] is not None or len(self.question_prompts) < 2:
+            return item
+
+        row = self.question_row(item, None, "response")
+        item["first_turn"] = self.journal.recorded(self.files["first_turn"], row)
+        if item["first_turn"] is None:
+            messages = self.question_client.construct_prompt(item["row"]["question"], self.question_prompt(0, item["args"].experiment_type))
+            completion = await self.question_client.async_api_call(messages)
+            item["first_turn"] = self.question_client.get_completion_message(completion)
+            self.journal.append(self.files["first_turn"], self.question_row(item, item["first_turn"], "response"))
+
+        return item
+
+    async def context_question(self, item):
+        if item["question"] is not None:
+            return item
+
+        exp_type = item["args"].experiment_type
+        if item["first_turn"] is not None:
+            messages = self.question_client.construct_prompt(item["row"]["question"], self.question_prompt(0, exp_type))
+            messages = self.question_client.expand_history(messages, item["first_turn"])
+            messages = self.question_client.construct_prompt(None, self.question_prompt(1, exp_type), messages)
+        else:
+            messages = self.question_client.construct_prompt(item["row"]["question"], self.question_prompt(0, exp_type))
+
+        completion = await self.question_client.async_api_call(messages)
+        item["question"] = self.question_client.get_completion_message(completion)
+        self.journal.append(self.files["question"], self.question_row(item, item["question"]))
+
+        return item
+
+    async def context_answer(self, item):
+        args, row = item["args"], item["row"]
+        key = (row["id"], args.bias, args.context, args.context_prompt, args.experiment_type)
+        if key in self.context_answers:
+            item["answer"] = self.context_answers[key]["response"]
+            return item
+
+        item["answer"] = self.journal.recorded(self.files["answer"], format_response(row, 0, args, None))
+        if item["answer"] is None:
+            messages = self.client.construct_prompt(item["question"], self.context_prompt)
+            completion = await self.client.async_api_call(messages)
+            item["answer"] = self.client.get_completion_message(completion)
+            self.journal.append(self.files["answer"], format_response(row, 0, args, item["answer"]))
+
+        return item
+
+    async def target_samples(self, item):
+        args, row = item["args"], item["row"]
+        messages = self.client.construct_prompt(item["question"], self.context_prompt)
+        messages = self.client.expand_history(messages, item["answer"])
+        target_prompt = self.target_prompt.str.replace("[unit]", row["unit"])
+        messages = self.client.construct_prompt(row["question"], target_prompt, messages)
+
+        async def sample_target(samples):
+            samples = [sample for sample in samples if self.journal.recorded(self.files["target"], format_response(row, sample, args, None, True)) is None]
+            if samples:
+                responses = await self.client.async_sample_responses(messages, samples, self.target_semaphore)
+                for sample, response in zip(samples, responses):
+                    self.journal.append(self.files["target"], format_response(row, sample, args, response, True))
+
+        await asyncio.gather(*[sample_target(samples) for samples in sample_chunks(args)])
+        print("Finished question", row["id"], args.experiment_type)
+
+        return item
+
+    async def run(self):
+        # the samples of several questions share the request limit of the target stage
+        self.target_semaphore = asyncio.Semaphore(int(self.args.target_concurrency))
+        stages = [
+            Stage("first_turn", self.first_turn, self.args.question_concurrency),
+            Stage("context_question", self.context_question, self.args.question_concurrency),
+            Stage("context_answer", self.context_answer, self.args.answer_concurrency),
+            Stage("target_samples", self.target_samples, self.args.target_concurrency),
+        ]
+        items = (self.condition(row, exp_type) for idx, row in self.target_questions.iterrows() for exp_type in self.exp_types)
+        return await run_stages(items, stages, int(self.args.queue_size))
+
+    def close(self):
+        self.journal.close()
+        compact_journal(self.journal_path, "./results/")
+        for client in [self.question_client, self.client]:
+            client.telemetry.report()
+            client.telemetry.close()
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    start = time.time()
+
+    pipeline = ContextPipeline(args)
+    failures = asyncio.run(pipeline.run())
+    pipeline.close()
+
+    print("Pipeline finished in {:.1f}s with {} failed questions".format(time.time() - start, len(failures)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import copy
+import itertools
+
+from dotenv import load_dotenv
+
+import run_experiments
+from read_batch_results import ingest_entry
+from batch_orchestrator import BatchManifest, wait_for_batches
+
+parser = argparse.ArgumentParser(prog="ThesisSweep", description="Submit the batches of all model, bias and prompt combinations and ingest their results")
+parser.add_argument("--models", nargs="+", default=["gpt-3.5-turbo"], help="Models of the sweep")
+parser.add_argument("--biases", nargs="+", default=["general"], help="Biases of the sweep")
+parser.add_argument("--target_prompts", nargs="+", default=["onlyanswer"], help="Target prompts of the sweep")
+parser.add_argument("--contexts", nargs="+", default=["single_turn"], help="Sources of the context questions, single_turn runs the questions without context")
+parser.add_argument("--context_prompt", default="simple", help="Prompt style for the context question")
+parser.add_argument("--samples", default=10, help="Number of samples per question")
+parser.add_argument("--choices_per_call", default=1, help="Number of samples per batch request with the n parameter")
+parser.add_argument("--manifest", default="./batches/manifest.json", help="Manifest file of the submitted batches")
+parser.add_argument("--max_batch_requests", default=50000, help="Maximum number of requests per batch, larger batches are split into shards")
+parser.add_argument("--interval", default=30, help="Initial polling interval in seconds")
+parser.add_argument("--timeout", default=None, help="Stop polling after the given number of seconds, a later call with --skip_submit continues")
+parser.add_argument("--skip_submit", default=False, action="store_true", help="Only poll and ingest the batches of the manifest")
+parser.add_argument("--debug", default=False, action="store_true", help="Only write the batch files without submitting them")
+
+# the context answers of multi turn conditions have to exist already (see --context_unavailable of run_experiments.py)
+def sweep_conditions(args):
+    for model, bias, target_prompt, context in itertools.product(args.models, args.biases, args.target_prompts, args.contexts):
+        condition = ["--model", model, "--bias", bias, "--target_prompt", target_prompt, "--context_prompt", args.context_prompt,
+                     "--samples", str(args.samples), "--choices_per_call", str(args.choices_per_call), "--manifest", args.manifest, "--max_batch_requests", str(args.max_batch_requests), "--as_batch"]
+        if context != "single_turn":
+            condition += ["--context", context]
+        if args.debug:
+            condition += ["--debug"]
+        yield run_experiments.parser.parse_args(condition)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if not args.skip_submit:
+        for condition in sweep_conditions(args):
+            print("Submitting", condition.model, condition.bias, condition.target_prompt, condition.context or "single_turn")
+            run_experiments.run_api_requests(copy.copy(condition))
+
+    if not args.debug:
+        from openai import OpenAI
+        load_dotenv()
+        client = OpenAI(max_retries=6)
+        manifest = BatchManifest(args.manifest)
+        ingest = lambda entry, lines: ingest_entry(entry, lines)
+        pending = wait_for_batches(client, manifest, ingest, ["target", "context_responses"], float(args.interval), timeout=float(args.timeout) if args.timeout else None)
+        print("Sweep finished" if not pending else "{} batches are still pending".format(len(pending)))
@@ -0,0 +1,199 @@
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from result_statistics import GROUP_COLUMNS, baseline_key, filter_answers
+
+parser = argparse.ArgumentParser(prog="Significance", description="Bootstrap confidence intervals and permutation tests of the shift of every condition against its baseline")
+parser.add_argument("--answers", default="saved_states/processed_answers.pkl", help="Processed answers (see process_results.py)")
+parser.add_argument("--format", default="order_of_magnitude", help="Column of the answers which is compared (order_of_magnitude or number)")
+parser.add_argument("--resamples", default=10000, help="Number of bootstrap resamples and permutations per condition")
+parser.add_argument("--confidence", default=0.95, help="Confidence level of the bootstrap intervals")
+parser.add_argument("--seed", default=0, help="Seed of the resampling, the results do not depend on the number of workers")
+parser.add_argument("--workers", default=1, help="Number of worker processes")
+parser.add_argument("--save", default="saved_states/significance_oom.pkl", help="File to save the test results")
+
+# maximum number of elements of a resampled array, larger buckets are processed in chunks
+CHUNK_ELEMENTS = 2 ** 22
+# families (question, model and target prompt) per shard, every shard gets its own random stream
+SHARD_FAMILIES = 16
+
+# answers of every condition grouped by the family of its baseline, conditions without a baseline are skipped
+def collect_families(answers, format):
+    data = answers.dropna(subset=[format])
+    grouped = data.groupby(GROUP_COLUMNS, observed=True, sort=False)
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    ends = np.cumsum(np.bincount(codes))
+    values = np.split(data[format].to_numpy(dtype=float)[order], ends[:-1])
+    keys = data[GROUP_COLUMNS].iloc[order[ends - np.bincount(codes)]].itertuples(index=False, name=None)
+    samples = dict(zip(keys, values))
+
+    families = {}
+    for key, values in samples.items():
+        baseline = baseline_key(key[0], key[1], key[4])
+        if key != baseline and baseline in samples:
+            families.setdefault(baseline, (samples[baseline], []))[1].append((key, values))
+
+    return list(families.values())
+
+# row indices by key, e.g. samples of the same length which are resampled in one array
+def buckets(keys):
+    rows = {}
+    for idx, key in enumerate(keys):
+        rows.setdefault(key, []).append(idx)
+    return {key: np.array(idx) for key, idx in rows.items()}
+
+def row_chunks(rows, width, resamples):
+    size = max(1, CHUNK_ELEMENTS // (width * resamples))
+    return [rows[start:start + size] for start in range(0, len(rows), size)]
+
+# median of a subset of sorted values, given the cumulative number of values of the subset up to every position
+def subset_median(values, rows, cumulative, size):
+    low = (cumulative >= (size + 1) // 2).argmax(axis=2)
+    high = (cumulative >= size // 2 + 1).argmax(axis=2)
+    return (values[rows, low] + values[rows, high]) / 2
+
+# medians of the bootstrap resamples of every sample, shape (samples, resamples)
+def bootstrap_medians(rng, samples, resamples):
+    medians = np.empty((len(samples), resamples))
+    for width, rows in buckets([len(sample) for sample in samples]).items():
+        for chunk in row_chunks(rows, width, resamples):
+            values = np.sort(np.stack([samples[row] for row in chunk]), axis=1)
+            # as the values are sorted, only the drawn positions are sorted to find the middle values of a resample
+            positions = np.floor(rng.random((len(chunk), resamples, width), dtype=np.float32) * width)
+            positions = np.sort(np.minimum(positions, width - 1), axis=2)
+            low, high = positions[..., (width - 1) // 2].astype(np.intp), positions[..., width // 2].astype(np.intp)
+            medians[chunk] = (values[np.arange(len(chunk))[:, None], low] + values[np.arange(len(chunk))[:, None], high]) / 2
+    return medians
+
+# number of ways to assign size of the pooled answers to the condition, counted by the number of answers of every distinct value
+def assignment_count(counts, size):
+    ways = np.zeros(size + 1)
+    ways[0] = 1
+    for count in counts:
+        ways = np.convolve(ways, np.ones(count + 1))[:size + 1]
+    return ways[size]
+
+# all assignments of size pooled answers to the condition as counts of every distinct value, with their probability under permutation
+def enumerate_assignments(counts, size):
+    assignments = np.zeros((1, 0), dtype=np.int64)
+    weights = np.ones(1)
+    remaining = np.cumsum(counts[::-1])[::-1]
+    for column, count in enumerate(counts):
+        taken = assignments.sum(axis=1)[:, None] + np.arange(count + 1)
+        rest = remaining[column + 1] if column + 1 < len(counts) else 0
+        rows, drawn = np.nonzero((taken <= size) & (taken + rest >= size))
+        assignments = np.column_stack([assignments[rows], drawn])
+        weights = weights[rows] * np.array([math.comb(count, x) for x in range(count + 1)], dtype=float)[drawn]
+    return assignments, weights / math.comb(int(counts.sum()), size)
+
+# absolute median differences of assignments of the pooled values (distinct values of every row and their counts), shape (rows, assignments)
+def assignment_differences(values, counts, assignments, size):
+    condition_counts = np.cumsum(assignments, axis=1)[None]
+    baseline_counts = np.cumsum(counts)[None, None, :] - condition_counts
+    rows = np.arange(len(values))[:, None]
+    return np.abs(subset_median(values, rows, condition_counts, size) - subset_median(values, rows, baseline_counts, counts.sum() - size))
+
+# absolute median differences of drawn permutations of the sorted pooled values, shape (rows, resamples),
+# the positions are assigned to the condition one after another with the probability of a uniformly drawn subset,
+# the middle positions of the condition and baseline are the number of steps before the middle ranks are reached
+def permutation_differences(rng, pooled, size, resamples):
+    width = pooled.shape[1]
+    shape = (len(pooled), resamples)
+    ranks = [(size + 1) // 2, size // 2 + 1, (width - size + 1) // 2, (width - size) // 2 + 1]
+    positions = [np.zeros(shape, dtype=np.intp) for _ in ranks]
+    taken = np.zeros(shape, dtype=np.intp)
+    for step in range(width):
+        taken += rng.random(shape) * (width - step) < size - taken
+        positions[0] += taken < ranks[0]
+        positions[1] += taken < ranks[1]
+        positions[2] += step + 1 - taken < ranks[2]
+        positions[3] += step + 1 - taken < ranks[3]
+    rows = np.arange(len(pooled))[:, None]
+    condition = (pooled[rows, positions[0]] + pooled[rows, positions[1]]) / 2
+    baseline = (pooled[rows, positions[2]] + pooled[rows, positions[3]]) / 2
+    return np.abs(condition - baseline)
+
+# two-sided p-values of the median difference, the condition and baseline answers are permuted together,
+# conditions with the same number of pooled and condition answers are permuted in one array
+def permutation_pvalues(rng, conditions, baselines, observed, resamples):
+    pvalues = np.empty(len(conditions))
+    sizes = [(len(condition) + len(baseline), len(condition)) for condition, baseline in zip(conditions, baselines)]
+    for (width, size), rows in buckets(sizes).items():
+        pooled = np.sort(np.stack([np.concatenate([conditions[row], baselines[row]]) for row in rows]), axis=1)
+        extreme = np.abs(observed[rows]) - 1e-9
+
+        # a permutation only matters by the number of answers of every distinct value which are assigned to the condition,
+        # rows with the same runs of equal sorted answers have the same assignments
+        starts = np.ones(pooled.shape, dtype=bool)
+        starts[:, 1:] = pooled[:, 1:] != pooled[:, :-1]
+        patterns, inverse = np.unique(starts, axis=0, return_inverse=True)
+        drawn = []
+        for pattern, pattern_rows in buckets(inverse.reshape(-1)).items():
+            positions = np.flatnonzero(patterns[pattern])
+            counts = np.diff(np.append(positions, width))
+            if assignment_count(counts, size) <= resamples:
+                # with fewer possible assignments than resamples (e.g. orders of magnitude), the share of extreme permutations is exact
+                assignments, probabilities = enumerate_assignments(counts, size)
+                differences = assignment_differences(pooled[pattern_rows][:, positions], counts, assignments, size)
+                pvalues[rows[pattern_rows]] = np.minimum(((differences >= extreme[pattern_rows, None]) * probabilities).sum(axis=1), 1.0)
+            else:
+                drawn.append(pattern_rows)
+
+        for chunk in row_chunks(np.sort(np.concatenate(drawn)), width, resamples) if drawn else []:
+            extremes = (permutation_differences(rng, pooled[chunk], size, resamples) >= extreme[chunk, None]).sum(axis=1)
+            pvalues[rows[chunk]] = (1 + extremes) / (resamples + 1)
+    return pvalues
+
+# observed difference, confidence interval and p-value of the conditions of some families
+def test_shard(families, resamples, confidence, seed):
+    rng = np.random.default_rng(seed)
+    baselines = [baseline for baseline, conditions in families]
+    family_rows = np.array([idx for idx, (baseline, conditions) in enumerate(families) for _ in conditions])
+    conditions = [values for baseline, conditions in families for key, values in conditions]
+
+    observed = np.array([np.median(values) for values in conditions]) - np.array([np.median(baselines[idx]) for idx in family_rows])
+
+    # the resamples of a baseline are shared by all conditions of its family
+    differences = bootstrap_medians(rng, conditions, resamples) - bootstrap_medians(rng, baselines, resamples)[family_rows]
+    alpha = 1 - confidence
+    low, high = np.quantile(differences, [alpha / 2, 1 - alpha / 2], axis=1)
+
+    pvalues = permutation_pvalues(rng, conditions, [baselines[idx] for idx in family_rows], observed, resamples)
+
+    return np.column_stack([observed, low, high, pvalues])
+
+def significance_tests(answers, format="order_of_magnitude", resamples=10000, confidence=0.95, seed=0, workers=1):
+    families = collect_families(answers, format)
+    shards = [families[start:start + SHARD_FAMILIES] for start in range(0, len(families), SHARD_FAMILIES)]
+    seeds = np.random.SeedSequence(seed).spawn(len(shards))
+
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(test_shard, shards, [resamples] * len(shards), [confidence] * len(shards), seeds))
+    else:
+        results = [test_shard(shard, resamples, confidence, shard_seed) for shard, shard_seed in zip(shards, seeds)]
+
+    rows = [(*key, len(values), len(baseline)) for baseline, conditions in families for key, values in conditions]
+    frame = pd.DataFrame(rows, columns=GROUP_COLUMNS + ["n", "baseline_n"])
+    columns = ["50%_difference", "ci_low", "ci_high", "p_value"]
+    frame[columns] = np.concatenate(results) if results else np.empty((0, len(columns)))
+
+    return frame
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start = time.time()
+
+    answers = filter_answers(pd.read_pickle(args.answers))
+    results = significance_tests(answers, args.format, int(args.resamples), float(args.confidence), int(args.seed), int(args.workers))
+
+    os.makedirs(os.path.dirname(args.save), exist_ok=True)
+    results.to_pickle(args.save)
+    print("Tested {} conditions with {} resamples in {:.1f}s, {} with p < 0.05".format(len(results), args.resamples, time.time() - start, int((results["p_value"] < 0.05).sum())))
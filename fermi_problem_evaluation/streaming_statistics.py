@@ -0,0 +1,249 @@
+import argparse
+import math
+import os
+import time
+
+from process_results import list_result_files, load_target_questions
+from result_statistics import GROUP_COLUMNS, STAT_COLUMNS, filter_answers, finish_statistics
+
+# numpy, pandas and the answer extraction are imported by the functions which use them, so that the CLI starts without them
+
+parser = argparse.ArgumentParser(prog="StreamingStatistics", description="Calculate the group statistics in one pass over the result files with bounded memory")
+parser.add_argument("--results", default="./results/", help="Folder with the target response files")
+parser.add_argument("--store", default=None, help="Parquet store of the results (see result_store.py), which is read instead of the result files")
+parser.add_argument("--target_questions", default="./experiment_data/target_questions.csv", help="File with the target questions")
+parser.add_argument("--chunk_size", default=10000, help="Number of responses which are read and extracted at once")
+parser.add_argument("--capacity", default=1024, help="Distinct numbers per group which are counted exactly, groups with more numbers use the quantile sketch")
+parser.add_argument("--relative_accuracy", default=0.01, help="Relative accuracy of the quantile sketch of the numbers")
+parser.add_argument("--states", default="./saved_states/", help="Folder to save the statistics (results_oom_df.pkl and results_num_df.pkl)")
+
+FORMATS = ["order_of_magnitude", "number"]
+ANSWER_COLUMNS = ["number", "order_of_magnitude", "comment"]
+APPEARANCE_COLUMNS = ["model", "target_id", "target_prompt"]
+
+# count, mean and variance of a stream, chunks are merged with the parallel form of Welford's algorithm
+class Moments:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def merge(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        if self.count == 0:
+            # the first chunk is taken over, as inf * 0 would turn the overflowing variance of extreme answers into NaN
+            self.mean, self.m2 = mean, m2
+        else:
+            delta = mean - self.mean
+            self.mean += delta * count / total
+            # delta * delta gives inf for extreme answers (e.g. 8e287) as the var of pandas, delta ** 2 raises an OverflowError
+            self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    # sample standard deviation as in pandas
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+# exact counts of the distinct values up to the capacity, beyond it only the most frequent values are kept (space saving),
+# which still finds the mode of skewed groups
+class ValueCounts:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.exact = True
+
+    def add(self, value, count):
+        if value in self.counts or len(self.counts) < self.capacity:
+            self.counts[value] = self.counts.get(value, 0) + count
+            return
+        self.exact = False
+        evicted = min(self.counts, key=self.counts.get)
+        self.counts[value] = self.counts.pop(evicted) + count
+
+    # the mode as in aggregate_modes of result_statistics.py: only a single most frequent value, which is not 0
+    def mode(self):
+        if not self.counts:
+            return math.nan, math.nan
+        top = max(self.counts.values())
+        modes = [value for value, count in self.counts.items() if count == top]
+        if len(modes) != 1 or modes[0] == 0:
+            return math.nan, math.nan
+        return modes[0], top
+
+    def median(self, count):
+        return sorted_median(sorted(self.counts.items()), count)
+
+# median of sorted (value, count) pairs, the mean of the two middle values for an even count
+def sorted_median(items, count):
+    low, high = (count - 1) // 2, count // 2
+    seen, low_value = 0, None
+    for value, value_count in items:
+        seen += value_count
+        if low_value is None and seen > low:
+            low_value = value
+        if seen > high:
+            return (low_value + value) / 2
+    return math.nan
+
+# logarithmic buckets with a relative accuracy for the quantiles of numbers over many orders of magnitude (as DDSketch),
+# every bucket is counted under its representative value
+class QuantileSketch:
+    def __init__(self, relative_accuracy):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}
+
+    def add(self, value, count):
+        self.buckets[value] = self.buckets.get(value, 0) + count
+
+    def median(self, count):
+        return sorted_median(sorted(self.buckets.items()), count)
+
+# representative value of the bucket of every number, within the relative accuracy of the number (zeros stay zero)
+def sketch_values(values, gamma):
+    import numpy as np
+
+    magnitudes = np.abs(values)
+    with np.errstate(divide="ignore"):
+        buckets = np.ceil(np.log(magnitudes) / np.log(gamma))
+        representatives = 2 * gamma ** buckets / (gamma + 1)
+    return np.where(magnitudes == 0, 0.0, np.sign(values) * representatives)
+
+class FormatAccumulator:
+    def __init__(self, capacity, relative_accuracy=None):
+        self.moments = Moments()
+        self.values = ValueCounts(capacity)
+        self.sketch = QuantileSketch(relative_accuracy) if relative_accuracy else None
+
+    def describe(self):
+        count = self.moments.count
+        if count == 0:
+            return {"min": math.nan, "max": math.nan, "mean": math.nan, "50%": math.nan, "std": math.nan, "mode": math.nan, "mode_count": math.nan, "unique": 0}
+
+        median = self.values.median(count) if self.values.exact or self.sketch is None else self.sketch.median(count)
+        mode, mode_count = self.values.mode()
+        return {
+            "min": self.moments.min,
+            "max": self.moments.max,
+            "mean": self.moments.mean,
+            "50%": median,
+            "std": self.moments.std(),
+            # as in mode_unique, groups without a single mode use the median
+            "mode": mode if not math.isnan(mode) else median,
+            "mode_count": mode_count,
+            "unique": len(self.values.counts) if self.values.exact else math.nan,
+        }
+
+class GroupAccumulator:
+    def __init__(self, capacity, relative_accuracy):
+        self.rows = 0
+        self.formats = {
+            # the order of magnitude is a small integer, so its counts are always exact
+            "order_of_magnitude": FormatAccumulator(capacity=math.inf),
+            "number": FormatAccumulator(capacity, relative_accuracy),
+        }
+
+# statistics of all groups, updated chunk by chunk, the memory depends on the number of groups and not on the number of responses
+class StreamingStatistics:
+    def __init__(self, capacity=1024, relative_accuracy=0.01):
+        self.capacity = capacity
+        self.relative_accuracy = relative_accuracy
+        self.gamma = QuantileSketch(relative_accuracy).gamma
+        self.groups = {}
+        # labels in order of appearance, which determines the order of the statistics as in compute_statistics
+        self.appearance = {column: {} for column in APPEARANCE_COLUMNS}
+
+    def group(self, key):
+        if key not in self.groups:
+            self.groups[key] = GroupAccumulator(self.capacity, self.relative_accuracy)
+        return self.groups[key]
+
+    # processed answers of a chunk, with the columns of the result files and the extracted answers
+    def update(self, answers):
+        data = filter_answers(answers)
+        for column in APPEARANCE_COLUMNS:
+            self.appearance[column].update(dict.fromkeys(data[column].unique()))
+
+        for key, rows in data.groupby(GROUP_COLUMNS, observed=True, sort=False).size().items():
+            self.group(key).rows += rows
+
+        for format in FORMATS:
+            valid = data.dropna(subset=[format])
+            if valid.empty:
+                continue
+            self.update_moments(valid, format)
+            self.update_counts(valid, format, valid[format], "values")
+            if format == "number":
+                self.update_counts(valid, format, sketch_values(valid[format].to_numpy(dtype=float), self.gamma), "sketch")
+
+    def update_moments(self, valid, format):
+        moments = valid.groupby(GROUP_COLUMNS, observed=True, sort=False)[format].agg(["count", "mean", "var", "min", "max"])
+        for key, count, mean, var, minimum, maximum in moments.itertuples(name=None):
+            m2 = var * (count - 1) if count > 1 else 0.0
+            self.group(key).formats[format].moments.merge(count, mean, m2, minimum, maximum)
+
+    def update_counts(self, valid, format, values, target):
+        counts = valid[GROUP_COLUMNS].assign(value=values).groupby(GROUP_COLUMNS + ["value"], observed=True, sort=False).size()
+        for key, count in counts.items():
+            getattr(self.group(key[:-1]).formats[format], target).add(key[-1], count)
+
+    def statistics(self, format):
+        import pandas as pd
+
+        rows = []
+        for key, group in self.groups.items():
+            rows.append({**group.formats[format].describe(), **dict(zip(GROUP_COLUMNS, key)), "num_valid_answers": group.rows})
+
+        stats = pd.DataFrame(rows, columns=STAT_COLUMNS + ["mode", "mode_count", "unique"] + GROUP_COLUMNS + ["num_valid_answers"])
+        appearance = {column: list(labels) for column, labels in self.appearance.items()}
+        return finish_statistics(stats, appearance)
+
+    def approximate_groups(self):
+        return sum(1 for group in self.groups.values() if not group.formats["number"].values.exact)
+
+# chunks of the result files (or of the Parquet store) with the extracted answers, the responses are dropped after the extraction
+def stream_answers(results_folder, target_questions_path, chunk_size, store=None):
+    import pandas as pd
+    from answer_extraction import extract_answers
+
+    target_questions, unit_table = load_target_questions(target_questions_path)
+    if store is not None:
+        from result_store import open_store
+        chunks = (batch.to_pandas() for batch in open_store(store).to_batches(batch_size=chunk_size))
+    else:
+        chunks = (chunk for path in list_result_files(results_folder) for chunk in pd.read_csv(path, chunksize=chunk_size))
+
+    for chunk in chunks:
+        answers = extract_answers(chunk, target_questions, unit_table=unit_table)
+        yield pd.concat([chunk.drop(columns=["response"]), answers[ANSWER_COLUMNS]], axis=1)
+
+def streaming_statistics(results_folder, target_questions_path, chunk_size=10000, capacity=1024, relative_accuracy=0.01, store=None):
+    statistics = StreamingStatistics(capacity, relative_accuracy)
+    responses = 0
+    for answers in stream_answers(results_folder, target_questions_path, chunk_size, store):
+        statistics.update(answers)
+        responses += len(answers)
+        print("Processed {} responses in {} groups".format(responses, len(statistics.groups)))
+
+    return statistics
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    start = time.time()
+
+    statistics = streaming_statistics(args.results, args.target_questions, int(args.chunk_size), int(args.capacity), float(args.relative_accuracy), args.store)
+    oom_df, num_df = statistics.statistics("order_of_magnitude"), statistics.statistics("number")
+
+    os.makedirs(args.states, exist_ok=True)
+    oom_df.to_pickle(os.path.join(args.states, "results_oom_df.pkl"))
+    num_df.to_pickle(os.path.join(args.states, "results_num_df.pkl"))
+
+    if statistics.approximate_groups():
+        print("{} groups had more than {} distinct numbers, their median is estimated by the sketch and their unique count is unknown".format(statistics.approximate_groups(), args.capacity))
+    print("Calculated the statistics of {} groups in {:.1f}s".format(len(oom_df), time.time() - start))
+
+if __name__ == "__main__":
+    main()
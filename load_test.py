@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_server
+from telemetry import percentile
+
+parser = argparse.ArgumentParser(prog="LoadTest", description="Measure the API client and the experiment scripts against the mock server", parents=[mock_server.options])
+parser.add_argument("--base_url", default=None, help="URL of a running server, otherwise a mock server is started")
+parser.add_argument("--requests", default=200, help="Number of requests of the client benchmark (0 skips it)")
+parser.add_argument("--concurrency", default=16, help="Maximum number of in-flight requests of the client benchmark")
+parser.add_argument("--model", default="gpt-4o-mini", help="Model tag of the requests")
+parser.add_argument("--sweep", action="append", default=[], help="Arguments of a run_experiments.py run which is timed end to end, can be repeated")
+parser.add_argument("--client_rpm", default=None, help="Requests per minute of the client rate limiter (sets OPENAI_RPM)")
+parser.add_argument("--client_tpm", default=None, help="Tokens per minute of the client rate limiter (sets OPENAI_TPM)")
+parser.add_argument("--report", default=None, help="JSON file to save the report")
+parser.add_argument("--backends", default=None, help="Backend config (JSON) which routes --model to its endpoints (sets BACKENDS_CONFIG)")
+parser.add_argument("--replicas", default=0, help="Number of mock servers which serve --model through a generated backend config (0 uses a single server without routing)")
+parser.add_argument("--replica_concurrency", default=8, help="Concurrency cap of every mock replica in the generated backend config")
+
+EXPERIMENT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fermi_problem_evaluation")
+
+def summarize(latencies, duration):
+    return {
+        "requests": len(latencies),
+        "duration_s": round(duration, 3),
+        "requests_per_s": round(len(latencies) / duration, 2) if duration > 0 else None,
+        "p50_s": percentile(latencies, 50),
+        "p99_s": percentile(latencies, 99),
+    }
+
+# requests through the APIClient, including its rate limiter and retries
+async def client_benchmark(model, requests, concurrency):
+    from utils import APIClient
+
+    client = APIClient(argparse.Namespace(model=model, debug=False, max_retries=6))
+    semaphore = asyncio.Semaphore(concurrency)
+    messages = [{"role": "user", "content": "How many piano tuners are there in Chicago? Answer as a [concrete number in 'people']"}]
+    latencies, failures = [], 0
+
+    async def request(sample):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.async_api_call(messages, sample)
+                latencies.append(time.perf_counter() - start)
+            except Exception as exception:
+                failures += 1
+                print("Request failed:", exception)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(sample) for sample in range(requests)])
+    report = summarize(latencies, time.perf_counter() - start)
+    report["failures"] = failures
+    return report
+
+# run the experiment script in a temporary copy of the experiment data, so that the real results stay untouched
+def sweep_benchmark(sweep, env):
+    folder = tempfile.mkdtemp(prefix="loadtest_")
+    try:
+        shutil.copytree(os.path.join(EXPERIMENT_FOLDER, "experiment_data"), os.path.join(folder, "experiment_data"))
+        command = [sys.executable, os.path.join(EXPERIMENT_FOLDER, "run_experiments.py")] + shlex.split(sweep)
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=folder, env=env, capture_output=True, text=True)
+        duration = time.perf_counter() - start
+
+        rows = 0
+        for root, dirs, files in os.walk(os.path.join(folder, "results")):
+            for file in files:
+                if file.endswith(".csv"):
+                    with open(os.path.join(root, file), encoding="utf-8") as f:
+                        rows += max(0, sum(1 for line in f) - 1)
+        if process.returncode != 0:
+            print(process.stderr[-2000:])
+        return {"arguments": sweep, "returncode": process.returncode, "duration_s": round(duration, 3), "rows": rows}
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+# one mock server per replica, all of them serve the model under test
+def start_replicas(args, folder):
+    servers, endpoints = [], {}
+    for idx in range(int(args.replicas)):
+        replica_args = argparse.Namespace(**{**vars(args), "port": 0})
+        servers.append(mock_server.start_server(replica_args))
+        endpoints["replica{}".format(idx)] = {"base_url": mock_server.base_url(servers[-1]), "max_concurrency": int(args.replica_concurrency)}
+
+    path = os.path.join(folder, "backends.json")
+    with open(path, "w") as f:
+        json.dump({"endpoints": endpoints, "models": {args.model: {"endpoints": list(endpoints)}}}, f, indent=4)
+    return servers, path
+
+def print_report(name, report):
+    print("{}: {}".format(name, ", ".join("{}={}".format(key, round(value, 4) if isinstance(value, float) else value) for key, value in report.items())))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    server, replicas = None, []
+    if int(args.replicas) > 0:
+        folder = tempfile.mkdtemp(prefix="loadtest_backends_")
+        replicas, args.backends = start_replicas(args, folder)
+        print("Started {} mock replicas with the backend config {}".format(len(replicas), args.backends))
+    if args.base_url is None:
+        server = mock_server.start_server(args)
+        args.base_url = mock_server.base_url(server)
+        print("Started mock server on", args.base_url)
+
+    # the client and the experiment scripts read the endpoint and quotas from the environment
+    os.environ["OPENAI_BASE_URL"] = args.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    if args.client_rpm:
+        os.environ["OPENAI_RPM"] = str(args.client_rpm)
+    if args.client_tpm:
+        os.environ["OPENAI_TPM"] = str(args.client_tpm)
+    if args.backends:
+        os.environ["BACKENDS_CONFIG"] = os.path.abspath(args.backends)
+
+    report = {"base_url": args.base_url}
+    if int(args.requests) > 0:
+        report["client"] = asyncio.run(client_benchmark(args.model, int(args.requests), int(args.concurrency)))
+        print_report("Client", report["client"])
+
+    from backends import get_registry
+    registry = get_registry()
+    if registry is not None:
+        report["endpoints"] = registry.stats()
+        for name, stats in report["endpoints"].items():
+            print_report("Endpoint " + name, stats)
+
+    report["sweeps"] = []
+    for sweep in args.sweep:
+        sweep_report = sweep_benchmark(sweep, dict(os.environ))
+        report["sweeps"].append(sweep_report)
+        print_report("Sweep", sweep_report)
+
+    if server is not None:
+        stats = server.state.stats()
+        report["server"] = summarize(stats["latencies"], 1)
+        del report["server"]["duration_s"], report["server"]["requests_per_s"]
+        report["server"]["status_counts"] = stats["status_counts"]
+        print_report("Server", report["server"])
+        server.shutdown()
+    for replica in replicas:
+        replica.shutdown()
+    if replicas:
+        shutil.rmtree(os.path.dirname(args.backends), ignore_errors=True)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
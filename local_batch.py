@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from utils import APIClient
+
+parser = argparse.ArgumentParser(prog="LocalBatch", description="Run batch files against an OpenAI compatible endpoint without a batch API")
+parser.add_argument("input", nargs="+", help="Batch files (*_batch.jsonl) as written by the experiment scripts")
+parser.add_argument("--output", default=None, help="Output file (only for a single batch file), defaults to <batch file>_output.jsonl")
+parser.add_argument("--base_url", default=None, help="Endpoint of the requests, otherwise the endpoint of the model is used (e.g. Together for llama models)")
+parser.add_argument("--api_key_env", default=None, help="Environment variable with the API key for --base_url")
+parser.add_argument("--concurrency", default=16, help="Maximum number of in-flight requests")
+parser.add_argument("--max_retries", default=6, help="Number of retries for throttled or failed requests")
+parser.add_argument("--backends", default=None, help="Backend config (JSON) which routes the models to self-hosted endpoints, defaults to BACKENDS_CONFIG")
+
+def output_paths(input_file, output_file=None):
+    stem = input_file[:-len(".jsonl")] if input_file.endswith(".jsonl") else input_file
+    output_file = output_file or stem + "_output.jsonl"
+    error_file = (output_file[:-len(".jsonl")] if output_file.endswith(".jsonl") else output_file) + "_errors.jsonl"
+    return output_file, error_file
+
+# custom ids which are already in the output, so that an interrupted batch only runs the remaining requests
+def completed_ids(output_file):
+    ids = set()
+    if os.path.exists(output_file):
+        with open(output_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ids.add(json.loads(line)["custom_id"])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+    return ids
+
+def read_requests(input_file, skip=()):
+    with open(input_file, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                if request["custom_id"] not in skip:
+                    yield request
+
+# output lines have the same shape as the output and error files of the OpenAI batch API
+def output_line(custom_id, completion):
+    return {
+        "id": "batch_req_" + uuid.uuid4().hex,
+        "custom_id": custom_id,
+        "response": {"status_code": 200, "request_id": completion.id, "body": completion.model_dump()},
+        "error": None,
+    }
+
+def error_line(custom_id, exception):
+    return {
+        "id": "batch_req_" + uuid.uuid4().hex,
+        "custom_id": custom_id,
+        "response": None,
+        "error": {"code": type(exception).__name__, "message": str(exception)},
+    }
+
+def make_client(model, base_url=None, api_key_env=None, max_retries=6, backends=None):
+    client = APIClient(argparse.Namespace(model=model, debug=False, max_retries=max_retries, backends=backends))
+    if base_url:
+        # an explicit endpoint takes precedence over the route of the backend registry
+        client.route = None
+        client.client_kwargs.update({"base_url": base_url, "api_key": os.environ.get(api_key_env or "OPENAI_API_KEY")})
+    return client
+
+# the choices of separate requests as one completion with n choices, as returned by a provider which supports n
+def merge_completions(completions):
+    choices = [completion.choices[0].model_copy(update={"index": idx}) for idx, completion in enumerate(completions)]
+    usage = completions[0].usage
+    if all(completion.usage is not None for completion in completions):
+        usage = usage.model_copy(update={name: sum(getattr(completion.usage, name) for completion in completions) for name in ["prompt_tokens", "completion_tokens", "total_tokens"]})
+    return completions[0].model_copy(update={"choices": choices, "usage": usage})
+
+# a request with n choices is sent as n separate requests if the provider does not support n (or returns fewer choices),
+# so that the output has the same shape for all providers, every request holds its own slot of the semaphore
+async def create_completion(client, body, semaphore):
+    n = int(body.get("n", 1))
+    if n == 1 or client.supports_n:
+        async with semaphore:
+            completion, attempt = await client.async_create(body)
+        if len(completion.choices) >= n:
+            return completion
+        client.disable_n()
+
+    single_body = {key: value for key, value in body.items() if key != "n"}
+
+    async def create_single():
+        async with semaphore:
+            return (await client.async_create(single_body))[0]
+
+    return merge_completions(await asyncio.gather(*[create_single() for _ in range(n)]))
+
+# run the requests of a batch file with bounded parallelism, the client retries transient errors
+async def run_local_batch(input_file, output_file=None, concurrency=16, base_url=None, api_key_env=None, max_retries=6, clients=None, backends=None):
+    output_file, error_file = output_paths(input_file, output_file)
+    requests = read_requests(input_file, completed_ids(output_file))
+    clients = clients if clients is not None else {}
+    stats = {"completed": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(int(concurrency))
+    start = time.time()
+
+    with open(output_file, "a", encoding="utf-8") as output, open(error_file, "a", encoding="utf-8") as errors:
+        async def worker():
+            # the workers share the request iterator, so that the batch file is streamed
+            for request in requests:
+                body = request["body"]
+                if body["model"] not in clients:
+                    clients[body["model"]] = make_client(body["model"], base_url, api_key_env, max_retries, backends)
+                try:
+                    completion = await create_completion(clients[body["model"]], body, semaphore)
+                    output.write(json.dumps(output_line(request["custom_id"], completion)) + "\n")
+                    stats["completed"] += 1
+                except Exception as exception:
+                    errors.write(json.dumps(error_line(request["custom_id"], exception)) + "\n")
+                    stats["failed"] += 1
+
+        await asyncio.gather(*[worker() for _ in range(int(concurrency))])
+
+    if os.path.exists(error_file) and os.path.getsize(error_file) == 0:
+        os.remove(error_file)
+    print("Ran {completed} requests ({failed} failed) of".format(**stats), input_file, "in {:.1f}s".format(time.time() - start))
+
+    return output_file, stats
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    load_dotenv()
+
+    if args.output and len(args.input) > 1:
+        raise Exception("--output can only be used with a single batch file")
+
+    for input_file in args.input:
+        output_file, stats = asyncio.run(run_local_batch(input_file, args.output, args.concurrency, args.base_url, args.api_key_env, int(args.max_retries), backends=args.backends))
+        print("Read the results with: python read_batch_results.py --output_file {} --description <model/target_prompt/bias/context>".format(output_file))
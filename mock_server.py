@@ -0,0 +1,304 @@
+import argparse
+import email.parser
+import email.policy
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# server options, which are shared with the load test harness
+options = argparse.ArgumentParser(add_help=False)
+options.add_argument("--host", default="127.0.0.1", help="Host of the mock server")
+options.add_argument("--port", default=8000, help="Port of the mock server (0 selects a free port)")
+options.add_argument("--latency", default="lognormal", choices=["fixed", "uniform", "exponential", "lognormal"], help="Distribution of the response latency")
+options.add_argument("--latency_mean", default=0.5, help="Mean response latency in seconds")
+options.add_argument("--latency_sigma", default=0.5, help="Sigma of the lognormal latency distribution")
+options.add_argument("--rate_429", default=0.0, help="Share of chat requests which are randomly throttled (429)")
+options.add_argument("--rate_500", default=0.0, help="Share of chat and batch requests which fail with a server error (500)")
+options.add_argument("--rpm", default=0, help="Requests per minute after which the server throttles (0 disables the limit)")
+options.add_argument("--batch_duration", default=5, help="Seconds until a submitted batch is completed")
+options.add_argument("--seed", default=None, help="Seed of the random latencies, errors and answers")
+
+parser = argparse.ArgumentParser(prog="MockServer", description="Local OpenAI compatible server for offline load tests", parents=[options])
+
+UNIT_PATTERN = re.compile(r"number in '([^']*)'")
+
+def sample_latency(distribution, mean, sigma, rng):
+    if mean <= 0:
+        return 0.0
+    if distribution == "uniform":
+        return rng.uniform(0, 2 * mean)
+    if distribution == "exponential":
+        return rng.expovariate(1 / mean)
+    if distribution == "lognormal":
+        return rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+    return mean
+
+# estimates are spread over several orders of magnitude, with the unit of the target prompt
+def synthetic_answer(messages, rng):
+    prompt = messages[-1]["content"] if messages else ""
+    match = UNIT_PATTERN.search(prompt)
+    if match is None:
+        return "Mock response with a reasonable guess."
+    number = float("{:.3g}".format(10 ** rng.uniform(0, 10)))
+    return "Answer: {} {}".format(int(number) if number >= 1 else number, match.group(1))
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+class MockState:
+    def __init__(self, args):
+        self.latency = args.latency
+        self.latency_mean = float(args.latency_mean)
+        self.latency_sigma = float(args.latency_sigma)
+        self.rate_429 = float(args.rate_429)
+        self.rate_500 = float(args.rate_500)
+        self.rpm = float(args.rpm)
+        self.batch_duration = float(args.batch_duration)
+        self.rng = random.Random(int(args.seed) if args.seed is not None else None)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.request_times = deque()
+        self.latencies = []
+        self.status_counts = {}
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def record(self, status, latency=None):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    # sliding window of the last minute, requests above the limit are throttled
+    def throttled(self):
+        if self.rpm <= 0:
+            return False
+        now = time.time()
+        with self.lock:
+            while self.request_times and now - self.request_times[0] > 60:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.rpm:
+                return True
+            self.request_times.append(now)
+            return False
+
+    def completion(self, body):
+        n = int(body.get("n", 1))
+        with self.lock:
+            contents = [synthetic_answer(body.get("messages", []), self.rng) for idx in range(n)]
+        prompt_tokens = sum(count_tokens(message.get("content") or "") for message in body.get("messages", []))
+        completion_tokens = sum(count_tokens(content) for content in contents)
+        return {
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": idx, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for idx, content in enumerate(contents)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def add_file(self, content, filename, purpose):
+        file = {"id": "file-" + uuid.uuid4().hex, "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file["id"]] = (file, content)
+        return file
+
+    def create_batch(self, body):
+        batch = {
+            "id": "batch_" + uuid.uuid4().hex,
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self.run_batch, args=(batch["id"],), daemon=True).start()
+        return batch
+
+    def update_batch(self, batch_id, **values):
+        with self.lock:
+            self.batches[batch_id].update(values)
+            return dict(self.batches[batch_id])
+
+    # the requests of a batch are answered without latency, the batch is completed after the batch duration
+    def run_batch(self, batch_id):
+        batch = self.update_batch(batch_id, status="in_progress", in_progress_at=int(time.time()))
+        content = self.files[batch["input_file_id"]][1].decode("utf-8")
+        outputs, errors = [], []
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            item = {"id": "batch_req_" + uuid.uuid4().hex, "custom_id": request["custom_id"], "error": None}
+            if self.random() < self.rate_500:
+                item["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex, "body": {"error": {"message": "Injected server error", "type": "server_error"}}}
+                errors.append(item)
+            else:
+                item["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.completion(request["body"])}
+                outputs.append(item)
+
+        time.sleep(self.batch_duration)
+        with self.lock:
+            cancelled = self.batches[batch_id]["status"] == "cancelling"
+        if cancelled:
+            self.update_batch(batch_id, status="cancelled", cancelled_at=int(time.time()))
+            return
+
+        to_jsonl = lambda items: "".join(json.dumps(item) + "\n" for item in items).encode("utf-8")
+        output_file = self.add_file(to_jsonl(outputs), batch_id + "_output.jsonl", "batch_output")
+        error_file = self.add_file(to_jsonl(errors), batch_id + "_error.jsonl", "batch_output") if errors else None
+        self.update_batch(
+            batch_id,
+            status="completed",
+            completed_at=int(time.time()),
+            output_file_id=output_file["id"],
+            error_file_id=error_file["id"] if error_file else None,
+            request_counts={"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)},
+        )
+
+    def stats(self):
+        with self.lock:
+            return {"status_counts": dict(self.status_counts), "latencies": list(self.latencies)}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def send(self, status, payload, headers=None, content_type="application/json"):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, error_type, headers=None):
+        self.send(status, {"error": {"message": message, "type": error_type, "code": error_type}}, headers)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+
+        if path == "/stats":
+            return self.send(200, self.state.stats())
+        if path.startswith("/v1/files/") and path.endswith("/content"):
+            file = self.state.files.get(parts[3])
+            if file is None:
+                return self.send_error_json(404, "No such file", "not_found")
+            return self.send(200, file[1], content_type="application/octet-stream")
+        if path.startswith("/v1/files/"):
+            file = self.state.files.get(parts[3])
+            if file is None:
+                return self.send_error_json(404, "No such file", "not_found")
+            return self.send(200, file[0])
+        if path.startswith("/v1/batches/"):
+            batch = self.state.batches.get(parts[3])
+            if batch is None:
+                return self.send_error_json(404, "No such batch", "not_found")
+            return self.send(200, batch)
+
+        self.send_error_json(404, "Unknown endpoint " + path, "not_found")
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.read_body()
+
+        if path == "/v1/chat/completions":
+            return self.chat_completion(json.loads(body))
+        if path == "/v1/files":
+            return self.upload_file(body)
+        if path == "/v1/batches":
+            body = json.loads(body)
+            if body.get("input_file_id") not in self.state.files:
+                return self.send_error_json(400, "No such input file", "invalid_request_error")
+            return self.send(200, self.state.create_batch(body))
+        if path.startswith("/v1/batches/") and path.endswith("/cancel"):
+            batch_id = path.split("/")[3]
+            if batch_id not in self.state.batches:
+                return self.send_error_json(404, "No such batch", "not_found")
+            return self.send(200, self.state.update_batch(batch_id, status="cancelling"))
+
+        self.send_error_json(404, "Unknown endpoint " + path, "not_found")
+
+    def chat_completion(self, body):
+        start = time.time()
+        if self.state.throttled() or self.state.random() < self.state.rate_429:
+            self.state.record(429)
+            retry_after = 0.5 + self.state.random()
+            return self.send_error_json(429, "Rate limit reached", "rate_limit_exceeded", {"retry-after-ms": str(int(retry_after * 1000))})
+
+        with self.state.lock:
+            latency = sample_latency(self.state.latency, self.state.latency_mean, self.state.latency_sigma, self.state.rng)
+        time.sleep(latency)
+
+        if self.state.random() < self.state.rate_500:
+            self.state.record(500)
+            return self.send_error_json(500, "Injected server error", "server_error")
+
+        self.send(200, self.state.completion(body))
+        self.state.record(200, time.time() - start)
+
+    # the files endpoint receives multipart form data with the purpose and the file
+    def upload_file(self, body):
+        header = "Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"]).encode("utf-8")
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+        fields, content, filename = {}, b"", "upload.jsonl"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                content = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            else:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        self.send(200, self.state.add_file(content, filename, fields.get("purpose", "batch")))
+
+def start_server(args):
+    server = ThreadingHTTPServer((args.host, int(args.port)), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def base_url(server):
+    host, port = server.server_address[:2]
+    return "http://{}:{}/v1".format(host, port)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, int(args.port)), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(args)
+    print("Mock server listening on", base_url(server))
+    print("Point the scripts to it with OPENAI_BASE_URL={} and any OPENAI_API_KEY".format(base_url(server)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+# default quotas per provider, they can be overridden with the environment variables
+# <PROVIDER>_RPM and <PROVIDER>_TPM (e.g. OPENAI_RPM=5000)
+PROVIDER_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 150000},
+    "together": {"rpm": 600, "tpm": 1000000},
+}
+
+RETRY_STATUS_CODES = [408, 409, 429]
+
+
+class TokenBucket:
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # take the amount from the bucket and return how long the caller has to wait for it
+    def reserve(self, amount, now):
+        self.refill(now)
+        amount = min(float(amount), self.capacity)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    # reserve one request and the estimated tokens, returns the delay before the request can be sent
+    def reserve(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            return max(delay, self.blocked_until - now)
+
+    def acquire(self, tokens):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def async_acquire(self, tokens):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # correct the token estimate with the usage reported by the API
+    def update(self, estimated_tokens, usage):
+        if usage is None or getattr(usage, "total_tokens", None) is None:
+            return
+        with self.lock:
+            self.tokens.give_back(estimated_tokens - usage.total_tokens)
+
+    # block all requests sharing this limiter after the provider signalled throttling
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+# return the rate limiter of the provider, which is shared by all clients of the process
+def get_rate_limiter(provider):
+    with rate_limiters_lock:
+        if provider not in rate_limiters:
+            limits = PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["openai"])
+            rpm = float(os.environ.get("{}_RPM".format(provider.upper()), limits["rpm"]))
+            tpm = float(os.environ.get("{}_TPM".format(provider.upper()), limits["tpm"]))
+            rate_limiters[provider] = RateLimiter(rpm, tpm)
+        return rate_limiters[provider]
+
+
+# rough token estimate (~4 characters per token) plus the maximum completion length
+def estimate_tokens(messages, max_tokens):
+    characters = sum(len(message["content"] or "") for message in messages)
+    return characters // 4 + max_tokens
+
+
+def get_status_code(exception):
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None and getattr(exception, "response", None) is not None:
+        status_code = getattr(exception.response, "status_code", None)
+    return status_code
+
+
+def is_retryable(exception):
+    status_code = get_status_code(exception)
+    if status_code is None:
+        # connection errors and timeouts do not have a status code
+        return type(exception).__name__ in ["APIConnectionError", "APITimeoutError"]
+    return status_code in RETRY_STATUS_CODES or status_code >= 500
+
+
+def get_retry_after(exception):
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after"):
+            return float(headers.get("retry-after"))
+    except ValueError:
+        # Retry-After can also be an HTTP date, which is treated like a missing header
+        pass
+    return None
+
+
+# jittered exponential backoff, the Retry-After header of the provider takes precedence
+def backoff_delay(attempt, retry_after=None, base=1.0, maximum=60.0):
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import time
+
+parser = argparse.ArgumentParser(prog="Telemetry", description="Summarize the metrics logs of experiment runs and batch ingestions")
+parser.add_argument("metrics", nargs="+", help="Metrics logs (JSONL) to summarize")
+
+GROUP_LABELS = ["model", "context_bias", "target_prompt"]
+
+# nearest rank percentile
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds) if hours else "{}m{:02d}s".format(minutes, seconds)
+
+# one line per request in the metrics log, with the labels of the run
+class Telemetry:
+    def __init__(self, path=None, labels=None, total=None, interval=10, max_tokens=None):
+        self.path = path
+        self.labels = labels or {}
+        self.total = total
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.records = []
+        self.start = time.time()
+        self.last_progress = self.start
+        self.file = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    def record(self, latency=None, usage=None, finish_reasons=(), retries=0, error=None, cached=False, **labels):
+        record = {"time": round(time.time(), 3), **self.labels, **labels}
+        if latency is not None:
+            record["latency"] = round(latency, 4)
+        if usage:
+            record["prompt_tokens"] = usage.get("prompt_tokens", 0)
+            record["completion_tokens"] = usage.get("completion_tokens", 0)
+        if finish_reasons:
+            record["finish_reasons"] = list(finish_reasons)
+        if retries:
+            record["retries"] = retries
+        if error:
+            record["error"] = error
+        if cached:
+            record["cached"] = True
+
+        self.records.append(record)
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        if "length" in record.get("finish_reasons", []):
+            print("Truncated response (finish_reason=length) at max_tokens={} for {}".format(self.max_tokens, ", ".join("{}={}".format(key, value) for key, value in labels.items() or self.labels.items())))
+
+        self.progress()
+        return record
+
+    # completions of the OpenAI client (or mocked completions in debug mode)
+    def record_completion(self, completion, latency, retries=0, cached=False, **labels):
+        usage = completion.usage.model_dump() if getattr(completion, "usage", None) is not None else None
+        finish_reasons = [choice.finish_reason for choice in completion.choices]
+        return self.record(latency, usage, finish_reasons, retries, cached=cached, **labels)
+
+    # response bodies of batch outputs, which have no latency
+    def record_response(self, body, error=None, **labels):
+        body = body or {}
+        finish_reasons = [choice.get("finish_reason") for choice in body.get("choices") or []]
+        return self.record(None, body.get("usage"), finish_reasons, error=error, **labels)
+
+    def progress(self, force=False):
+        now = time.time()
+        if not force and now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+
+        done = len(self.records)
+        elapsed = max(now - self.start, 1e-9)
+        rate = done / elapsed
+        tokens = sum(record.get("prompt_tokens", 0) + record.get("completion_tokens", 0) for record in self.records)
+        message = "[{}] {} requests, {:.2f} req/s, {:.0f} tokens/s".format(format_duration(elapsed), done, rate, tokens / elapsed)
+        if self.total:
+            eta = (self.total - done) / rate if rate > 0 else None
+            message += ", {}/{} ({:.0%}), ETA {}".format(done, self.total, done / self.total, format_duration(max(eta, 0) if eta is not None else None))
+        print(message)
+
+    def report(self):
+        print_report(self.records, self.max_tokens)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def summarize(records):
+    groups = {}
+    for record in records:
+        key = tuple(record.get(label, "") for label in GROUP_LABELS)
+        groups.setdefault(key, []).append(record)
+
+    summary = []
+    for key, group in sorted(groups.items(), key=lambda item: tuple(str(value) for value in item[0])):
+        latencies = [record["latency"] for record in group if "latency" in record and not record.get("cached") and not record.get("error")]
+        finish_reasons = [reason for record in group for reason in record.get("finish_reasons", [])]
+        summary.append({
+            **dict(zip(GROUP_LABELS, key)),
+            "requests": len(group),
+            "cached": sum(1 for record in group if record.get("cached")),
+            "errors": sum(1 for record in group if record.get("error")),
+            "retries": sum(record.get("retries", 0) for record in group),
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "prompt_tokens": sum(record.get("prompt_tokens", 0) for record in group),
+            "completion_tokens": sum(record.get("completion_tokens", 0) for record in group),
+            "responses": len(finish_reasons),
+            "truncated": finish_reasons.count("length"),
+        })
+
+    return summary
+
+def print_report(records, max_tokens=None):
+    summary = summarize(records)
+    columns = GROUP_LABELS + ["requests", "cached", "errors", "retries", "latency_mean", "latency_p50", "latency_p99", "prompt_tokens", "completion_tokens", "truncated"]
+    rows = [[("{:.3f}".format(row[column]) if isinstance(row[column], float) else str(row[column])) for column in columns] for row in summary]
+    widths = [max([len(column)] + [len(row[idx]) for row in rows]) for idx, column in enumerate(columns)]
+
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+    truncated = sum(row["truncated"] for row in summary)
+    if truncated:
+        print("{} responses were truncated at max_tokens{} and will likely have no extractable answer".format(truncated, "=" + str(max_tokens) if max_tokens else ""))
+
+    return summary
+
+def load_metrics(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print_report(load_metrics(args.metrics))
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+EVALUATION_FOLDER = os.path.join(ROOT, "fermi_problem_evaluation")
+
+# the scripts import their neighbours from their own folder and the shared modules from the repository root
+for folder in [ROOT, EVALUATION_FOLDER, os.path.join(ROOT, "context_question_generation")]:
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
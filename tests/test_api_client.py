@@ -0,0 +1,40 @@
+import argparse
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from utils import APIClient
+
+# a provider which ignores n and returns a single choice per call
+def single_choice(sample):
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=SimpleNamespace(content="sample {}".format(sample)))])
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    return APIClient(argparse.Namespace(model="gpt-4o", debug=False))
+
+def test_ignored_n_disables_multi_choice_calls(client):
+    client.api_call = lambda messages, sample=0, n=1: single_choice(sample)
+
+    assert client.sample_responses([], [0, 1, 2]) == ["sample 0", "sample 1", "sample 2"]
+    assert client.supports_n is False
+
+def test_separate_async_calls_hold_a_slot_each(client):
+    calls = {"in_flight": 0, "peak": 0}
+
+    async def async_api_call(messages, sample=0, n=1):
+        calls["in_flight"] += 1
+        calls["peak"] = max(calls["peak"], calls["in_flight"])
+        await asyncio.sleep(0.01)
+        calls["in_flight"] -= 1
+        return single_choice(sample)
+
+    async def sample():
+        return await client.async_sample_responses([], [0, 1, 2, 3, 4], asyncio.Semaphore(2))
+
+    client.async_api_call = async_api_call
+    assert asyncio.run(sample()) == ["sample {}".format(idx) for idx in range(5)]
+    assert client.supports_n is False
+    assert calls["peak"] == 2
@@ -0,0 +1,32 @@
+import json
+
+from batch_ingestion import IdIndex, append_csv, ingest_batch
+
+def output_line(custom_id, content):
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": {"choices": [{"index": 0, "message": {"content": content}}]}}})
+
+def create_rows(custom_id, answers):
+    return [{"id": custom_id, "response": answer} for answer in answers]
+
+def row_id(row):
+    return row["id"]
+
+def test_index_is_rebuilt_after_the_result_file_changed(tmp_path):
+    filepath = str(tmp_path / "results.csv")
+    stats = ingest_batch([output_line("a", "1"), output_line("b", "2")], create_rows, filepath, row_id)
+    assert stats["rows"] == 2
+
+    # rows appended without the index, e.g. by the compaction of a journal
+    append_csv(filepath, [{"id": "c", "response": "3"}])
+    assert "c" in IdIndex(filepath, row_id)
+
+    stats = ingest_batch([output_line("a", "1"), output_line("c", "3"), output_line("d", "4")], create_rows, filepath, row_id)
+    assert (stats["rows"], stats["duplicates"]) == (1, 2)
+
+def test_index_of_a_removed_result_file_is_discarded(tmp_path):
+    filepath = tmp_path / "results.csv"
+    ingest_batch([output_line("a", "1")], create_rows, str(filepath), row_id)
+    filepath.unlink()
+
+    assert "a" not in IdIndex(str(filepath), row_id)
+    assert ingest_batch([output_line("a", "1")], create_rows, str(filepath), row_id)["rows"] == 1
@@ -0,0 +1,38 @@
+import json
+from types import SimpleNamespace
+
+import batch_orchestrator
+from batch_orchestrator import BatchManifest, wait_for_batches
+
+# connection errors have no status code and are retried
+class APIConnectionError(Exception):
+    pass
+
+class FakeBatches:
+    def __init__(self, batches, failures):
+        self.batches = batches
+        self.failures = failures
+
+    def retrieve(self, batch_id):
+        if self.failures:
+            self.failures -= 1
+            raise APIConnectionError("connection reset")
+        return self.batches[batch_id]
+
+def test_expired_batches_are_ingested_after_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_orchestrator.time, "sleep", lambda seconds: None)
+    output_file = tmp_path / "output.jsonl"
+    output_file.write_text(json.dumps({"custom_id": "0/0"}) + "\n", encoding="utf-8")
+
+    manifest = BatchManifest(str(tmp_path / "manifest.json"))
+    manifest.add({"batch_id": "batch_1", "kind": "target", "status": "in_progress", "ingested": False})
+    request_counts = SimpleNamespace(completed=1, total=2)
+    batch = SimpleNamespace(status="expired", output_file_id=str(output_file), error_file_id=None, request_counts=request_counts)
+    client = SimpleNamespace(batches=FakeBatches({"batch_1": batch}, failures=2))
+
+    ingested = []
+    pending = wait_for_batches(client, manifest, lambda entry, lines: ingested.extend(lines), interval=0)
+
+    assert pending == []
+    assert [json.loads(line)["custom_id"] for line in ingested] == ["0/0"]
+    assert BatchManifest(manifest.path).entries[0]["status"] == "expired"
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import pytest
+
+import mock_server
+from local_batch import make_client, run_local_batch
+from utils import batch_call
+
+@pytest.fixture
+def server():
+    args = mock_server.parser.parse_args(["--port", "0", "--latency_mean", "0", "--seed", "1"])
+    server = mock_server.start_server(args)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def write_batch(path, n=1):
+    messages = [{"role": "user", "content": "How many piano tuners are there in Chicago?"}]
+    with open(path, "w", encoding="utf-8") as f:
+        for idx in range(3):
+            f.write(json.dumps(batch_call("mock-model", messages, "{}/0".format(idx), n)) + "\n")
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def run(input_file, server, clients=None):
+    clients = clients if clients is not None else {"mock-model": make_client("mock-model", mock_server.base_url(server), max_retries=0)}
+    return asyncio.run(run_local_batch(str(input_file), concurrency=2, clients=clients))
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+
+def test_output_has_the_shape_of_a_batch_output(tmp_path, server):
+    input_file = tmp_path / "test_batch.jsonl"
+    write_batch(input_file)
+
+    output_file, stats = run(input_file, server)
+    assert stats == {"completed": 3, "failed": 0}
+
+    lines = read_lines(output_file)
+    assert sorted(line["custom_id"] for line in lines) == ["0/0", "1/0", "2/0"]
+    for line in lines:
+        assert line["error"] is None and line["response"]["status_code"] == 200
+        assert line["response"]["body"]["choices"][0]["message"]["content"]
+
+def test_resumed_batch_skips_completed_requests(tmp_path, server):
+    input_file = tmp_path / "test_batch.jsonl"
+    write_batch(input_file)
+    output_file, _ = run(input_file, server)
+
+    _, stats = run(input_file, server)
+    assert stats == {"completed": 0, "failed": 0}
+    assert len(read_lines(output_file)) == 3
+
+def test_failed_requests_are_written_to_the_error_file(tmp_path, server):
+    server.state.rate_500 = 1.0
+    input_file = tmp_path / "test_batch.jsonl"
+    write_batch(input_file)
+
+    output_file, stats = run(input_file, server)
+    assert stats == {"completed": 0, "failed": 3}
+    assert read_lines(output_file) == []
+    errors = read_lines(tmp_path / "test_batch_output_errors.jsonl")
+    assert sorted(error["custom_id"] for error in errors) == ["0/0", "1/0", "2/0"]
+    assert all(error["response"] is None and error["error"]["code"] for error in errors)
+
+def test_choices_are_requested_separately_without_n(tmp_path, server):
+    input_file = tmp_path / "test_batch.jsonl"
+    write_batch(input_file, n=4)
+    client = make_client("mock-model", mock_server.base_url(server), max_retries=0)
+    client.supports_n = False
+
+    output_file, stats = run(input_file, server, {"mock-model": client})
+    assert stats == {"completed": 3, "failed": 0}
+    for line in read_lines(output_file):
+        assert [choice["index"] for choice in line["response"]["body"]["choices"]] == [0, 1, 2, 3]
+    assert server.state.status_counts[200] == 12
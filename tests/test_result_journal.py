@@ -0,0 +1,41 @@
+import csv
+
+from result_journal import ResultJournal, compact_journal
+
+FILE = "model/onlyanswer/general_target_responses.csv"
+
+def target_row(target_id, sample, experiment_type, response):
+    return {"target_id": target_id, "sample": sample, "model": "model", "context": "human", "context_prompt": "simple", "context_bias": "general", "target_prompt": "onlyanswer", "experiment_type": experiment_type, "response": response}
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+def test_compaction_orders_rows_as_synchronous_runs(tmp_path):
+    journal = ResultJournal(str(tmp_path / "journals" / "run.jsonl"), str(tmp_path))
+    # completion order of concurrent calls
+    for target_id, sample, experiment_type in [(10, 1, "increase"), (2, 0, "increase"), (10, 0, "decrease"), (2, 1, "decrease"), (2, 0, "decrease")]:
+        journal.append(FILE, target_row(target_id, sample, experiment_type, "answer"))
+    journal.close()
+
+    assert compact_journal(journal.path, str(tmp_path)) == 5
+    rows = read_rows(tmp_path / FILE)
+    assert [(row["target_id"], row["experiment_type"], row["sample"]) for row in rows] == [
+        ("2", "decrease", "0"), ("2", "decrease", "1"), ("2", "increase", "0"), ("10", "decrease", "0"), ("10", "increase", "1"),
+    ]
+
+def test_saved_samples_are_recorded_without_resume(tmp_path):
+    journal = ResultJournal(str(tmp_path / "journals" / "run.jsonl"), str(tmp_path))
+    journal.append(FILE, target_row(0, 0, "decrease", "first"))
+    journal.close()
+    compact_journal(journal.path, str(tmp_path))
+
+    # a rerun with the same parameters finds the saved sample in the result file
+    journal = ResultJournal(str(tmp_path / "journals" / "run.jsonl"), str(tmp_path))
+    assert journal.recorded(FILE, target_row(0, 0, "decrease", None)) == "first"
+    assert journal.recorded(FILE, target_row(0, 1, "decrease", None)) is None
+    journal.append(FILE, target_row(0, 1, "decrease", "second"))
+    journal.close()
+
+    assert compact_journal(journal.path, str(tmp_path)) == 1
+    assert [row["response"] for row in read_rows(tmp_path / FILE)] == ["first", "second"]
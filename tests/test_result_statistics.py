@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import EVALUATION_FOLDER
+from result_statistics import GROUP_COLUMNS, compute_statistics, describe_convert, filter_answers
+
+PROCESSED_ANSWERS = os.path.join(EVALUATION_FOLDER, "saved_states", "processed_answers.pkl")
+
+# the aggregation has to reproduce describe_convert exactly, including mean and std, the saved statistics are compared across versions
+@pytest.mark.skipif(not os.path.exists(PROCESSED_ANSWERS), reason="no processed answers")
+def test_aggregation_matches_describe_exactly():
+    answers = filter_answers(pd.read_pickle(PROCESSED_ANSWERS))
+    answers = answers[answers["target_id"] < 10]
+
+    for format, statistics in zip(["order_of_magnitude", "number"], compute_statistics(answers)):
+        expected = pd.DataFrame([describe_convert(group, key, format) for key, group in answers.groupby(GROUP_COLUMNS)])
+        expected = expected.set_index(GROUP_COLUMNS).sort_index()
+        actual = statistics.set_index(GROUP_COLUMNS).sort_index()
+
+        assert expected.index.equals(actual.index)
+        for column in ["min", "max", "mean", "50%", "std", "unique", "num_valid_answers"]:
+            np.testing.assert_array_equal(actual[column].astype(float), expected[column].astype(float), err_msg=format + " " + column)
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from result_store import load_results, migrate, sync_store
+
+def target_rows(target_ids, response="answer"):
+    return pd.DataFrame([
+        {"target_id": target_id, "sample": 0, "model": "model", "context": "human", "context_prompt": "simple", "context_bias": "general", "target_prompt": "onlyanswer", "experiment_type": "increase", "response": response}
+        for target_id in target_ids
+    ])
+
+@pytest.fixture
+def result_file(tmp_path):
+    filepath = tmp_path / "results" / "model" / "onlyanswer" / "general_target_responses.csv"
+    os.makedirs(filepath.parent)
+    target_rows([0, 1]).to_csv(filepath, index=False)
+    return filepath
+
+def test_sync_appends_new_rows_of_the_result_files(tmp_path, result_file):
+    results, store = str(tmp_path / "results"), str(tmp_path / "store")
+    assert migrate(results, store) == 2
+    assert sync_store(results, store) == 0
+
+    target_rows([2, 3]).to_csv(result_file, mode="a", header=False, index=False)
+    assert sync_store(results, store) == 2
+    assert sync_store(results, store) == 0
+    assert sorted(load_results(store)["target_id"]) == [0, 1, 2, 3]
+
+def test_sync_rejects_rewritten_result_files(tmp_path, result_file):
+    results, store = str(tmp_path / "results"), str(tmp_path / "store")
+    migrate(results, store)
+
+    target_rows([0]).to_csv(result_file, index=False)
+    with pytest.raises(Exception, match="migrate again"):
+        sync_store(results, store)
+
+def test_ingestion_appends_to_the_store(tmp_path, result_file):
+    from batch_ingestion import append_csv, ingest_batch
+    from read_batch_results import store_writer
+
+    results, store = str(tmp_path / "results"), str(tmp_path / "store")
+    migrate(results, store)
+    # rows which were appended to the result file without the store, e.g. by a compaction
+    append_csv(str(result_file), target_rows([2]).to_dict("records"))
+
+    lines = [json.dumps({"custom_id": str(target_id), "response": {"body": {"choices": [{"message": {"content": "answer"}}]}}}) for target_id in [3, 4]]
+    create_rows = lambda custom_id, answers: target_rows([int(custom_id)], answers[0]).to_dict("records")
+    ingest_batch(lines, create_rows, str(result_file), lambda row: str(row["target_id"]), write_rows=store_writer(store, results))
+
+    assert sorted(load_results(store)["target_id"]) == [0, 1, 2, 3, 4]
+    assert sync_store(results, store) == 0
@@ -0,0 +1,52 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from significance import enumerate_assignments, permutation_pvalues
+
+# share of all subsets of the pooled answers, whose median difference is at least as extreme as the observed one
+def brute_force_share(condition, baseline):
+    pooled = np.concatenate([condition, baseline])
+    observed = abs(np.median(condition) - np.median(baseline))
+    extreme = []
+    for subset in itertools.combinations(range(len(pooled)), len(condition)):
+        mask = np.zeros(len(pooled), dtype=bool)
+        mask[list(subset)] = True
+        extreme.append(abs(np.median(pooled[mask]) - np.median(pooled[~mask])) >= observed - 1e-9)
+    return np.mean(extreme)
+
+def test_assignments_cover_all_permutations():
+    assignments, probabilities = enumerate_assignments(np.array([3, 1, 4, 2]), 5)
+    assert probabilities.sum() == pytest.approx(1)
+    assert (assignments.sum(axis=1) == 5).all()
+    assert len(np.unique(assignments, axis=0)) == len(assignments)
+
+# few distinct values are tested exactly
+def test_exact_pvalues_match_all_permutations():
+    condition, baseline = np.array([2, 3, 3, 4, 4, 4], dtype=float), np.array([1, 2, 2, 3, 3, 5], dtype=float)
+    observed = np.array([np.median(condition) - np.median(baseline)])
+
+    pvalue = permutation_pvalues(np.random.default_rng(0), [condition], [baseline], observed, 10000)[0]
+    assert pvalue == pytest.approx(brute_force_share(condition, baseline), rel=1e-12)
+
+# many distinct values are tested with drawn permutations
+def test_drawn_pvalues_match_all_permutations():
+    condition, baseline = np.array([0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5]), np.array([0.1, 1.1, 2.2, 3.3, 4.4, 5.6, 6.6, 7.7])
+    observed = np.array([np.median(condition) - np.median(baseline)])
+
+    pvalue = permutation_pvalues(np.random.default_rng(0), [condition], [baseline], observed, 20000)[0]
+    assert pvalue == pytest.approx(brute_force_share(condition, baseline), abs=0.01)
+
+# conditions of the same size are permuted together, whether their answers have ties or not
+def test_pvalues_of_a_bucket_match_all_permutations():
+    rng = np.random.default_rng(1)
+    conditions = [rng.integers(0, 3, 5).astype(float), rng.integers(0, 3, 5).astype(float), rng.random(5), rng.random(5) + 0.5]
+    baselines = [rng.integers(0, 4, 6).astype(float), rng.integers(1, 3, 6).astype(float), rng.random(6), rng.random(6)]
+    observed = np.array([np.median(condition) - np.median(baseline) for condition, baseline in zip(conditions, baselines)])
+
+    # the first two conditions have fewer assignments than resamples and are tested exactly
+    pvalues = permutation_pvalues(np.random.default_rng(0), conditions, baselines, observed, 100)
+    shares = [brute_force_share(condition, baseline) for condition, baseline in zip(conditions, baselines)]
+    assert pvalues[:2] == pytest.approx(shares[:2], rel=1e-12)
+    assert pvalues[2:] == pytest.approx(shares[2:], abs=0.15)
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import EVALUATION_FOLDER
+from result_statistics import compute_statistics, filter_answers
+from streaming_statistics import StreamingStatistics
+
+PROCESSED_ANSWERS = os.path.join(EVALUATION_FOLDER, "saved_states", "processed_answers.pkl")
+
+def assert_same_statistics(expected, actual):
+    assert list(expected.columns) == list(actual.columns)
+    for column in expected.columns:
+        if expected[column].dtype.kind in "fi":
+            np.testing.assert_allclose(actual[column].astype(float), expected[column].astype(float), rtol=1e-9, equal_nan=True, err_msg=column)
+        else:
+            assert (actual[column].astype(str) == expected[column].astype(str)).all(), column
+
+# target 35 of gpt-4o has an answer of 8.34e287 and infinite answers, whose variance overflows
+@pytest.mark.skipif(not os.path.exists(PROCESSED_ANSWERS), reason="no processed answers")
+@pytest.mark.parametrize("chunk_size", [997, 5000])
+def test_streaming_statistics_match_with_extreme_answers(chunk_size):
+    answers = pd.read_pickle(PROCESSED_ANSWERS)
+    answers = answers[answers["target_id"].isin([34, 35, 36])].reset_index(drop=True)
+    assert np.isinf(answers["number"].astype(float)).any() and (answers["number"].astype(float) > 1e287).any()
+
+    statistics = StreamingStatistics()
+    for start in range(0, len(answers), chunk_size):
+        statistics.update(answers.iloc[start:start + chunk_size])
+
+    oom_df, num_df = compute_statistics(filter_answers(answers))
+    assert_same_statistics(oom_df, statistics.statistics("order_of_magnitude"))
+    assert_same_statistics(num_df, statistics.statistics("number"))
@@ -1,24 +1,53 @@
-from openai.types.chat import ChatCompletionMessage
-from openai.types.chat.chat_completion import ChatCompletion, Choice
 import json
 import pickle
 import time
 import os
-import pandas as pd
-from openai import OpenAI
+import asyncio
+from response_cache import ResponseCache, cache_key
+from rate_limiter import get_rate_limiter, estimate_tokens, is_retryable, get_retry_after, get_status_code, backoff_delay
+from backends import get_route
+
+# sampling parameters shared by synchronous, asynchronous and batch requests
+SAMPLING_PARAMS = {
+    "temperature": float(0.8),
+    "max_tokens": 512,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0
+}
 
 class APIClient:
     def __init__(self, args):
         self.args = args
-        if "gpt" in args.model:
-            self.client = OpenAI()
+        self.provider = "openai"
+        # retries are handled by the client wrapper, so that they share the rate limiter
+        self.client_kwargs = {"max_retries": 0}
+        # models of the backend registry (--backends or BACKENDS_CONFIG) are routed to the least loaded of their endpoints
+        self.route = get_route(args.model, getattr(args, "backends", None))
+        if self.route is not None:
+            self.provider = "backends"
         elif "llama" in args.model:
-            self.args.model = "meta-llama/" + args.model
-            self.client = OpenAI(
-                api_key=os.environ.get("TOGETHER_API_KEY"),
-                base_url="https://api.together.xyz/v1",
-            )
-            self.args.as_batch = False
+            if not args.model.startswith("meta-llama/"):
+                self.args.model = "meta-llama/" + args.model
+            self.provider = "together"
+            self.client_kwargs.update({
+                "api_key": os.environ.get("TOGETHER_API_KEY"),
+                "base_url": "https://api.together.xyz/v1",
+            })
+        # providers without a batch API run batch files with the local batch executor
+        self.has_batch_api = self.provider == "openai"
+        # the OpenAI client is only imported for requests, so that scripts which do not send any start quickly
+        self.client = new_client(self.client_kwargs) if self.route is None else None
+        self.rate_limiter = get_rate_limiter(self.provider) if self.route is None else self.route.rate_limiter
+        self.max_retries = int(getattr(args, "max_retries", 6))
+        cache_path = getattr(args, "cache", None)
+        self.cache = ResponseCache(cache_path, getattr(args, "cache_size", 1024)) if cache_path else None
+        # the async client is only created if asynchronous calls are used
+        self.async_client = None
+        # several samples are requested in one call with the n parameter, unless the provider rejects it
+        self.supports_n = self.provider == "openai" if self.route is None else self.route.supports_n
+        # optional Telemetry, which records the latency, usage and finish reasons of every request
+        self.telemetry = None
     
     def return_client_args(self):
         return self, self.args
@@ -27,6 +56,8 @@ class APIClient:
         return self.client
     
     def construct_prompt(self, question, prompt, history=None):
+        # pandas is imported on use, so that the scripts which import the client start without it
+        import pandas as pd
         if prompt.any() != None:
             items = [el for el in [prompt["prefix"], question, prompt["postfix"]] if el and pd.notna(el)]
             input = {
@@ -50,29 +81,186 @@ class APIClient:
         history.append(new_message)
         return history
 
-    def api_call(self, messages):
+    def mock_completion(self, n=1):
+        from openai.types.chat import ChatCompletionMessage
+        from openai.types.chat.chat_completion import ChatCompletion, Choice
+        mocked_response = "Mock response"
+        choices = [Choice(finish_reason="stop", index=idx, message=ChatCompletionMessage(content=mocked_response, role="assistant")) for idx in range(n)]
+        return ChatCompletion(id="test", model="gpt-3.5-turbo", object="chat.completion", choices=choices, created=int(time.time()))
+
+    def sampling_params(self, n=1):
+        return {**SAMPLING_PARAMS, "n": n} if n > 1 else SAMPLING_PARAMS
+
+    # return the cache key and the cached completion (None if it was not requested before)
+    def cached_completion(self, messages, sample, n=1):
+        if self.cache is None:
+            return None, None
+
+        key = cache_key(self.args.model, messages, self.sampling_params(n), sample)
+        cached = self.cache.get(key)
+        if cached is None:
+            return key, None
+        from openai.types.chat.chat_completion import ChatCompletion
+        return key, ChatCompletion.model_validate_json(cached)
+
+    def store_completion(self, key, completion):
+        if self.cache is not None:
+            self.cache.put(key, self.args.model, completion.model_dump_json())
+
+    def record_completion(self, completion, start, retries=0, cached=False):
+        if self.telemetry is not None:
+            self.telemetry.record_completion(completion, time.perf_counter() - start, retries, cached)
+
+    def api_call(self, messages, sample=0, n=1):
+        start = time.perf_counter()
         if self.args.debug:
-            mocked_response = "Mock response"
-            choice = Choice(finish_reason="stop", index=0, message=ChatCompletionMessage(content=mocked_response, role="assistant"))
-            completion = ChatCompletion(id="test", model="gpt-3.5-turbo", object="chat.completion", choices=[choice], created=int(time.time()))
-        else:
-            completion = self.client.chat.completions.create(
-                    model=self.args.model,
-                    messages=messages,
-                    temperature=0.8,
-                    max_tokens=512,
-                    top_p=1,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-            )
-                
+            # optional simulated latency to benchmark the runners offline
+            time.sleep(float(getattr(self.args, "debug_latency", 0)))
+            completion = self.mock_completion(n)
+            self.record_completion(completion, start)
+            return completion
+
+        key, completion = self.cached_completion(messages, sample, n)
+        if completion is not None:
+            self.record_completion(completion, start, cached=True)
+            return completion
+
+        completion, attempt = self.create({"model": self.args.model, "messages": messages, **self.sampling_params(n)})
+        self.store_completion(key, completion)
+        self.record_completion(completion, start, attempt)
+
         return completion
+
+    async def async_api_call(self, messages, sample=0, n=1):
+        start = time.perf_counter()
+        if self.args.debug:
+            await asyncio.sleep(float(getattr(self.args, "debug_latency", 0)))
+            completion = self.mock_completion(n)
+            self.record_completion(completion, start)
+            return completion
+
+        key, completion = self.cached_completion(messages, sample, n)
+        if completion is not None:
+            self.record_completion(completion, start, cached=True)
+            return completion
+
+        completion, attempt = await self.async_create({"model": self.args.model, "messages": messages, **self.sampling_params(n)})
+        self.store_completion(key, completion)
+        self.record_completion(completion, start, attempt)
+
+        return completion
+
+    # request a completion with the given parameters, throttled by the rate limiter and retried on transient errors
+    def create(self, params):
+        tokens = estimate_tokens(params["messages"], params.get("max_tokens", SAMPLING_PARAMS["max_tokens"]) * params.get("n", 1))
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                completion = self.send(params)
+                break
+            except Exception as exception:
+                time.sleep(self.retry_delay(exception, attempt))
+
+        self.rate_limiter.update(tokens, completion.usage)
+        return completion, attempt
+
+    async def async_create(self, params):
+        tokens = estimate_tokens(params["messages"], params.get("max_tokens", SAMPLING_PARAMS["max_tokens"]) * params.get("n", 1))
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.async_acquire(tokens)
+            try:
+                completion = await self.async_send(params)
+                break
+            except Exception as exception:
+                await asyncio.sleep(self.retry_delay(exception, attempt))
+
+        self.rate_limiter.update(tokens, completion.usage)
+        return completion, attempt
+
+    # a single request, either to the provider of the model or to an endpoint of its route
+    def send(self, params):
+        if self.route is None:
+            return self.client.chat.completions.create(**params)
+        with self.route.slot() as endpoint:
+            return endpoint.get_client().chat.completions.create(**self.route.request(params))
+
+    async def async_send(self, params):
+        if self.route is None:
+            if self.async_client is None:
+                self.async_client = new_client(self.client_kwargs, as_async=True)
+            return await self.async_client.chat.completions.create(**params)
+        async with self.route.async_slot() as endpoint:
+            return await endpoint.get_async_client().chat.completions.create(**self.route.request(params))
+
+    # return the backoff delay for a failed request or re-raise the exception if it should not be retried
+    def retry_delay(self, exception, attempt):
+        if not is_retryable(exception) or attempt >= self.max_retries:
+            if self.telemetry is not None:
+                self.telemetry.record(retries=attempt, error="{} ({})".format(type(exception).__name__, get_status_code(exception)))
+            raise exception
+
+        retry_after = get_retry_after(exception)
+        delay = backoff_delay(attempt, retry_after)
+        if get_status_code(exception) == 429:
+            self.rate_limiter.pause(delay)
+        print("Retrying request after error ({}), attempt {} in {:.1f}s".format(get_status_code(exception), attempt + 1, delay))
+
+        return delay
     
     
     def get_completion_message(self, completion):
         return completion.choices[0].message.content
 
-def batch_call(model, messages, id):
+    def get_completion_messages(self, completion):
+        return [choice.message.content for choice in sorted(completion.choices, key=lambda choice: choice.index)]
+
+    # a rejected n parameter (400) or a wrong number of choices disables multi-choice calls, all other errors are raised
+    def disable_n(self, exception=None):
+        if exception is not None and get_status_code(exception) != 400:
+            raise exception
+        print("The n parameter is not supported for {}, falling back to separate calls".format(self.args.model))
+        self.supports_n = False
+
+    # responses for the given sample indices, requested in one call with n choices if possible
+    def sample_responses(self, messages, samples):
+        if len(samples) > 1 and self.supports_n:
+            try:
+                responses = self.get_completion_messages(self.api_call(messages, samples[0], len(samples)))
+                if len(responses) == len(samples):
+                    return responses
+                # providers which ignore n return a single choice
+                self.disable_n()
+            except Exception as exception:
+                self.disable_n(exception)
+
+        return [self.get_completion_message(self.api_call(messages, sample)) for sample in samples]
+
+    # every call holds its own slot of the semaphore (if given), which bounds the number of in-flight requests
+    async def async_sample_responses(self, messages, samples, semaphore=None):
+        async def call(sample, n=1):
+            if semaphore is None:
+                return await self.async_api_call(messages, sample, n)
+            async with semaphore:
+                return await self.async_api_call(messages, sample, n)
+
+        if len(samples) > 1 and self.supports_n:
+            try:
+                responses = self.get_completion_messages(await call(samples[0], len(samples)))
+                if len(responses) == len(samples):
+                    return responses
+                self.disable_n()
+            except Exception as exception:
+                self.disable_n(exception)
+
+        completions = await asyncio.gather(*[call(sample) for sample in samples])
+        return [self.get_completion_message(completion) for completion in completions]
+
+def new_client(client_kwargs, as_async=False):
+    from openai import OpenAI, AsyncOpenAI
+    return AsyncOpenAI(**client_kwargs) if as_async else OpenAI(**client_kwargs)
+
+# with n > 1, the choices of the call are the samples following the sample index of the custom id
+def batch_call(model, messages, id, n=1):
     return {
         "custom_id": id,
         "method": "POST",
@@ -80,11 +268,7 @@ def batch_call(model, messages, id):
         "body": {
             "model": model,
             "messages": messages,
-            "temperature": float(0.8),
-            "max_tokens": 512,
-            "top_p": 1,
-            "frequency_penalty": 0,
-            "presence_penalty": 0
+            **({**SAMPLING_PARAMS, "n": n} if n > 1 else SAMPLING_PARAMS)
         }
     }
 
@@ -103,3 +287,19 @@ def save_results(data, filename, as_json=True):
         with open(filename + ".pkl", "wb") as file:
             pickle.dump(data, file)
             file.close()
+
+# first row of every key, built once instead of scanning the frame with a boolean mask for every lookup
+class RowLookup:
+    def __init__(self, frame, columns, name):
+        self.columns = columns
+        self.name = name
+        frame = frame.drop_duplicates(columns, keep="first")
+        self.rows = dict(zip(frame[columns].itertuples(index=False, name=None), frame.to_dict("records")))
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __getitem__(self, key):
+        if key not in self.rows:
+            raise Exception("No {} found for {}".format(self.name, ", ".join("{}={}".format(column, value) for column, value in zip(self.columns, key))))
+        return self.rows[key]